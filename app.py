@@ -1,118 +1,308 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, g, request, jsonify, send_file
 from flask_cors import CORS
 import os
 import tempfile
 import csv
 import io
+import gzip
 import json
-import requests
 import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from invoice_extractor_server import extract_fields_from_image
+import request_profiler
+import tracing
+import usage_accounting
+from werkzeug.exceptions import HTTPException
+from invoice_extractor_server import (
+    USAGE, extract_fields_from_image, flatten_invoice_data, get_cascade_stats, get_input_mode_stats
+)
+from invoice_analytics import InvoiceAnalytics
+from invoice_model import Invoice
+from invoice_search import SearchIndex
+import einvoice_qr
+from invoice_store import InvoiceStore
+from extraction_scheduler import PRIORITY_CLASSES, ExtractionScheduler, QueueFull
+from single_flight import SingleFlight
+from upload_stream import InvalidUpload, StreamingUploadRequest
+from work_queue import open_queue, spool_file
+from webhooks import (
+    WEBHOOK_LOGS, append_webhook_log, dispatch_webhooks, get_webhook_health, load_webhook_config,
+    save_webhook_config
+)
 
 app = Flask(__name__)
+app.request_class = StreamingUploadRequest
 
-CORS(app, origins=["*"])
+CORS(app, origins=["*"], expose_headers=['Server-Timing', 'X-Trace-Id', 'Retry-After', 'X-Profile-Id'])
 
 # Configure upload settings
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB default request size
 UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
-# Webhook configuration storage
-WEBHOOK_CONFIG_FILE = 'webhook_config.json'
-WEBHOOK_LOGS = []
+# Per-route upload limits; uploads are streamed to disk so these can be large
+UPLOAD_LIMITS = {
+    'extract_invoice_data': int(os.environ.get('EXTRACT_MAX_UPLOAD_MB', 64)) * 1024 * 1024,
+    'extract_invoice_batch': int(os.environ.get('EXTRACT_BATCH_MAX_UPLOAD_MB', 512)) * 1024 * 1024,
+}
+StreamingUploadRequest.upload_limits = UPLOAD_LIMITS
+StreamingUploadRequest.upload_folder = UPLOAD_FOLDER
+
+# Recent extraction results (Invoice objects) keyed by upload content hash
+EXTRACTION_CACHE_SIZE = int(os.environ.get('EXTRACTION_CACHE_SIZE', 128))
+EXTRACTION_CACHE = OrderedDict()
+EXTRACTION_CACHE_LOCK = threading.Lock()
+
+# Concurrent uploads of the same content share one model call, also across
+# worker processes via lease files in this folder
+EXTRACTION_FLIGHTS = SingleFlight(
+    lease_dir=os.path.join(UPLOAD_FOLDER, '.inflight'),
+    lease_seconds=int(os.environ.get('SINGLE_FLIGHT_LEASE_SECONDS', 300))
+)
+
+# Model calls run on a shared worker pool; interactive uploads are served
+# ahead of bulk batches without starving them
+SCHEDULER = ExtractionScheduler(
+    workers=int(os.environ.get('EXTRACTION_WORKERS', 4)),
+    weights={
+        'interactive': int(os.environ.get('SCHEDULER_INTERACTIVE_WEIGHT', 4)),
+        'bulk': int(os.environ.get('SCHEDULER_BULK_WEIGHT', 1))
+    },
+    bulk_max_wait=float(os.environ.get('SCHEDULER_BULK_MAX_WAIT', 30)),
+    bulk_max_inflight=int(os.environ['SCHEDULER_BULK_MAX_INFLIGHT']) if os.environ.get('SCHEDULER_BULK_MAX_INFLIGHT') else None,
+    # Admission control: bounded queues and the longest acceptable queue wait
+    max_queue={
+        'interactive': int(os.environ.get('ADMISSION_MAX_QUEUE_INTERACTIVE', 100)),
+        'bulk': int(os.environ.get('ADMISSION_MAX_QUEUE_BULK', 1000))
+    },
+    max_queue_wait={
+        'interactive': float(os.environ.get('ADMISSION_MAX_WAIT_INTERACTIVE', 30)),
+        'bulk': float(os.environ.get('ADMISSION_MAX_WAIT_BULK', 600))
+    },
+    initial_latency=float(os.environ.get('ADMISSION_INITIAL_LATENCY', 10))
+)
+
+# With EXTRACTION_BACKEND=queue, extractions are enqueued for extraction_worker.py
+# processes instead of running on SCHEDULER in this process
+EXTRACTION_BACKEND = os.environ.get('EXTRACTION_BACKEND', 'local')
+WORK_QUEUE = open_queue() if EXTRACTION_BACKEND == 'queue' else None
+# Jobs allowed to wait in the queue per priority class before uploads are shed
+WORK_QUEUE_MAX_PENDING = {
+    'interactive': int(os.environ.get('WORK_QUEUE_MAX_PENDING_INTERACTIVE', 1000)),
+    'bulk': int(os.environ.get('WORK_QUEUE_MAX_PENDING_BULK', 10000))
+}
+# Seconds /api/extract waits for a queued job before answering 202 with its id
+QUEUE_RESPONSE_WAIT = float(os.environ.get('QUEUE_RESPONSE_WAIT', 25))
+# Upper bound on a client's ?wait=, so one request cannot hold a server thread
+QUEUE_MAX_RESPONSE_WAIT = float(os.environ.get('QUEUE_MAX_RESPONSE_WAIT', 30))
+
+# Every new extraction is appended here; analytics reads it incrementally
+INVOICE_STORE = InvoiceStore()
+ANALYTICS = InvoiceAnalytics(INVOICE_STORE)
+SEARCH_INDEX = SearchIndex(INVOICE_STORE)
+# Index existing extractions in the background; later ones are added as they arrive
+threading.Thread(target=SEARCH_INDEX.refresh, name='search-index-warmup', daemon=True).start()
+
 RECEIVED_WEBHOOK_DATA = []  # Store actual received JSON data
 
-def load_webhook_config():
-    """Load webhook configuration from file."""
-    try:
-        if os.path.exists(WEBHOOK_CONFIG_FILE):
-            with open(WEBHOOK_CONFIG_FILE, 'r') as f:
-                return json.load(f)
-    except Exception as e:
-        print(f"Error loading webhook config: {e}")
-    return {'webhooks': []}
+# Requests that get a trace, returned as Server-Timing and logged to TRACE_LOG_FILE
+TRACED_ENDPOINTS = {'extract_invoice_data', 'extract_invoice_batch'}
+# Requests that may be profiled, on the X-Profile admin header or by sampling
+PROFILED_ENDPOINTS = {'extract_invoice_data', 'extract_invoice_batch', 'download_csv'}
+
+@app.before_request
+def start_request_trace():
+    # Model calls made for this request are accounted to its endpoint
+    usage_accounting.set_endpoint(request.endpoint)
+    if request.endpoint in TRACED_ENDPOINTS:
+        tracing.start_trace(
+            request.endpoint,
+            traceparent=request.headers.get('traceparent'),
+            method=request.method,
+            path=request.path
+        )
 
-def save_webhook_config(config):
-    """Save webhook configuration to file."""
+@app.before_request
+def start_request_profile():
+    if request.endpoint not in PROFILED_ENDPOINTS or not request_profiler.should_profile(request.headers.get('X-Profile')):
+        return None
     try:
-        with open(WEBHOOK_CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=2)
-        return True
-    except Exception as e:
-        print(f"Error saving webhook config: {e}")
-        return False
+        profile = request_profiler.RequestProfile(
+            request.endpoint,
+            mode=request.headers.get('X-Profile-Mode') or request_profiler.PROFILE_MODE,
+            method=request.method,
+            path=request.path
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    profile.start()
+    g.profile = profile
+    return None
 
-def send_webhook(url, data, headers=None):
-    """Send data to webhook URL asynchronously."""
-    def _send():
-        log_entry = {
-            'timestamp': datetime.now().isoformat(),
-            'url': url,
-            'status': 'pending',
-            'response_code': None,
-            'error': None
-        }
-        
+@app.after_request
+def finish_request_trace(response):
+    trace = tracing.current_trace()
+    if trace is not None:
+        tracing.end_trace(trace, status=response.status_code)
+        response.headers['Server-Timing'] = trace.server_timing()
+        response.headers['Timing-Allow-Origin'] = '*'
+        response.headers['X-Trace-Id'] = trace.trace_id
+    return response
+
+@app.after_request
+def finish_request_profile(response):
+    # Registered after finish_request_trace so it runs first, while the trace is open
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.stop()
+        trace = tracing.current_trace()
+        profile.details.update(status=response.status_code, trace_id=trace.trace_id if trace else None)
         try:
-            webhook_headers = {'Content-Type': 'application/json'}
-            if headers:
-                webhook_headers.update(headers)
-            
-            response = requests.post(
-                url, 
-                json=data, 
-                headers=webhook_headers,
-                timeout=30
-            )
-            
-            log_entry['status'] = 'success' if response.status_code < 400 else 'failed'
-            log_entry['response_code'] = response.status_code
-            log_entry['response_text'] = response.text[:500]  # Limit response text
-            
-        except Exception as e:
-            log_entry['status'] = 'error'
-            log_entry['error'] = str(e)
-        
-        # Store log (keep only last 100 entries)
-        WEBHOOK_LOGS.append(log_entry)
-        if len(WEBHOOK_LOGS) > 100:
-            WEBHOOK_LOGS.pop(0)
-    
-    # Send webhook in background thread
-    thread = threading.Thread(target=_send)
-    thread.daemon = True
-    thread.start()
-
-def flatten_invoice_data(data):
-    """Flatten nested invoice data for CSV export."""
-    flattened = {}
-    
-    def flatten_dict(d, prefix=''):
-        for key, value in d.items():
-            if isinstance(value, dict):
-                flatten_dict(value, f"{prefix}{key}_")
-            elif isinstance(value, list):
-                if key == 'items':
-                    # Handle items array specially
-                    for i, item in enumerate(value):
-                        for item_key, item_value in item.items():
-                            flattened[f"item_{i+1}_{item_key}"] = item_value
-                else:
-                    flattened[f"{prefix}{key}"] = str(value)
-            else:
-                flattened[f"{prefix}{key}"] = value
-    
-    flatten_dict(data)
-    return flattened
+            metadata = profile.save()
+            if metadata is not None:
+                response.headers['X-Profile-Id'] = metadata['id']
+        except OSError as e:
+            print(f"Error saving profile {profile.profile_id}: {e}")
+    return response
+
+@app.teardown_request
+def discard_request_profile(error=None):
+    # Only left over when the response never got to finish_request_profile
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.stop()
+
+def get_cached_extraction(content_hash):
+    """Return a previous extraction result for identical upload content."""
+    with EXTRACTION_CACHE_LOCK:
+        if content_hash in EXTRACTION_CACHE:
+            EXTRACTION_CACHE.move_to_end(content_hash)
+            return EXTRACTION_CACHE[content_hash]
+    return None
+
+def cache_extraction(content_hash, data):
+    """Remember an extraction result, evicting the least recently used."""
+    with EXTRACTION_CACHE_LOCK:
+        EXTRACTION_CACHE[content_hash] = data
+        EXTRACTION_CACHE.move_to_end(content_hash)
+        while len(EXTRACTION_CACHE) > EXTRACTION_CACHE_SIZE:
+            EXTRACTION_CACHE.popitem(last=False)
+
+def invoice_response(invoice):
+    """JSON response reusing the invoice's cached encoding."""
+    return app.response_class(invoice.to_json_bytes(), mimetype='application/json')
+
+def get_request_priority(default):
+    """Priority class from the X-Priority header or the 'priority' query argument.
+
+    Form fields are not consulted: reading one parses the whole upload, and the
+    priority is needed to shed a request before its body is read.
+    """
+    priority = request.headers.get('X-Priority') or request.args.get('priority') or default
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Invalid priority '{priority}'. Use one of: {', '.join(PRIORITY_CLASSES)}")
+    return priority
+
+def get_extract_mode():
+    """'full' extraction, or 'header' for integrations that only need the header."""
+    mode = request.headers.get('X-Extract-Mode') or request.args.get('mode') or 'full'
+    if mode not in ('full', 'header'):
+        raise ValueError(f"Invalid mode '{mode}'. Use 'full' or 'header'")
+    return mode
+
+def busy_response(retry_after, estimated_wait=None):
+    """503 telling the client when a retry is expected to be admitted."""
+    response = jsonify({
+        'error': 'Server is busy, please retry later',
+        'retry_after': retry_after,
+        'estimated_wait_seconds': round(estimated_wait, 1) if estimated_wait is not None else None
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def usage_headers(response, meta):
+    """Expose the model and token counts of a fresh extraction."""
+    if meta.get('model'):
+        response.headers['X-Extraction-Model'] = meta['model']
+    if meta.get('tokens'):
+        response.headers['X-Extraction-Tokens'] = f"prompt={meta['tokens']['prompt']}, output={meta['tokens']['output']}"
+    return response
+
+def check_admission(priority, jobs=1):
+    """Shed a request of `jobs` extractions if the queue wait would be too long."""
+    retry_after = USAGE.check()
+    if retry_after is not None:
+        # Over the daily token budget: throttled until the next slot or day
+        response = jsonify({'error': 'Daily token budget exhausted, please retry later', 'retry_after': retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    if WORK_QUEUE is not None:
+        if WORK_QUEUE.stats()['queued'][priority] + jobs > WORK_QUEUE_MAX_PENDING[priority]:
+            return busy_response(max(1, round(QUEUE_RESPONSE_WAIT)))
+        return None
+    admitted, estimated_wait, retry_after = SCHEDULER.try_admit(priority, jobs=jobs)
+    if not admitted:
+        return busy_response(retry_after, estimated_wait)
+    return None
+
+def enqueue_upload(file, upload, mode, priority, source, einvoice=None):
+    """Queue an upload for the extraction workers and return the job id."""
+    payload = {
+        'path': os.path.abspath(spool_file(upload.path, upload.sha256, upload.extension)),
+        'mime_type': upload.mime_type,
+        'sha256': upload.sha256,
+        'filename': file.filename,
+        'mode': mode,
+        'source': source,
+        'endpoint': request.endpoint,
+        'traceparent': tracing.propagation_headers().get('traceparent')
+    }
+    if einvoice is not None:
+        payload['einvoice'] = einvoice
+    # Repeated uploads of the same content share the job still in the queue
+    return WORK_QUEUE.enqueue(payload, priority=priority, dedupe_key=f'{upload.sha256}:{mode}')
+
+def wait_for_job(job_id, timeout):
+    """Poll a queued job until it finishes or the timeout passes."""
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
+        job = WORK_QUEUE.get(job_id)
+        remaining = deadline - time.monotonic()
+        if job is None or job['status'] in ('done', 'failed') or remaining <= 0:
+            return job
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.5)
+
+def job_accepted_response(job):
+    """202 pointing the client at the job's status endpoint."""
+    status_url = f"/api/jobs/{job['job_id']}"
+    response = jsonify({'job_id': job['job_id'], 'status': job['status'], 'status_url': status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
 
 @app.route('/api/extract', methods=['POST'])
 def extract_invoice_data():
     """Extract data from uploaded invoice image."""
     try:
-        # Check if file is present
+        try:
+            priority = get_request_priority('interactive')
+            mode = get_extract_mode()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        with tracing.span('admission', priority=priority):
+            rejection = check_admission(priority)
+        if rejection is not None:
+            return rejection
+        
+        # Accessing request.files streams the body into spool files, hashing
+        # and sniffing each one as it arrives; bad or oversize uploads abort here.
         if 'file' not in request.files:
             return jsonify({'error': 'No file uploaded'}), 400
         
@@ -120,21 +310,69 @@ def extract_invoice_data():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        # Validate file type
-        allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
-        file_extension = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
+        upload = file.stream
+        tracing.add_span('upload', (upload.finished_at or upload.started_at) - upload.started_at,
+                         start=upload.started_at, bytes=upload.size)
+        tracing.add_span('temp_write', upload.write_seconds, start=upload.started_at)
         
-        if file_extension not in allowed_extensions:
-            return jsonify({'error': 'Invalid file type. Please upload an image file.'}), 400
+        cache_key = upload.sha256 if mode == 'full' else f'{upload.sha256}:{mode}'
+        with tracing.span('cache') as cache_span:
+            invoice = get_cached_extraction(cache_key)
+            cache_span.set('hit', invoice is not None)
         
-        # Save uploaded file temporarily
-        temp_filename = f"temp_invoice_{os.urandom(8).hex()}.{file_extension}"
-        temp_path = os.path.join(UPLOAD_FOLDER, temp_filename)
-        file.save(temp_path)
+        duplicate_irn = None
+        if invoice is None:
+            # A verified e-invoice QR code identifies the invoice by its IRN, so
+            # a different scan of an invoice we already have needs no model call.
+            # An unverified IRN could name any invoice, so it is not looked up.
+            with tracing.span('qr_decode') as qr_span:
+                einvoice = einvoice_qr.find_einvoice(upload.path, upload.mime_type)
+                qr_span.set('found', einvoice is not None)
+            if einvoice and einvoice['verified']:
+                record = SEARCH_INDEX.find_irn(einvoice['fields']['Irn'])
+                if record and (record.get('mode', 'full') == 'full' or mode == 'header'):
+                    invoice = Invoice.from_dict(record['data'])
+                    duplicate_irn = einvoice['fields']['Irn']
         
-        try:
-            # Extract data using your existing function
-            extracted_data, error_message = extract_fields_from_image(temp_path)
+        if invoice is None and WORK_QUEUE is not None:
+            # A worker extracts, stores and fires the webhooks; answer with the
+            # result if it is ready in time, otherwise with the job id
+            with tracing.span('enqueue'):
+                job_id = enqueue_upload(file, upload, mode, priority, 'api', einvoice=einvoice or False)
+            with tracing.span('wait_for_job'):
+                wait = request.args.get('wait', QUEUE_RESPONSE_WAIT, type=float)
+                job = wait_for_job(job_id, min(max(0.0, wait), QUEUE_MAX_RESPONSE_WAIT))
+            if job is None:
+                # Purged (or lost with the queue) before it could be answered
+                return jsonify({'error': 'Job not found', 'job_id': job_id}), 404
+            if job['status'] == 'failed':
+                return jsonify({'error': job.get('error', 'Extraction failed'), 'job_id': job_id}), 500
+            if job['status'] != 'done':
+                return job_accepted_response(job)
+            invoice = Invoice.from_dict(job['result']['data'])
+            cache_extraction(cache_key, invoice)
+            RECEIVED_WEBHOOK_DATA[:] = [{
+                'timestamp': datetime.now().isoformat(),
+                'data': invoice.to_dict(),
+                'digest': invoice.digest
+            }]
+            response = invoice_response(invoice)
+            response.headers['X-Job-Id'] = job_id
+            return response
+        
+        meta = {}
+        if invoice is None:
+            # Extract data using your existing function; duplicates of an
+            # in-flight upload wait for and share the first request's result
+            with tracing.span('extract') as extract_span:
+                (extracted_data, error_message), shared = EXTRACTION_FLIGHTS.do(
+                    cache_key,
+                    lambda: SCHEDULER.submit(
+                        extract_fields_from_image, upload.path, upload.mime_type, meta=meta,
+                        header_only=mode == 'header', einvoice=einvoice or False, priority=priority
+                    ).result()
+                )
+                extract_span.set('shared', shared)
             
             if error_message:
                 return jsonify({'error': error_message}), 500
@@ -142,34 +380,144 @@ def extract_invoice_data():
             if not extracted_data:
                 return jsonify({'error': 'No data could be extracted from the invoice'}), 400
             
-            # Clean up temporary file
-            os.remove(temp_path)
-            
-            # Store current invoice data (replace any previous data)
-            current_entry = {
-                'timestamp': datetime.now().isoformat(),
-                'data': extracted_data
-            }
-            RECEIVED_WEBHOOK_DATA[:] = [current_entry]
-            
-            # Send data to configured webhooks
-            config = load_webhook_config()
-            for webhook in config.get('webhooks', []):
-                if webhook.get('enabled', True):
-                    send_webhook(
-                        webhook['url'], 
-                        extracted_data, 
-                        webhook.get('headers', {})
+            # Typed once; the response, cache and webhooks share its encoded JSON
+            invoice = Invoice.from_dict(extracted_data)
+            cache_extraction(cache_key, invoice)
+            if not shared:
+                # Coalesced duplicates were already stored by their leader
+                INVOICE_STORE.retain_source(upload.path, upload.sha256, upload.extension)
+                INVOICE_STORE.append(invoice, upload.sha256, source='api', filename=file.filename, mode=mode,
+                                     model=meta.get('model'), tokens=meta.get('tokens'),
+                                     section_versions=meta.get('section_versions'))
+                SEARCH_INDEX.refresh()
+        
+        # Store current invoice data (replace any previous data)
+        current_entry = {
+            'timestamp': datetime.now().isoformat(),
+            'data': invoice.to_dict(),
+            'digest': invoice.digest
+        }
+        RECEIVED_WEBHOOK_DATA[:] = [current_entry]
+        
+        # Send data to configured webhooks (encoded once, duplicates collapsed);
+        # a duplicate was sent when it was first extracted
+        if not duplicate_irn:
+            dispatch_webhooks(invoice)
+        
+        response = usage_headers(invoice_response(invoice), meta)
+        if duplicate_irn:
+            response.headers['X-Duplicate-IRN'] = duplicate_irn
+        return response
+        
+    except QueueFull:
+        # Lost the race for the last queue slot after being admitted
+        return busy_response(max(1, round(SCHEDULER.estimate_wait(priority))))
+    except HTTPException:
+        raise
+    except Exception as e:
+        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+@app.route('/api/extract-batch', methods=['POST'])
+def extract_invoice_batch():
+    """Extract data from several uploaded invoices, as bulk priority by default."""
+    try:
+        try:
+            priority = get_request_priority('bulk')
+            mode = get_extract_mode()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Shed early, before the body is read, when not even one more job fits
+        rejection = check_admission(priority)
+        if rejection is not None:
+            return rejection
+        
+        files = [f for f in request.files.getlist('files') if f.filename]
+        if not files:
+            return jsonify({'error': 'No files uploaded'}), 400
+        
+        # The whole batch must fit, or none of it is started
+        rejection = check_admission(priority, jobs=len(files))
+        if rejection is not None:
+            return rejection
+        
+        if WORK_QUEUE is not None:
+            # Hand every uncached file to the workers and answer right away
+            results = []
+            for file in files:
+                upload = file.stream
+                cached = get_cached_extraction(upload.sha256 if mode == 'full' else f'{upload.sha256}:{mode}')
+                if cached is not None:
+                    dispatch_webhooks(cached)
+                    results.append({'filename': file.filename, 'data': cached.to_dict()})
+                    continue
+                job_id = enqueue_upload(file, upload, mode, priority, 'batch')
+                results.append({'filename': file.filename, 'job_id': job_id, 'status_url': f'/api/jobs/{job_id}'})
+            return jsonify({
+                'count': len(results),
+                'queued': sum(1 for result in results if 'job_id' in result),
+                'results': results
+            }), 202
+        
+        # Queue every file first so the batch runs concurrently
+        pending = []
+        for file in files:
+            upload = file.stream
+            cache_key = upload.sha256 if mode == 'full' else f'{upload.sha256}:{mode}'
+            cached = get_cached_extraction(cache_key)
+            if cached is not None:
+                pending.append((file, upload, None, cached, {}))
+            else:
+                meta = {}
+                try:
+                    # The worker decodes any e-invoice QR code itself
+                    future = SCHEDULER.submit(
+                        extract_fields_from_image, upload.path, upload.mime_type, meta=meta,
+                        header_only=mode == 'header', priority=priority
                     )
+                except QueueFull:
+                    future = None
+                pending.append((file, upload, future, None, meta))
+        
+        results = []
+        for file, upload, future, invoice, meta in pending:
+            if future is None and invoice is None:
+                results.append({'filename': file.filename, 'error': 'Server is busy, please retry later'})
+                continue
+            if future is not None:
+                try:
+                    extracted_data, error_message = future.result()
+                except Exception as e:
+                    extracted_data, error_message = None, f'Processing failed: {str(e)}'
+                if error_message or not extracted_data:
+                    results.append({
+                        'filename': file.filename,
+                        'error': error_message or 'No data could be extracted from the invoice'
+                    })
+                    continue
+                invoice = Invoice.from_dict(extracted_data)
+                cache_extraction(upload.sha256 if mode == 'full' else f'{upload.sha256}:{mode}', invoice)
+                INVOICE_STORE.retain_source(upload.path, upload.sha256, upload.extension)
+                INVOICE_STORE.append(invoice, upload.sha256, source='batch', filename=file.filename, mode=mode,
+                                     model=meta.get('model'), tokens=meta.get('tokens'),
+                                     section_versions=meta.get('section_versions'))
             
-            return jsonify(extracted_data)
-            
-        except Exception as e:
-            # Clean up temporary file in case of error
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            raise e
-            
+            dispatch_webhooks(invoice)
+            result = {'filename': file.filename, 'data': invoice.to_dict()}
+            if meta.get('tokens'):
+                result.update(model=meta['model'], tokens=meta['tokens'])
+            results.append(result)
+        
+        SEARCH_INDEX.refresh()
+        
+        return jsonify({
+            'count': len(results),
+            'succeeded': sum(1 for result in results if 'data' in result),
+            'results': results
+        })
+        
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': f'Processing failed: {str(e)}'}), 500
 
@@ -186,7 +534,7 @@ def download_csv():
         output = io.StringIO()
         
         # Flatten the structured data for CSV
-        flattened_data = flatten_invoice_data(data)
+        flattened_data = flatten_invoice_data(Invoice.from_dict(data))
         
         # Write CSV headers and data
         fieldnames = list(flattened_data.keys())
@@ -239,8 +587,10 @@ def download_json():
 
 @app.route('/api/webhooks', methods=['GET'])
 def get_webhooks():
-    """Get all configured webhooks."""
+    """Get all configured webhooks with their delivery health."""
     config = load_webhook_config()
+    for webhook in config.get('webhooks', []):
+        webhook['health'] = get_webhook_health(webhook['url']) or {'state': 'closed', 'latency_ms': None}
     return jsonify(config)
 
 @app.route('/api/webhooks', methods=['POST'])
@@ -260,9 +610,19 @@ def add_webhook():
             'url': data['url'],
             'enabled': data.get('enabled', True),
             'headers': data.get('headers', {}),
+            'gzip': bool(data.get('gzip', False)),
             'created_at': datetime.now().isoformat()
         }
         
+        # Optional delivery settings
+        for key in ('connect_timeout', 'read_timeout'):
+            if data.get(key) is not None:
+                webhook[key] = float(data[key])
+        if data.get('on_open') is not None:
+            if data['on_open'] not in ('drop', 'queue'):
+                return jsonify({'error': "on_open must be 'drop' or 'queue'"}), 400
+            webhook['on_open'] = data['on_open']
+        
         config['webhooks'].append(webhook)
         
         if save_webhook_config(config):
@@ -316,7 +676,10 @@ def get_webhook_logs():
 def demo_webhook():
     """Demo webhook endpoint to receive invoice data."""
     try:
-        data = request.get_json()
+        if request.content_encoding == 'gzip':
+            data = json.loads(gzip.decompress(request.get_data()))
+        else:
+            data = request.get_json()
         
         # Log the received data
         log_entry = {
@@ -329,16 +692,19 @@ def demo_webhook():
         }
         
         # Store in webhook logs for demonstration
-        WEBHOOK_LOGS.append(log_entry)
-        if len(WEBHOOK_LOGS) > 100:
-            WEBHOOK_LOGS.pop(0)
+        append_webhook_log(log_entry)
         
         # Only store data if this is a demo webhook call (not from main extraction)
-        # Check if data is already stored from main extraction process
-        if not RECEIVED_WEBHOOK_DATA or RECEIVED_WEBHOOK_DATA[0]['data'] != data:
+        # Check if data is already stored from main extraction process; our own
+        # deliveries carry the digest, so no dict comparison is needed
+        digest = request.headers.get('X-Invoice-Digest')
+        if digest is None and data:
+            digest = Invoice.from_dict(data).digest
+        if not RECEIVED_WEBHOOK_DATA or RECEIVED_WEBHOOK_DATA[0].get('digest') != digest:
             received_entry = {
                 'timestamp': log_entry['timestamp'],
-                'data': data
+                'data': data,
+                'digest': digest
             }
             # Replace entire list with single current entry
             RECEIVED_WEBHOOK_DATA[:] = [received_entry]
@@ -363,7 +729,7 @@ def demo_webhook():
             'type': 'demo_webhook_error',
             'error': str(e)
         }
-        WEBHOOK_LOGS.append(error_log)
+        append_webhook_log(error_log)
         
         return jsonify({
             'status': 'error',
@@ -559,14 +925,124 @@ def test_webhook_system():
         }
         return jsonify(results), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Report extraction pipeline metrics."""
+    return jsonify({
+        'timestamp': datetime.now().isoformat(),
+        'cascade': get_cascade_stats(),
+        'input_modes': get_input_mode_stats(),
+        'single_flight': EXTRACTION_FLIGHTS.get_stats(),
+        'scheduler': SCHEDULER.get_stats(),
+        'work_queue': WORK_QUEUE.stats() if WORK_QUEUE is not None else None
+    })
+
+@app.route('/api/usage', methods=['GET'])
+def get_usage():
+    """Model calls, tokens, latency and cost per day, endpoint, model, supplier or prompt."""
+    try:
+        group_by = tuple(
+            dimension.strip() for dimension in request.args.get('group_by', 'day,endpoint,model').split(',')
+            if dimension.strip()
+        )
+        return jsonify(USAGE.report(request.args.get('from'), request.args.get('to'), group_by))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Usage query failed: {str(e)}'}), 500
+
+@app.route('/api/jobs', methods=['GET'])
+def get_jobs():
+    """Work queue depth and job counts."""
+    if WORK_QUEUE is None:
+        return jsonify({'error': 'The work queue is not enabled (EXTRACTION_BACKEND=queue)'}), 404
+    return jsonify(WORK_QUEUE.stats())
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status of a queued extraction, with the extracted data once done."""
+    if WORK_QUEUE is None:
+        return jsonify({'error': 'The work queue is not enabled (EXTRACTION_BACKEND=queue)'}), 404
+    job = WORK_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/profiles', methods=['GET'])
+def list_request_profiles():
+    """Stored request profiles, newest first (admin token required)."""
+    if not request_profiler.is_admin(request.headers.get('X-Profile')):
+        return jsonify({'error': 'Send the profiling admin token in the X-Profile header'}), 403
+    return jsonify({
+        'sample_rate': request_profiler.PROFILE_SAMPLE_RATE,
+        'ring_size': request_profiler.PROFILE_RING_SIZE,
+        'profiles': request_profiler.list_profiles()
+    })
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def download_request_profile(profile_id):
+    """Download a profile as collapsed stacks (sampler) or a pstats file (cprofile)."""
+    if not request_profiler.is_admin(request.headers.get('X-Profile')):
+        return jsonify({'error': 'Send the profiling admin token in the X-Profile header'}), 403
+    path = request_profiler.profile_path(profile_id)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    mimetype = 'text/plain' if path.endswith('.collapsed') else 'application/octet-stream'
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=os.path.basename(path))
+
+@app.route('/api/analytics', methods=['GET'])
+def get_analytics():
+    """Spend grouped by supplier GSTIN, HSN code or month."""
+    try:
+        result = ANALYTICS.query(
+            group_by=request.args.get('group_by', 'supplier'),
+            month_from=request.args.get('from'),
+            month_to=request.args.get('to'),
+            supplier=request.args.get('supplier'),
+            limit=request.args.get('limit', 50, type=int)
+        )
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Analytics query failed: {str(e)}'}), 500
+
+@app.route('/api/search', methods=['GET'])
+def search_invoices():
+    """Ranked full-text search over extracted invoices."""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Query parameter q is required'}), 400
+    
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+    if page < 1 or not 1 <= per_page <= 100:
+        return jsonify({'error': 'page must be >= 1 and per_page between 1 and 100'}), 400
+    
+    try:
+        started = time.perf_counter()
+        result = SEARCH_INDEX.search(
+            query, page=page, per_page=per_page,
+            include_data=request.args.get('include_data', '').lower() in ('1', 'true', 'yes')
+        )
+        result['elapsed_ms'] = round(1000 * (time.perf_counter() - started), 2)
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': f'Search failed: {str(e)}'}), 500
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
     return jsonify({'status': 'healthy', 'message': 'Invoice extractor API is running'})
 
+@app.errorhandler(InvalidUpload)
+def invalid_upload(e):
+    return jsonify({'error': e.description}), 400
+
 @app.errorhandler(413)
 def too_large(e):
-    return jsonify({'error': 'File too large. Maximum size is 16MB.'}), 413
+    limit_mb = (request.max_content_length or 0) // (1024 * 1024)
+    return jsonify({'error': f'File too large. Maximum size is {limit_mb}MB.'}), 413
 
 @app.errorhandler(404)
 def not_found(e):
@@ -0,0 +1,249 @@
+"""Re-extract stored invoices whose sections predate the current prompt.
+
+Every stored extraction records the version of each section it was extracted
+under (``section_versions``; see SECTION_VERSIONS in invoice_extractor_server).
+When a section's schema or the prompt instructions change, its version
+changes. This script finds the latest record for each source image whose
+versions are out of date, sends the kept image (see InvoiceStore.retain_source)
+to the model asking for only the stale sections, and appends the merged result
+to the store with ``supersedes`` pointing at the old record. Records from before
+versioning have no versions, so every section counts as stale; pass
+``--sections`` to limit the backfill to the sections that actually changed.
+
+A JSON Lines checkpoint records each finished invoice, so an interrupted run
+picks up where it stopped. Only permanent failures (a missing source image, an
+incomplete result from every model) are checkpointed as failed. Model errors
+and calls refused by the daily token budget are not checkpointed, so the next
+run tries them again. The run stops early if the budget runs out.
+
+A stale section is only replaced when the new result passes validation. If it
+does not, the new result only fills sections the stored record lacks. A section
+missing from the new result keeps its stored data and old version.
+
+Usage:
+    python backfill.py --sections transport_info --concurrency 4
+    python backfill.py --dry-run
+"""
+import argparse
+import hashlib
+import json
+import os
+import signal
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import usage_accounting
+from invoice_extractor_server import (
+    ALL_SECTIONS, HEADER_SECTIONS, SECTION_VERSIONS, USAGE, extract_fields_from_image
+)
+from invoice_model import Invoice
+from invoice_store import InvoiceStore
+from upload_stream import SNIFF_BYTES, sniff_mime_type
+
+CHECKPOINT_FILE = os.path.join('uploads', 'backfill_checkpoint.jsonl')
+
+
+def stale_sections(record, only=None):
+    """Sections of a stored record extracted under an older version, in prompt order."""
+    scope = HEADER_SECTIONS if record.get('mode', 'full') == 'header' else ALL_SECTIONS
+    versions = record.get('section_versions') or {}
+    return [
+        section for section in scope
+        if (only is None or section in only) and versions.get(section) != SECTION_VERSIONS[section]
+    ]
+
+
+class PermanentFailure(Exception):
+    """Retrying the invoice cannot help; it is checkpointed as failed."""
+
+
+def target_key(sha256, only=None):
+    """Checkpoint key of bringing an image's sections (or only these) up to their current versions."""
+    versions = ','.join(f'{section}={SECTION_VERSIONS[section]}' for section in ALL_SECTIONS
+                        if only is None or section in only)
+    return f"{sha256}:{hashlib.sha256(versions.encode('utf-8')).hexdigest()[:8]}"
+
+
+def find_stale(store, only=None):
+    """(offset, record, stale sections) for the latest record of each image that needs a backfill."""
+    latest = {}
+    for offset, _, record in store.read_from(0):
+        if record.get('sha256'):
+            latest[record['sha256']] = (offset, record)
+    stale = []
+    for offset, record in latest.values():
+        sections = stale_sections(record, only)
+        if sections:
+            stale.append((offset, record, sections))
+    return stale
+
+
+class Checkpoint:
+    """Append-only record of the backfill targets already finished or given up on."""
+
+    def __init__(self, path):
+        self.path = path
+        self.status = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn write from a crash; the invoice gets retried
+                    self.status[entry['key']] = entry['status']
+
+    def get(self, key):
+        with self.lock:
+            return self.status.get(key)
+
+    def record(self, key, status, **details):
+        entry = {'timestamp': datetime.now().isoformat(), 'key': key, 'status': status}
+        entry.update(details)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.status[key] = status
+
+
+class Backfill:
+    def __init__(self, store, checkpoint, concurrency=4, retry_failed=False, only=None):
+        self.store = store
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.retry_failed = retry_failed
+        self.only = only
+        self.stop_event = threading.Event()
+        self.counts = Counter()
+        self.counts_lock = threading.Lock()
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def run(self, targets):
+        # At most `concurrency` extractions queued or running at a time
+        slots = threading.BoundedSemaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for offset, record, sections in targets:
+                key = target_key(record['sha256'], self.only)
+                status = self.checkpoint.get(key)
+                if status == 'done' or (status == 'failed' and not self.retry_failed):
+                    self._count('skipped')
+                    continue
+                slots.acquire()
+                retry_after = USAGE.check()
+                if self.stop_event.is_set() or retry_after is not None:
+                    slots.release()
+                    if retry_after is not None:
+                        print(f"Daily token budget exhausted; run again in {retry_after} seconds to resume")
+                    break
+                future = executor.submit(self.process, key, offset, record, sections)
+                future.add_done_callback(lambda _: slots.release())
+        return dict(self.counts)
+
+    def _count(self, outcome):
+        with self.counts_lock:
+            self.counts[outcome] += 1
+
+    def process(self, key, offset, record, sections):
+        sha256 = record['sha256']
+        name = record.get('filename') or sha256[:12]
+        try:
+            path = self.store.source_path(sha256)
+            if path is None:
+                raise PermanentFailure('source image not kept')
+
+            with open(path, 'rb') as f:
+                sniffed = sniff_mime_type(f.read(SNIFF_BYTES))
+            if sniffed is None:
+                raise PermanentFailure('Invalid file type. Please upload an image file.')
+
+            usage_accounting.set_endpoint('backfill')
+            meta = {}
+            result, error_message = extract_fields_from_image(path, sniffed[0], meta=meta, sections=sections)
+            if error_message:
+                raise RuntimeError(error_message)
+
+            data = dict(record.get('data') or {})
+            versions = dict(record.get('section_versions') or {})
+            complete = not meta.get('validation_issues')
+            replaced = []
+            for section in sections:
+                # A section missing from one response never deletes stored data,
+                # and stored data is only replaced by a result that validates
+                if result.get(section) is None or not (complete or data.get(section) is None):
+                    continue
+                data[section] = result[section]
+                versions[section] = SECTION_VERSIONS[section]
+                replaced.append(section)
+
+            new_offset = None
+            if replaced:
+                new_offset = self.store.append(
+                    Invoice.from_dict(data), sha256, source='backfill', filename=record.get('filename'),
+                    mode=record.get('mode', 'full'), model=meta.get('model'), tokens=meta.get('tokens'),
+                    section_versions=versions, supersedes=offset
+                )
+            if not complete:
+                issues = ', '.join(meta['validation_issues'])
+                raise PermanentFailure(f"incomplete result ({issues}); kept the stored "
+                                       f"{', '.join(s for s in sections if s not in replaced) or 'sections'}")
+            self.checkpoint.record(key, 'done', sha256=sha256, sections=sections, offset=new_offset)
+            self._count('done')
+            print(f"{name}: re-extracted {', '.join(replaced) or 'nothing new'}")
+        except PermanentFailure as e:
+            self.checkpoint.record(key, 'failed', sha256=sha256, sections=sections, error=str(e))
+            self._count('failed')
+            print(f"{name}: failed - {e}")
+        except Exception as e:
+            # Model errors and budget refusals are left for the next run
+            self._count('retry')
+            if USAGE.check() is not None:
+                self.stop()
+            print(f"{name}: will retry on the next run - {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-extract stored invoices whose sections are out of date.')
+    parser.add_argument('--sections', help=f"Comma-separated sections to consider (default: all of {', '.join(ALL_SECTIONS)})")
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('BACKFILL_CONCURRENCY', 4)),
+                        help='Maximum concurrent extractions')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE, help='Checkpoint file used to resume')
+    parser.add_argument('--limit', type=int, help='Backfill at most this many invoices')
+    parser.add_argument('--retry-failed', action='store_true', help='Retry invoices that failed in an earlier run')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be re-extracted')
+    args = parser.parse_args()
+
+    only = None
+    if args.sections:
+        only = {section.strip() for section in args.sections.split(',') if section.strip()}
+        unknown = only - set(ALL_SECTIONS)
+        if unknown:
+            parser.error(f"Unknown sections: {', '.join(sorted(unknown))}")
+
+    store = InvoiceStore()
+    targets = find_stale(store, only)
+    if args.limit is not None:
+        targets = targets[:args.limit]
+    by_section = Counter(section for _, _, sections in targets for section in sections)
+    print(f"{len(targets)} invoices to backfill: " +
+          (', '.join(f'{section} {count}' for section, count in by_section.most_common()) or 'none'))
+    if args.dry_run or not targets:
+        return
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.checkpoint)), exist_ok=True)
+    backfill = Backfill(store, Checkpoint(args.checkpoint), concurrency=args.concurrency,
+                        retry_failed=args.retry_failed, only=only)
+    signal.signal(signal.SIGINT, backfill.stop)
+    signal.signal(signal.SIGTERM, backfill.stop)
+    counts = backfill.run(targets)
+    print(', '.join(f'{outcome}: {count}' for outcome, count in sorted(counts.items())) or 'Nothing done')
+
+
+if __name__ == '__main__':
+    main()
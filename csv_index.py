@@ -0,0 +1,232 @@
+"""Sidecar index for the desktop app's append-only invoice CSV.
+
+The index lives next to the CSV (``extracted_invoices.csv.idx``) as JSON Lines:
+one header record followed by one record per data row holding its byte span
+and its (GSTIN, invoice number) key. Appending a row appends one index line,
+so counting, duplicate checks and appends never re-read the CSV, and a single
+row can be read back by seeking straight to its offset. If the index is
+missing or does not match the CSV size it is rebuilt with one scan.
+"""
+import ast
+import csv
+import io
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# Column names that hold the supplier GSTIN / invoice number in the CSV
+# layouts the app has written over time (legacy flat, flattened, nested).
+GSTIN_COLUMNS = ('GSTIN', 'company_info_gstin', 'gstin')
+INVOICE_NUMBER_COLUMNS = ('GST invoice Number', 'invoice_info_gst_invoice_number', 'gst_invoice_number')
+
+
+def _first_value(row, columns):
+    for column in columns:
+        value = row.get(column)
+        if value not in (None, ''):
+            return str(value)
+    return ''
+
+
+def invoice_key(data: Dict) -> Optional[Tuple[str, str]]:
+    """Return the (GSTIN, invoice number) identity of an invoice, if known."""
+    company_info = data.get('company_info') or {}
+    invoice_info = data.get('invoice_info') or {}
+
+    # Nested sections read back from the CSV are Python reprs of dicts
+    if isinstance(company_info, str):
+        company_info = _literal_dict(company_info)
+    if isinstance(invoice_info, str):
+        invoice_info = _literal_dict(invoice_info)
+
+    gstin = _first_value(company_info, GSTIN_COLUMNS) or _first_value(data, GSTIN_COLUMNS)
+    number = _first_value(invoice_info, INVOICE_NUMBER_COLUMNS) or _first_value(data, INVOICE_NUMBER_COLUMNS)
+    if not gstin or not number:
+        return None
+    return gstin.strip().upper(), number.strip().upper()
+
+
+def _literal_dict(text):
+    try:
+        value = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return {}
+    return value if isinstance(value, dict) else {}
+
+
+def iter_csv_records(f):
+    """Yield (start, end, raw_bytes) for each CSV record of a binary file.
+
+    A newline ends a record only when the quotes seen so far are balanced,
+    which keeps multi-line quoted addresses in one record.
+    """
+    start = f.tell()
+    buffer = b''
+    for line in f:
+        buffer += line
+        if buffer.count(b'"') % 2 == 0:
+            end = start + len(buffer)
+            yield start, end, buffer
+            start, buffer = end, b''
+    if buffer:
+        yield start, start + len(buffer), buffer
+
+
+class IndexedCsvStore:
+    def __init__(self, csv_path: str):
+        self.csv_path = csv_path
+        self.index_path = csv_path + '.idx'
+        self.lock = threading.Lock()
+        self.header = []
+        self.spans = []  # (start, end) byte offsets of each data row
+        self.keys = {}  # (gstin, invoice number) -> row number
+        self.size = 0
+        if not self._load_index():
+            self.rebuild()
+
+    @property
+    def count(self) -> int:
+        return len(self.spans)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                meta = json.loads(f.readline())
+                header, size = meta['header'], meta['end']
+                spans, keys = [], {}
+                for line in f:
+                    entry = json.loads(line)
+                    if entry['o'] != size:
+                        return False
+                    if entry['k']:
+                        keys.setdefault(tuple(entry['k']), len(spans))
+                    spans.append((entry['o'], entry['e']))
+                    size = entry['e']
+        except (ValueError, KeyError):
+            return False
+
+        actual_size = os.path.getsize(self.csv_path) if os.path.exists(self.csv_path) else 0
+        if size != actual_size:
+            return False
+
+        self.header, self.spans, self.keys, self.size = header, spans, keys, size
+        return True
+
+    def rebuild(self):
+        """Scan the CSV once and rewrite the sidecar index."""
+        with self.lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        self.header, self.spans, self.keys, self.size = [], [], {}, 0
+        lines = []
+        if os.path.exists(self.csv_path):
+            with open(self.csv_path, 'rb') as f:
+                for start, end, raw in iter_csv_records(f):
+                    fields = next(csv.reader(io.StringIO(raw.decode('utf-8'), newline='')), [])
+                    if start == 0:
+                        self.header = fields
+                        self.size = end
+                        continue
+                    key = invoice_key(dict(zip(self.header, fields)))
+                    lines.append(self._index_line(start, end, key))
+                    self._remember(start, end, key)
+
+        header_end = self.spans[0][0] if self.spans else self.size
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'header': self.header, 'end': header_end}) + '\n')
+            f.writelines(lines)
+        os.replace(temp_path, self.index_path)
+
+    def _header_bytes(self):
+        if not self.header:
+            return b''
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(self.header)
+        return buffer.getvalue().encode('utf-8')
+
+    @staticmethod
+    def _index_line(start, end, key):
+        return json.dumps({'o': start, 'e': end, 'k': list(key) if key else None}) + '\n'
+
+    def _remember(self, start, end, key):
+        if key:
+            self.keys.setdefault(key, len(self.spans))
+        self.spans.append((start, end))
+        self.size = end
+
+    def find(self, key: Optional[Tuple[str, str]]) -> Optional[int]:
+        """Return the row number already holding this invoice key, or None."""
+        if key is None:
+            return None
+        return self.keys.get(key)
+
+    def is_duplicate(self, data: Dict) -> bool:
+        return self.find(invoice_key(data)) is not None
+
+    def append(self, data: Dict) -> int:
+        """Append one invoice and return its row number."""
+        return self.append_rows([data])[0]
+
+    def append_rows(self, rows: List[Dict]) -> List[int]:
+        """Append invoices in one write and return their row numbers."""
+        if not rows:
+            return []
+
+        with self.lock:
+            # The CSV was changed behind our back (e.g. edited in Excel)
+            actual_size = os.path.getsize(self.csv_path) if os.path.exists(self.csv_path) else 0
+            if actual_size != self.size:
+                self._rebuild()
+
+            new_file = not self.header
+            if new_file:
+                # Union of all keys, in first-seen order, so differing invoices still fit
+                self.header = list(dict.fromkeys(key for row in rows for key in row))
+
+            encoded = []
+            for row in rows:
+                buffer = io.StringIO()
+                fieldnames = self.header if all(key in self.header for key in row) else list(row.keys())
+                csv.DictWriter(buffer, fieldnames=fieldnames, restval='').writerow(row)
+                encoded.append(buffer.getvalue().encode('utf-8'))
+
+            with open(self.csv_path, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                if new_file:
+                    header_bytes = self._header_bytes()
+                    f.write(header_bytes)
+                    offset += len(header_bytes)
+                index_lines = []
+                row_numbers = []
+                for row, raw in zip(rows, encoded):
+                    key = invoice_key(row)
+                    index_lines.append(self._index_line(offset, offset + len(raw), key))
+                    row_numbers.append(len(self.spans))
+                    self._remember(offset, offset + len(raw), key)
+                    offset += len(raw)
+                f.write(b''.join(encoded))
+
+            with open(self.index_path, 'a' if not new_file else 'w', encoding='utf-8') as f:
+                if new_file:
+                    f.write(json.dumps({'header': self.header, 'end': self.spans[0][0]}) + '\n')
+                f.writelines(index_lines)
+            return row_numbers
+
+    def read_row(self, row_number: int) -> Dict[str, str]:
+        """Read a single row back by seeking to its byte offset."""
+        start, end = self.spans[row_number]
+        with open(self.csv_path, 'rb') as f:
+            f.seek(start)
+            raw = f.read(end - start)
+        fields = next(csv.reader(io.StringIO(raw.decode('utf-8'), newline='')), [])
+        return dict(zip(self.header, fields))
+
+    def get(self, key: Tuple[str, str]) -> Optional[Dict[str, str]]:
+        row_number = self.find(key)
+        return None if row_number is None else self.read_row(row_number)
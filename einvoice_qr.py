@@ -0,0 +1,187 @@
+"""Local decoding of the signed GST e-invoice QR code.
+
+B2B e-invoices carry a QR code holding a JWT signed by the Invoice Registration
+Portal. Its ``data`` claim has the seller and buyer GSTINs, the document
+number, type and date, the invoice value, the item count, the main HSN code
+and the IRN. When a code with a verified signature is found those fields are
+filled deterministically, and the model is only asked for the rest. An
+unverified code is only passed to the model as a hint, since anyone can print
+a QR code.
+
+QR detection needs ``pyzbar`` (with the zbar library) or ``opencv-python``.
+Without either, find_einvoice() finds nothing and extraction works as before.
+Signatures are verified with ``cryptography`` against the portal's public key
+in ``EINVOICE_PUBLIC_KEY_FILE`` (PEM key or certificate). Without a key, codes
+are returned as ``verified: False`` unless ``EINVOICE_REQUIRE_SIGNATURE`` is
+set, in which case unverified codes are ignored.
+"""
+import base64
+import json
+import os
+import re
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+try:
+    from pyzbar import pyzbar
+except ImportError:
+    pyzbar = None
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+    x509 = None
+
+EINVOICE_QR_ENABLED = os.getenv('EINVOICE_QR_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+EINVOICE_PUBLIC_KEY_FILE = os.getenv('EINVOICE_PUBLIC_KEY_FILE')
+EINVOICE_REQUIRE_SIGNATURE = os.getenv('EINVOICE_REQUIRE_SIGNATURE', 'false').lower() in ('1', 'true', 'yes')
+
+GSTIN_PATTERN = re.compile(r'^[0-9]{2}[0-9A-Z]{10}[0-9A-Z]Z[0-9A-Z]$')
+GSTIN_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+IRN_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Fields filled from the QR code, as (section, field) of the extraction schema
+QR_FIELDS = {
+    'SellerGstin': ('company_info', 'gstin'),
+    'BuyerGstin': ('billing_info', 'billing_party_gstin'),
+    'DocNo': ('invoice_info', 'gst_invoice_number'),
+    'DocDt': ('invoice_info', 'invoice_date'),
+    'DocTyp': ('invoice_info', 'invoice_type'),
+    'Irn': ('invoice_info', 'e_invoice_irn'),
+    'TotInvVal': ('totals', 'total_invoice'),
+}
+
+_public_key = None
+
+
+def gstin_is_valid(gstin) -> bool:
+    """Check a GSTIN's format and its mod-36 check character."""
+    if not isinstance(gstin, str) or not GSTIN_PATTERN.match(gstin):
+        return False
+    total = 0
+    for position, char in enumerate(gstin[:14]):
+        product = GSTIN_CHARS.index(char) * (2 if position % 2 else 1)
+        total += product // 36 + product % 36
+    return GSTIN_CHARS[(36 - total % 36) % 36] == gstin[14]
+
+
+def _b64decode(segment):
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def decode_qr_codes(image_path: str, mime_type: str = 'image/jpeg') -> List[str]:
+    """Text of every QR code found in an image (PDFs are not scanned)."""
+    if mime_type == 'application/pdf' or (pyzbar is None and cv2 is None):
+        return []
+    try:
+        with Image.open(image_path) as image:
+            image = image.convert('L')
+            if pyzbar is not None:
+                return [
+                    symbol.data.decode('utf-8', 'replace')
+                    for symbol in pyzbar.decode(image, symbols=[pyzbar.ZBarSymbol.QRCODE])
+                ]
+            found, texts, _, _ = cv2.QRCodeDetector().detectAndDecodeMulti(np.asarray(image))
+            return [text for text in texts if text] if found else []
+    except Exception as e:
+        print(f"Error decoding QR codes in {image_path}: {e}")
+        return []
+
+
+def _load_public_key():
+    global _public_key
+    if _public_key is None and EINVOICE_PUBLIC_KEY_FILE and x509 is not None:
+        with open(EINVOICE_PUBLIC_KEY_FILE, 'rb') as f:
+            pem = f.read()
+        if b'CERTIFICATE' in pem:
+            _public_key = x509.load_pem_x509_certificate(pem).public_key()
+        else:
+            _public_key = serialization.load_pem_public_key(pem)
+    return _public_key
+
+
+def verify_signature(token: str) -> bool:
+    """True if the JWT's RS256 signature checks out against the portal key."""
+    if not EINVOICE_PUBLIC_KEY_FILE:
+        return False
+    if x509 is None:
+        print("EINVOICE_PUBLIC_KEY_FILE is set but the cryptography package is not installed")
+        return False
+    try:
+        signing_input, _, signature = token.rpartition('.')
+        _load_public_key().verify(_b64decode(signature), signing_input.encode('ascii'),
+                                  padding.PKCS1v15(), hashes.SHA256())
+        return True
+    except (InvalidSignature, ValueError, OSError):
+        return False
+
+
+def parse_einvoice_token(token: str) -> Optional[Dict]:
+    """Decode and sanity-check an e-invoice JWT; None if it is not one."""
+    parts = token.strip().split('.')
+    if len(parts) != 3:
+        return None
+    try:
+        header = json.loads(_b64decode(parts[0]))
+        claims = json.loads(_b64decode(parts[1]))
+        data = claims.get('data')
+        data = json.loads(data) if isinstance(data, str) else data
+    except (ValueError, AttributeError):
+        return None
+    # The portal signs with RS256; a token without it (or with "none") is forged
+    if not isinstance(data, dict) or header.get('alg') != 'RS256':
+        return None
+
+    irn = str(data.get('Irn', '')).lower()
+    if not IRN_PATTERN.match(irn) or not gstin_is_valid(data.get('SellerGstin')) or not data.get('DocNo'):
+        return None
+    buyer_gstin = data.get('BuyerGstin')
+    if buyer_gstin not in (None, '', 'URP') and not gstin_is_valid(buyer_gstin):
+        return None
+
+    data['Irn'] = irn
+    return {'fields': data, 'token': token.strip(), 'issuer': claims.get('iss')}
+
+
+def find_einvoice(image_path: str, mime_type: str = 'image/jpeg') -> Optional[Dict]:
+    """Locate and decode the signed e-invoice QR code on an invoice image.
+
+    Returns {'fields', 'token', 'issuer', 'verified'} or None.
+    """
+    if not EINVOICE_QR_ENABLED:
+        return None
+    for text in decode_qr_codes(image_path, mime_type):
+        einvoice = parse_einvoice_token(text)
+        if einvoice is None:
+            continue
+        einvoice['verified'] = verify_signature(einvoice['token'])
+        if EINVOICE_REQUIRE_SIGNATURE and not einvoice['verified']:
+            print(f"Ignoring e-invoice QR with unverified signature (IRN {einvoice['fields']['Irn']})")
+            continue
+        return einvoice
+    return None
+
+
+def to_invoice_fields(einvoice: Dict) -> Dict[str, Dict]:
+    """The QR fields as a partial extraction result, section by section.
+
+    Only a verified code's fields may be trusted as extraction results.
+    """
+    sections = {}
+    for qr_field, (section, field) in QR_FIELDS.items():
+        value = einvoice['fields'].get(qr_field)
+        if value in (None, '', 'URP'):
+            continue
+        sections.setdefault(section, {})[field] = value
+    sections.setdefault('invoice_info', {})['qr_code'] = einvoice['token']
+    return sections
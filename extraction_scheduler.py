@@ -0,0 +1,233 @@
+"""Priority-aware scheduler in front of the model calls.
+
+Extraction jobs are queued per priority class and run on a fixed pool of
+worker threads. Classes share the workers by smooth weighted round-robin, so
+interactive uploads get most turns while bulk work still progresses. A bulk job
+that has waited longer than ``bulk_max_wait`` is served next regardless of
+weights, at most once per ``bulk_max_wait`` so a standing bulk backlog cannot
+take every turn, and bulk jobs may occupy at most ``bulk_max_inflight`` workers so a
+free worker is always left for an operator at the UI.
+
+Admission control sits in front of the queues: each class has a bounded queue
+and a maximum acceptable queue wait. try_admit() estimates the wait a new job
+would see from the queue ahead of it and a moving average of recent job
+latency, and refuses work whose estimate exceeds the budget, together with the
+number of seconds after which a retry is expected to fit.
+"""
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import request_profiler
+import tracing
+
+PRIORITY_CLASSES = ('interactive', 'bulk')
+
+
+class QueueFull(Exception):
+    """The priority class's queue is at its bound."""
+
+
+class _Job:
+    __slots__ = ('fn', 'args', 'kwargs', 'future', 'priority', 'enqueued_at', 'context')
+
+    def __init__(self, fn, args, kwargs, priority):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        # Run in the submitter's context so request-scoped state (the trace)
+        # follows the job onto the worker thread
+        self.context = contextvars.copy_context()
+
+
+class ExtractionScheduler:
+    def __init__(self, workers=4, weights=None, bulk_max_wait=30.0, bulk_max_inflight=None,
+                 max_queue=None, max_queue_wait=None, initial_latency=10.0, latency_alpha=0.2):
+        self.workers = workers
+        self.weights = weights or {'interactive': 4, 'bulk': 1}
+        self.bulk_max_wait = bulk_max_wait
+        self.max_inflight = {
+            'interactive': workers,
+            'bulk': bulk_max_inflight if bulk_max_inflight is not None else max(1, workers - 1)
+        }
+
+        self.queues = {priority: deque() for priority in PRIORITY_CLASSES}
+        self.current_weight = {priority: 0 for priority in PRIORITY_CLASSES}
+        # When a bulk job last jumped the weights; the aging clock restarts there
+        self.bulk_promoted_at = float('-inf')
+        self.inflight = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.completed = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.waits = {priority: deque(maxlen=1000) for priority in PRIORITY_CLASSES}
+        self.condition = threading.Condition()
+
+        # Admission control
+        self.max_queue = max_queue or {'interactive': 100, 'bulk': 1000}
+        self.max_queue_wait = max_queue_wait or {'interactive': 30.0, 'bulk': 600.0}
+        self.latency_alpha = latency_alpha
+        self.latency_estimate = initial_latency
+        self.latency_samples = 0
+        self.shed = {priority: {'queue_full': 0, 'wait_budget': 0} for priority in PRIORITY_CLASSES}
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name=f'extraction-worker-{i}')
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, fn, *args, priority='interactive', **kwargs):
+        """Queue fn(*args, **kwargs) in a priority class and return a Future."""
+        if priority not in self.queues:
+            raise ValueError(f"Unknown priority class: {priority}")
+        job = _Job(fn, args, kwargs, priority)
+        with self.condition:
+            if len(self.queues[priority]) >= self.max_queue[priority]:
+                self.shed[priority]['queue_full'] += 1
+                raise QueueFull(priority)
+            self.queues[priority].append(job)
+            self.condition.notify()
+        return job.future
+
+    def _estimate_wait(self, priority, jobs=1):
+        """Seconds the last of `jobs` new jobs in this class would wait to start."""
+        capacity = self.max_inflight[priority]
+        ahead = len(self.queues[priority]) + jobs - 1
+
+        # Weighted round-robin lets the other class take turns in between
+        for other in PRIORITY_CLASSES:
+            if other != priority and self.queues[other]:
+                turns = math.ceil((ahead + 1) * self.weights[other] / self.weights[priority])
+                ahead += min(len(self.queues[other]), turns)
+
+        wait = ahead / capacity * self.latency_estimate
+        busy = sum(self.inflight.values())
+        if busy >= self.workers or self.inflight[priority] >= capacity:
+            # On average a running job is half done when we arrive
+            wait += self.latency_estimate / 2
+        return wait
+
+    def estimate_wait(self, priority, jobs=1):
+        with self.condition:
+            return self._estimate_wait(priority, jobs)
+
+    def try_admit(self, priority, jobs=1):
+        """Decide whether to accept work now.
+
+        Returns (admitted, estimated_wait, retry_after) where retry_after is the
+        number of seconds until the estimated wait fits the class's budget.
+        """
+        with self.condition:
+            estimated_wait = self._estimate_wait(priority, jobs)
+            budget = self.max_queue_wait[priority]
+            if len(self.queues[priority]) + jobs > self.max_queue[priority]:
+                self.shed[priority]['queue_full'] += 1
+                # Time for the queue to drain enough to make room
+                excess = len(self.queues[priority]) + jobs - self.max_queue[priority]
+                retry_after = excess / self.max_inflight[priority] * self.latency_estimate
+                return False, estimated_wait, max(1, math.ceil(max(retry_after, estimated_wait - budget)))
+            if estimated_wait > budget:
+                self.shed[priority]['wait_budget'] += 1
+                # The queue drains at the rate the estimate was built from, so
+                # the wait falls below budget after the excess has elapsed
+                return False, estimated_wait, max(1, math.ceil(estimated_wait - budget))
+        return True, estimated_wait, 0
+
+    def _record_latency(self, seconds):
+        if self.latency_samples == 0:
+            self.latency_estimate = seconds
+        else:
+            self.latency_estimate += self.latency_alpha * (seconds - self.latency_estimate)
+        self.latency_samples += 1
+
+    def _eligible(self):
+        return [
+            priority for priority in PRIORITY_CLASSES
+            if self.queues[priority] and self.inflight[priority] < self.max_inflight[priority]
+        ]
+
+    def _pick(self, eligible):
+        # Starvation protection: an old enough bulk job jumps the weights, but
+        # a backlog of old jobs only gets one such promotion per bulk_max_wait
+        if 'bulk' in eligible:
+            now = time.monotonic()
+            waited = now - max(self.queues['bulk'][0].enqueued_at, self.bulk_promoted_at)
+            if waited >= self.bulk_max_wait:
+                self.bulk_promoted_at = now
+                return 'bulk'
+
+        # Smooth weighted round-robin over the classes that have work
+        total = 0
+        best = None
+        for priority in eligible:
+            self.current_weight[priority] += self.weights[priority]
+            total += self.weights[priority]
+            if best is None or self.current_weight[priority] > self.current_weight[best]:
+                best = priority
+        self.current_weight[best] -= total
+        return best
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                eligible = self._eligible()
+                while not eligible:
+                    self.condition.wait()
+                    eligible = self._eligible()
+                priority = self._pick(eligible)
+                job = self.queues[priority].popleft()
+                self.inflight[priority] += 1
+                wait = time.monotonic() - job.enqueued_at
+                self.waits[priority].append(wait)
+
+            started = time.monotonic()
+            if job.future.set_running_or_notify_cancel():
+                try:
+                    job.future.set_result(job.context.run(self._run_job, job, wait))
+                except BaseException as e:
+                    job.future.set_exception(e)
+
+            with self.condition:
+                self._record_latency(time.monotonic() - started)
+                self.inflight[priority] -= 1
+                self.completed[priority] += 1
+                # A class that was capped may be runnable again
+                self.condition.notify_all()
+
+    @staticmethod
+    def _run_job(job, wait):
+        tracing.add_span('queue', wait, priority=job.priority)
+        # A profiled request's jobs are profiled along with it
+        profile = request_profiler.current_profile()
+        if profile is None:
+            return job.fn(*job.args, **job.kwargs)
+        with profile.thread():
+            return job.fn(*job.args, **job.kwargs)
+
+    def get_stats(self):
+        """Queue depth, in-flight jobs and queue wait time per priority class."""
+        report = {'workers': self.workers, 'weights': dict(self.weights), 'classes': {}}
+        with self.condition:
+            report['latency_estimate_ms'] = round(1000 * self.latency_estimate, 1)
+            for priority in PRIORITY_CLASSES:
+                waits = sorted(self.waits[priority])
+                report['classes'][priority] = {
+                    'queued': len(self.queues[priority]),
+                    'max_queue': self.max_queue[priority],
+                    'max_queue_wait_s': self.max_queue_wait[priority],
+                    'estimated_wait_ms': round(1000 * self._estimate_wait(priority), 1),
+                    'shed': dict(self.shed[priority]),
+                    'inflight': self.inflight[priority],
+                    'max_inflight': self.max_inflight[priority],
+                    'completed': self.completed[priority],
+                    'queue_wait_ms': {
+                        'mean': round(1000 * sum(waits) / len(waits), 1),
+                        'p50': round(1000 * waits[len(waits) // 2], 1),
+                        'p95': round(1000 * waits[min(len(waits) - 1, int(0.95 * len(waits)))], 1),
+                        'max': round(1000 * waits[-1], 1)
+                    } if waits else None
+                }
+        return report
@@ -0,0 +1,199 @@
+"""Standalone extraction worker for the durable work queue.
+
+Leases jobs enqueued by the API (EXTRACTION_BACKEND=queue). It runs
+extract_fields_from_image on each one, appends the result to the extraction
+store, fires the configured webhooks and stores the result on the job, where
+the API's /api/jobs/<id> endpoint picks it up. Run as many worker processes as
+the model quota allows, each with its own --concurrency. Leases are extended
+while a job runs; a worker that dies just lets its leases run out, and its jobs
+are retried elsewhere.
+
+Usage:
+    python extraction_worker.py --concurrency 4
+"""
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+
+import tracing
+import usage_accounting
+from invoice_extractor_server import USAGE, extract_fields_from_image
+from invoice_model import Invoice
+from invoice_store import InvoiceStore
+from webhooks import DELIVERY_POOL, dispatch_webhooks
+from work_queue import VISIBILITY_TIMEOUT, WORK_QUEUE_URL, open_queue, purge_files
+
+# Finished jobs and their spooled uploads are kept this long for status queries
+RETENTION_SECONDS = float(os.environ.get('WORK_QUEUE_RETENTION_HOURS', 24)) * 3600
+PURGE_INTERVAL = 600
+
+
+class JobFailed(Exception):
+    """An extraction attempt failed; retry=False when repeating it cannot help."""
+
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+
+class ExtractionWorker:
+    def __init__(self, queue, worker_id, store, concurrency=4, visibility_timeout=VISIBILITY_TIMEOUT,
+                 poll_interval=1.0, send_webhooks=True):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.store = store
+        self.concurrency = concurrency
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.send_webhooks = send_webhooks
+        self.stop_event = threading.Event()
+        self.active = {}  # job id -> leased job
+        self.active_lock = threading.Lock()
+
+    def run(self):
+        threads = [
+            threading.Thread(target=self._loop, name=f'extraction-job-{i}')
+            for i in range(self.concurrency)
+        ]
+        threads.append(threading.Thread(target=self._keep_leases, name='lease-heartbeat', daemon=True))
+        for thread in threads:
+            thread.start()
+        last_purge = 0.0
+        while not self.stop_event.wait(5):
+            if time.monotonic() - last_purge >= PURGE_INTERVAL:
+                last_purge = time.monotonic()
+                self._purge()
+        print("Stopping; finishing in-flight jobs...")
+        for thread in threads[:-1]:
+            thread.join()
+        DELIVERY_POOL.shutdown(wait=True)
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            # Leave jobs queued while the daily token budget is exhausted
+            retry_after = USAGE.check()
+            if retry_after is not None:
+                self.stop_event.wait(min(retry_after, 60))
+                continue
+            try:
+                job = self.queue.lease(self.worker_id, self.visibility_timeout)
+            except Exception as e:
+                print(f"Error leasing a job: {e}")
+                job = None
+            if job is None:
+                self.stop_event.wait(self.poll_interval)
+                continue
+            self.process(job)
+
+    def _keep_leases(self):
+        while not self.stop_event.wait(self.visibility_timeout / 3):
+            with self.active_lock:
+                jobs = list(self.active.values())
+            for job in jobs:
+                try:
+                    if not self.queue.extend(job, self.visibility_timeout):
+                        print(f"Job {job.id}: lease lost; another worker may run it too")
+                except Exception as e:
+                    print(f"Job {job.id}: error extending lease - {e}")
+
+    def _purge(self):
+        try:
+            jobs = self.queue.purge(RETENTION_SECONDS)
+            files = purge_files(self.queue, RETENTION_SECONDS)
+            if jobs or files:
+                print(f"Purged {jobs} finished jobs and {files} spooled uploads")
+        except Exception as e:
+            print(f"Error purging finished jobs: {e}")
+
+    def process(self, job):
+        name = job.payload.get('filename') or job.id
+        with self.active_lock:
+            self.active[job.id] = job
+        try:
+            result = self.run_job(job)
+            if not self.queue.complete(job, result):
+                print(f"{name}: finished, but another worker holds the job now")
+            else:
+                print(f"{name}: extracted (job {job.id}, attempt {job.attempts})")
+        except Exception as e:
+            retry = e.retry if isinstance(e, JobFailed) else True
+            status = self.queue.fail(job, str(e), retry=retry)
+            print(f"{name}: failed on attempt {job.attempts}/{job.max_attempts} - {e} ({status})")
+        finally:
+            with self.active_lock:
+                self.active.pop(job.id, None)
+
+    def run_job(self, job):
+        payload = job.payload
+        trace = tracing.start_trace(
+            'extraction_job',
+            traceparent=payload.get('traceparent'),
+            job_id=job.id,
+            attempt=job.attempts,
+            worker=self.worker_id
+        )
+        usage_accounting.set_endpoint(payload.get('endpoint') or 'queue')
+        try:
+            if not os.path.exists(payload['path']):
+                raise JobFailed(f"Upload {payload['path']} is missing", retry=False)
+            meta = {}
+            mode = payload.get('mode', 'full')
+            data, error_message = extract_fields_from_image(
+                payload['path'], payload['mime_type'], meta=meta,
+                header_only=mode == 'header', einvoice=payload.get('einvoice')
+            )
+            if error_message:
+                raise JobFailed(error_message)
+            if not data:
+                raise JobFailed('No data could be extracted from the invoice', retry=False)
+
+            invoice = Invoice.from_dict(data)
+            self.store.retain_source(payload['path'], payload.get('sha256'),
+                                     os.path.splitext(payload['path'])[1].lstrip('.'))
+            self.store.append(invoice, payload.get('sha256'), source=payload.get('source', 'queue'),
+                              filename=payload.get('filename'), mode=mode, model=meta.get('model'),
+                              tokens=meta.get('tokens'), section_versions=meta.get('section_versions'))
+            if self.send_webhooks:
+                dispatch_webhooks(invoice)
+            return {'data': invoice.to_dict(), 'digest': invoice.digest, 'model': meta.get('model'),
+                    'tokens': meta.get('tokens')}
+        finally:
+            tracing.end_trace(trace)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process queued invoice extractions.')
+    parser.add_argument('--queue', default=WORK_QUEUE_URL, help='Work queue URL')
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('EXTRACTION_WORKERS', 4)),
+                        help='Jobs processed at the same time')
+    parser.add_argument('--worker-id', default=f'{socket.gethostname()}:{os.getpid()}',
+                        help='Name recorded on leased jobs')
+    parser.add_argument('--visibility-timeout', type=float, default=VISIBILITY_TIMEOUT,
+                        help='Seconds a lease lasts without being extended')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between polls of an empty queue')
+    parser.add_argument('--no-webhooks', action='store_true', help='Do not fire configured webhooks')
+    args = parser.parse_args()
+
+    worker = ExtractionWorker(
+        open_queue(args.queue),
+        args.worker_id,
+        InvoiceStore(),
+        concurrency=args.concurrency,
+        visibility_timeout=args.visibility_timeout,
+        poll_interval=args.poll_interval,
+        send_webhooks=not args.no_webhooks
+    )
+    print(f"Worker {args.worker_id} processing jobs from {args.queue} ({args.concurrency} at a time)")
+    signal.signal(signal.SIGINT, worker.stop)
+    signal.signal(signal.SIGTERM, worker.stop)
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()
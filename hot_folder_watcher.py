@@ -0,0 +1,330 @@
+"""Headless hot-folder watcher for unattended invoice ingestion.
+
+Watches a directory for new invoice scans, waits until each file has finished
+writing, extracts it with bounded concurrency, writes the result to a CSV or
+JSON Lines output and to the extraction store (so it appears in search and
+analytics and can be backfilled), fires the configured webhooks and moves the
+file into a done or failed folder. A JSON Lines ledger keyed by content hash
+survives restarts, so a file is never extracted twice once it is done, and a
+file whose extraction was interrupted is picked up again.
+
+Usage:
+    python hot_folder_watcher.py /srv/mailroom/inbox --format csv --workers 4
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shutil
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from invoice_extractor_server import extract_fields_from_image, flatten_invoice_data
+from invoice_model import Invoice
+from invoice_store import InvoiceStore
+from upload_stream import SNIFF_BYTES, sniff_mime_type
+import usage_accounting
+from webhooks import dispatch_webhooks
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+
+def file_sha256(path):
+    """Hash a file in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Ledger:
+    """Append-only record of every file the watcher has handled."""
+
+    def __init__(self, path):
+        self.path = path
+        self.status = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn write from a crash; the file gets retried
+                    self.status[entry['sha256']] = entry['status']
+
+    def is_done(self, sha256):
+        with self.lock:
+            return self.status.get(sha256) == 'done'
+
+    def record(self, sha256, status, **details):
+        entry = {'timestamp': datetime.now().isoformat(), 'sha256': sha256, 'status': status}
+        entry.update(details)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.status[sha256] = status
+
+
+class ResultWriter:
+    """Appends extraction results to a CSV file or a JSON Lines file."""
+
+    def __init__(self, path, output_format):
+        self.path = path
+        self.output_format = output_format
+        self.lock = threading.Lock()
+
+    def write(self, source_file, sha256, data):
+        with self.lock:
+            if self.output_format == 'json':
+                record = {
+                    'source_file': source_file,
+                    'sha256': sha256,
+                    'extracted_at': datetime.now().isoformat(),
+                    'data': data.to_dict()
+                }
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            else:
+                row = {'source_file': source_file, 'sha256': sha256}
+                row.update(flatten_invoice_data(data))
+                self._append_csv_row(row)
+
+    def _append_csv_row(self, row):
+        header = []
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'r', newline='', encoding='utf-8') as f:
+                header = next(csv.reader(f), [])
+
+        if header and all(key in header for key in row):
+            with open(self.path, 'a', newline='', encoding='utf-8') as f:
+                csv.DictWriter(f, fieldnames=header, restval='').writerow(row)
+            return
+
+        # New columns (e.g. more line items than before): rewrite with a wider header
+        rows = []
+        if header:
+            with open(self.path, 'r', newline='', encoding='utf-8') as f:
+                rows = list(csv.DictReader(f))
+        fieldnames = header + [key for key in row if key not in header]
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, restval='')
+            writer.writeheader()
+            writer.writerows(rows)
+            writer.writerow(row)
+        os.replace(temp_path, self.path)
+
+
+class HotFolderWatcher:
+    def __init__(self, inbox, done_dir, failed_dir, ledger, writer, store,
+                 workers=4, settle_seconds=2.0, poll_interval=2.0, send_webhooks=True):
+        self.inbox = inbox
+        self.done_dir = done_dir
+        self.failed_dir = failed_dir
+        self.ledger = ledger
+        self.writer = writer
+        self.store = store
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.send_webhooks = send_webhooks
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.stop_event = threading.Event()
+
+        # path -> (size, mtime_ns, time that signature was first seen)
+        self.pending = {}
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+
+        # Outputs may live inside the inbox; never treat them as invoices.
+        # Scanned paths are absolute, so these must be too.
+        self.own_files = {os.path.abspath(path) for path in (writer.path, writer.path + '.tmp', ledger.path)}
+
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.inotify.add_watch(inbox, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+            except OSError as e:
+                print(f"inotify unavailable ({e}), falling back to polling")
+                self.inotify = None
+
+        for directory in (done_dir, failed_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    def run(self):
+        mode = 'inotify' if self.inotify else 'polling'
+        print(f"Watching {self.inbox} ({mode}); done -> {self.done_dir}, failed -> {self.failed_dir}")
+        while not self.stop_event.is_set():
+            self.scan()
+            self.wait_for_changes()
+        print("Stopping; waiting for in-flight extractions...")
+        self.executor.shutdown(wait=True)
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def wait_for_changes(self):
+        # inotify only shortens the wait; every tick still rescans the folder,
+        # so events lost during a restart or an overflow never skip a file.
+        timeout = 0.5 if self.pending else self.poll_interval
+        if self.inotify:
+            self.inotify.read(timeout=int(timeout * 1000))
+        else:
+            self.stop_event.wait(timeout)
+
+    def scan(self):
+        now = time.monotonic()
+        seen = set()
+        for entry in os.scandir(self.inbox):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            path = entry.path
+            if os.path.abspath(path) in self.own_files:
+                continue
+            seen.add(path)
+            with self.in_flight_lock:
+                if path in self.in_flight:
+                    continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = self.pending.get(path)
+            if previous is None or previous[:2] != signature:
+                self.pending[path] = signature + (now,)
+                continue
+
+            # Unchanged for the settle period: the writer has finished
+            if stat.st_size > 0 and now - previous[2] >= self.settle_seconds:
+                del self.pending[path]
+                with self.in_flight_lock:
+                    self.in_flight.add(path)
+                self.executor.submit(self.process, path)
+
+        for path in list(self.pending):
+            if path not in seen:
+                del self.pending[path]
+
+    def process(self, path):
+        name = os.path.basename(path)
+        sha256 = None
+        try:
+            sha256 = file_sha256(path)
+            if self.ledger.is_done(sha256):
+                print(f"{name}: already extracted, moving to done")
+                self.move(path, self.done_dir)
+                return
+
+            self.ledger.record(sha256, 'started', file=name)
+
+            with open(path, 'rb') as f:
+                sniffed = sniff_mime_type(f.read(SNIFF_BYTES))
+            if sniffed is None:
+                raise ValueError('Invalid file type. Please upload an image file.')
+
+            usage_accounting.set_endpoint('hot_folder')
+            meta = {}
+            data, error_message = extract_fields_from_image(path, sniffed[0], meta=meta)
+            if error_message:
+                raise RuntimeError(error_message)
+            if not data:
+                raise RuntimeError('No data could be extracted from the invoice')
+
+            invoice = Invoice.from_dict(data)
+            self.store.retain_source(path, sha256, sniffed[1])
+            self.store.append(invoice, sha256, source='hot_folder', filename=name, mode='full',
+                              model=meta.get('model'), tokens=meta.get('tokens'),
+                              section_versions=meta.get('section_versions'))
+            self.writer.write(name, sha256, invoice)
+            if self.send_webhooks:
+                dispatch_webhooks(invoice)
+
+            # Recorded before the move, so a crash in between leaves a done
+            # file in the inbox, which the next scan moves, not a rerun
+            moved_to = self.target_path(path, self.done_dir)
+            self.ledger.record(sha256, 'done', file=name, moved_to=moved_to)
+            print(f"{name}: extracted")
+            try:
+                shutil.move(path, moved_to)
+            except OSError as move_error:
+                print(f"{name}: could not move to done folder - {move_error}")
+        except Exception as e:
+            print(f"{name}: failed - {e}")
+            try:
+                moved_to = self.move(path, self.failed_dir)
+            except OSError as move_error:
+                # Leave it in the inbox; the next scan retries it
+                print(f"{name}: could not move to failed folder - {move_error}")
+                moved_to = None
+            if sha256:
+                self.ledger.record(sha256, 'failed', file=name, error=str(e), moved_to=moved_to)
+        finally:
+            with self.in_flight_lock:
+                self.in_flight.discard(path)
+
+    def target_path(self, path, directory):
+        """Where a file moved into a folder goes, without overwriting an existing name."""
+        target = os.path.join(directory, os.path.basename(path))
+        if os.path.exists(target):
+            stem, ext = os.path.splitext(os.path.basename(path))
+            target = os.path.join(directory, f"{stem}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}{ext}")
+        return target
+
+    def move(self, path, directory):
+        """Move a file into a folder without overwriting an existing name."""
+        target = self.target_path(path, directory)
+        shutil.move(path, target)
+        return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Watch a folder and extract invoices dropped into it.')
+    parser.add_argument('inbox', help='Directory to watch')
+    parser.add_argument('--done', help='Folder for extracted files (default: INBOX/done)')
+    parser.add_argument('--failed', help='Folder for failed files (default: INBOX/failed)')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv', help='Result output format')
+    parser.add_argument('--output', help='Result file (default: INBOX/extracted_invoices.csv or .jsonl)')
+    parser.add_argument('--ledger', help='Ledger file (default: INBOX/.watcher_ledger.jsonl)')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WATCHER_WORKERS', 4)),
+                        help='Maximum concurrent extractions')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='Seconds a file must stay unchanged before it is processed')
+    parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds between folder scans')
+    parser.add_argument('--no-webhooks', action='store_true', help='Do not fire configured webhooks')
+    args = parser.parse_args()
+
+    inbox = os.path.abspath(args.inbox)
+    extension = 'jsonl' if args.format == 'json' else 'csv'
+    watcher = HotFolderWatcher(
+        inbox,
+        args.done or os.path.join(inbox, 'done'),
+        args.failed or os.path.join(inbox, 'failed'),
+        Ledger(args.ledger or os.path.join(inbox, '.watcher_ledger.jsonl')),
+        ResultWriter(args.output or os.path.join(inbox, f'extracted_invoices.{extension}'), args.format),
+        InvoiceStore(),
+        workers=args.workers,
+        settle_seconds=args.settle,
+        poll_interval=args.poll_interval,
+        send_webhooks=not args.no_webhooks
+    )
+    signal.signal(signal.SIGINT, watcher.stop)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    watcher.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+"""Columnar spend analytics over the extraction store.
+
+Invoices and line items from ``InvoiceStore`` are kept as NumPy columns in
+``uploads/analytics/``: one raw binary file per column, opened with
+``numpy.memmap``. Text keys (supplier GSTIN, HSN code) are dictionary-encoded
+to integer codes and dates to a month number, so every group-by is a single
+``numpy.bincount`` over the codes.
+
+``refresh()`` reads only the store records appended since the last refresh and
+appends them to the column files. ``meta.json`` is written last and records
+how far the store was consumed and how many rows each column holds. A crash
+mid-refresh therefore leaves extra bytes that are trimmed on the next run,
+never a half-counted record. Refreshes from several worker processes are
+serialised with a lock file.
+
+Each invoice row keeps the store offset of its record. A backfilled record
+(``supersedes``) or a new extraction of an image already counted is added as a
+new row and sets the ``replaced`` flag on the earlier row, in place; queries
+skip replaced invoices and their items. A record whose invoice digest was
+already counted (a redelivered queue job, a re-upload, the same file twice in
+a batch) is skipped, so every invoice is counted once.
+Column files shorter than meta.json expects, such as a column added by a newer
+version, make the next refresh rebuild every column from the start of the store.
+"""
+import json
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from datetime import datetime
+from typing import Dict, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+from invoice_model import to_number
+from invoice_store import InvoiceStore
+
+ANALYTICS_DIR = os.environ.get('ANALYTICS_DIR', os.path.join('uploads', 'analytics'))
+REFRESH_BATCH = 10000
+
+INVOICE_COLUMNS = {
+    'supplier': np.int32,
+    'month': np.int32,
+    'invoice_amount': np.float64,
+    'total_invoice': np.float64,
+    'cgst': np.float64,
+    'sgst': np.float64,
+    'igst': np.float64,
+    'cess_amount': np.float64,
+    'offset': np.int64,  # store offset of the record
+    'replaced': np.bool_,  # superseded by a later extraction of the image
+    'digest': np.uint64,  # leading 64 bits of the invoice digest, 0 if none
+    'image': np.uint64,  # leading 64 bits of the image sha256, 0 if none
+}
+ITEM_COLUMNS = {
+    'invoice': np.int64,
+    'supplier': np.int32,
+    'hsn': np.int32,
+    'month': np.int32,
+    'quantity': np.float64,
+    'value': np.float64,  # taxable value, or amount when that is missing
+}
+TAX_COLUMNS = ('cgst', 'sgst', 'igst', 'cess_amount')
+GROUP_BY = ('supplier', 'hsn', 'month')
+
+# Month codes count months from January 2000; 0 means the date was not understood
+BASE_YEAR = 2000
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%d/%m/%y', '%d-%m-%y',
+                '%d-%b-%Y', '%d-%b-%y', '%d %b %Y', '%d %B %Y', '%b %d, %Y', '%B %d, %Y')
+
+
+def month_code(invoice_date) -> int:
+    """Month number of an invoice date in any of the common Indian formats."""
+    if not invoice_date:
+        return 0
+    return _month_code(str(invoice_date))
+
+
+@lru_cache(maxsize=8192)
+def _month_code(invoice_date):
+    text = re.sub(r'\s+', ' ', invoice_date.strip())
+    for date_format in DATE_FORMATS:
+        try:
+            parsed = datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        if parsed.year < BASE_YEAR:
+            return 0
+        return (parsed.year - BASE_YEAR) * 12 + parsed.month
+    return 0
+
+
+def month_label(code: int) -> Optional[str]:
+    if code <= 0:
+        return None
+    year, month = divmod(code - 1, 12)
+    return f'{BASE_YEAR + year:04d}-{month + 1:02d}'
+
+
+def parse_month(text: str) -> int:
+    """Month code of a 'YYYY-MM' query parameter."""
+    match = re.fullmatch(r'(\d{4})-(\d{1,2})', text.strip())
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        raise ValueError(f"Invalid month '{text}', expected YYYY-MM")
+    return (int(match.group(1)) - BASE_YEAR) * 12 + int(match.group(2))
+
+
+def _hash_key(hexdigest) -> int:
+    """Leading 64 bits of a hex digest, as stored in the key columns."""
+    try:
+        return int(str(hexdigest)[:16], 16) if hexdigest else 0
+    except ValueError:
+        return 0
+
+
+def _key(value) -> str:
+    return re.sub(r'\s+', '', str(value)).upper() if value not in (None, '') else ''
+
+
+class InvoiceAnalytics:
+    def __init__(self, store: InvoiceStore, directory: str = ANALYTICS_DIR):
+        self.store = store
+        self.directory = directory
+        self.meta_path = os.path.join(directory, 'meta.json')
+        self.lock_path = os.path.join(directory, 'refresh.lock')
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.invoices = {}
+        self.items = {}
+        # Digests of counted invoices, and the latest row of each image
+        self.digests = set()
+        self.image_rows = {}
+        self.keyed_rows = 0
+        self._reload()
+
+    def _reload(self, trim=False):
+        self.meta = self._load_meta()
+        if self._columns_short():
+            self.meta = self._empty_meta()
+        self.supplier_codes = {gstin: code for code, gstin in enumerate(self.meta['suppliers'])}
+        self.hsn_codes = {hsn: code for code, hsn in enumerate(self.meta['hsn_codes'])}
+        if trim:
+            self._trim_columns()
+        self._map_columns()
+        self._load_keys()
+
+    def _load_keys(self):
+        """Catch the dedupe keys up with the rows committed, by us or another process."""
+        rows = self.meta['invoices']
+        if self.keyed_rows > rows:
+            # Keys of a failed refresh or a rebuilt index
+            self.digests, self.image_rows, self.keyed_rows = set(), {}, 0
+        digests = self.invoices['digest'][self.keyed_rows:rows].tolist()
+        images = self.invoices['image'][self.keyed_rows:rows].tolist()
+        for row, (digest, image) in enumerate(zip(digests, images), start=self.keyed_rows):
+            self.digests.add(digest)
+            if image:
+                self.image_rows[image] = row
+        self.keyed_rows = rows
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return self._empty_meta()
+
+    @staticmethod
+    def _empty_meta():
+        # Code 0 is reserved for "unknown" in both dictionaries
+        return {'offset': 0, 'invoices': 0, 'items': 0, 'suppliers': [''], 'supplier_names': [''],
+                'hsn_codes': ['']}
+
+    def _column_path(self, table, column):
+        return os.path.join(self.directory, f'{table}.{column}.bin')
+
+    def _columns(self):
+        for column, dtype in INVOICE_COLUMNS.items():
+            yield 'invoices', column, dtype, self.meta['invoices']
+        for column, dtype in ITEM_COLUMNS.items():
+            yield 'items', column, dtype, self.meta['items']
+
+    def _columns_short(self):
+        """True if a column file holds fewer rows than meta.json has committed."""
+        for table, column, dtype, rows in self._columns():
+            path = self._column_path(table, column)
+            if rows and (not os.path.exists(path) or os.path.getsize(path) < rows * np.dtype(dtype).itemsize):
+                return True
+        return False
+
+    def _trim_columns(self):
+        """Drop bytes a crashed refresh appended after the last committed meta."""
+        for table, column, dtype, rows in self._columns():
+            path = self._column_path(table, column)
+            expected = rows * np.dtype(dtype).itemsize
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            if os.path.getsize(path) > expected:
+                with open(path, 'r+b') as f:
+                    f.truncate(expected)
+
+    def _map_columns(self):
+        for table, column, dtype, rows in self._columns():
+            target = self.invoices if table == 'invoices' else self.items
+            # Only the committed rows are mapped, so bytes still being appended
+            # by a refresh in another process are never read
+            if rows == 0:
+                target[column] = np.zeros(0, dtype=dtype)
+            else:
+                target[column] = np.memmap(self._column_path(table, column), dtype=dtype, mode='r', shape=(rows,))
+
+    def _code(self, codes, names, key):
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(names)
+            names.append(key)
+        return code
+
+    def refresh(self) -> int:
+        """Add store records appended since the last refresh; return how many."""
+        with self.lock:
+            if self.store.size() == self.meta['offset']:
+                return 0
+            with open(self.lock_path, 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Another process may have refreshed while we waited
+                self._reload(trim=True)
+                return self._refresh()
+
+    def _refresh(self):
+        added = 0
+        invoice_rows = {column: [] for column in INVOICE_COLUMNS}
+        item_rows = {column: [] for column in ITEM_COLUMNS}
+        replaced = []
+        offset = self.meta['offset']
+        for record_offset, next_offset, record in self.store.read_from(offset):
+            digest, image = _hash_key(record.get('digest')), _hash_key(record.get('sha256'))
+            superseded = record.get('supersedes')
+            if superseded is None and digest and digest in self.digests:
+                # The same invoice delivered or uploaded again is counted once
+                offset = next_offset
+                added += 1
+                continue
+            # A backfill or a re-extraction of the same image takes the place of
+            # the row counted for it; the superseded record itself may have been
+            # skipped as a duplicate, so fall back to the image's row
+            row = self._row_of(superseded, invoice_rows) if superseded is not None else None
+            if row is None and image:
+                row = self.image_rows.get(image)
+            if row is not None:
+                self._flag_replaced(row, invoice_rows, replaced)
+            self._add_record(record_offset, record.get('data') or {}, invoice_rows, item_rows, digest, image)
+            offset = next_offset
+            added += 1
+            if added % REFRESH_BATCH == 0:
+                self._commit(offset, invoice_rows, item_rows, replaced)
+        self._commit(offset, invoice_rows, item_rows, replaced)
+        return added
+
+    def _row_of(self, record_offset, invoice_rows):
+        """Invoice row of a store record, committed or still pending; None if it has none."""
+        offsets = self.invoices['offset']
+        row = int(np.searchsorted(offsets, record_offset))
+        if row < len(offsets) and offsets[row] == record_offset:
+            return row
+        pending = invoice_rows['offset']
+        if record_offset in pending:
+            return self.meta['invoices'] + pending.index(record_offset)
+        return None
+
+    def _flag_replaced(self, row, invoice_rows, replaced):
+        if row < self.meta['invoices']:
+            replaced.append(row)
+        else:
+            invoice_rows['replaced'][row - self.meta['invoices']] = True
+
+    def _add_record(self, record_offset, data, invoice_rows, item_rows, digest=0, image=0):
+        company_info = data.get('company_info') or {}
+        invoice_info = data.get('invoice_info') or {}
+        tax_info = data.get('tax_info') or {}
+        totals = data.get('totals') or {}
+
+        gstin = _key(company_info.get('gstin'))
+        supplier = self._code(self.supplier_codes, self.meta['suppliers'], gstin)
+        if supplier == len(self.meta['supplier_names']):
+            self.meta['supplier_names'].append(company_info.get('company_name') or '')
+        month = month_code(invoice_info.get('invoice_date'))
+        invoice_index = self.meta['invoices'] + len(invoice_rows['supplier'])
+
+        invoice_rows['supplier'].append(supplier)
+        invoice_rows['month'].append(month)
+        invoice_rows['offset'].append(record_offset)
+        invoice_rows['replaced'].append(False)
+        invoice_rows['digest'].append(digest)
+        invoice_rows['image'].append(image)
+        self.digests.add(digest)
+        if image:
+            self.image_rows[image] = invoice_index
+        self.keyed_rows = invoice_index + 1
+        for column in ('invoice_amount', 'total_invoice'):
+            value = to_number(totals.get(column))
+            invoice_rows[column].append(np.nan if value is None else value)
+        for column in TAX_COLUMNS:
+            value = to_number(tax_info.get(column))
+            invoice_rows[column].append(np.nan if value is None else value)
+
+        for item in data.get('items') or []:
+            if not isinstance(item, dict):
+                continue
+            value = to_number(item.get('taxable_value'))
+            if value is None:
+                value = to_number(item.get('amount'))
+            quantity = to_number(item.get('quantity'))
+            item_rows['invoice'].append(invoice_index)
+            item_rows['supplier'].append(supplier)
+            item_rows['hsn'].append(self._code(self.hsn_codes, self.meta['hsn_codes'], _key(item.get('hsn_code'))))
+            item_rows['month'].append(month)
+            item_rows['quantity'].append(np.nan if quantity is None else quantity)
+            item_rows['value'].append(np.nan if value is None else value)
+
+    def _commit(self, offset, invoice_rows, item_rows, replaced):
+        for table, rows, columns in (('invoices', invoice_rows, INVOICE_COLUMNS), ('items', item_rows, ITEM_COLUMNS)):
+            for column, dtype in columns.items():
+                if rows[column]:
+                    with open(self._column_path(table, column), 'ab') as f:
+                        f.write(np.asarray(rows[column], dtype=dtype).tobytes())
+            self.meta[table] += len(rows['supplier'])
+            for values in rows.values():
+                values.clear()
+        # Rewriting a flag is idempotent, so a crash before meta.json is
+        # written only makes the next refresh flag the same rows again
+        if replaced:
+            with open(self._column_path('invoices', 'replaced'), 'r+b') as f:
+                for row in replaced:
+                    f.seek(row)
+                    f.write(b'\x01')
+            replaced.clear()
+        self.meta['offset'] = offset
+
+        temp_path = self.meta_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(temp_path, self.meta_path)
+        self._map_columns()
+
+    def query(self, group_by: str = 'supplier', month_from: Optional[str] = None, month_to: Optional[str] = None,
+              supplier: Optional[str] = None, limit: int = 50) -> Dict:
+        """Aggregate spend per supplier GSTIN, HSN code or month."""
+        if group_by not in GROUP_BY:
+            raise ValueError(f"Invalid group_by '{group_by}'. Use one of: {', '.join(GROUP_BY)}")
+        self.refresh()
+        started = time.perf_counter()
+
+        with self.lock:
+            invoices, items = dict(self.invoices), dict(self.items)
+            suppliers = list(self.meta['suppliers'])
+            supplier_names = list(self.meta['supplier_names'])
+            hsn_codes = list(self.meta['hsn_codes'])
+
+        low = parse_month(month_from) if month_from else None
+        high = parse_month(month_to) if month_to else None
+        supplier_code = None
+        if supplier:
+            supplier_code = self.supplier_codes.get(_key(supplier), -1)
+
+        live = ~invoices['replaced']
+
+        def mask_for(table):
+            # Items are live when the invoice they belong to is
+            mask = live.copy() if table is invoices else live[table['invoice']]
+            if low is not None:
+                mask &= table['month'] >= low
+            if high is not None:
+                mask &= (table['month'] <= high) & (table['month'] > 0)
+            if supplier_code is not None:
+                mask &= table['supplier'] == supplier_code
+            return mask
+
+        invoice_mask = mask_for(invoices)
+        if group_by == 'hsn':
+            groups = self._group_items(invoices, items, mask_for(items), len(hsn_codes))
+            labels = hsn_codes
+        else:
+            size = len(suppliers) if group_by == 'supplier' else int(invoices['month'].max(initial=0)) + 1
+            groups = self._group_invoices(invoices, invoice_mask, group_by, size)
+            labels = suppliers if group_by == 'supplier' else None
+
+        order = np.argsort(-groups.pop('total'), kind='stable')
+        order = order[groups['count'][order] > 0][:limit]
+        rows = []
+        for code in order.tolist():
+            row = {metric: _round(values[code]) for metric, values in groups.items()}
+            if group_by == 'month':
+                row['key'] = month_label(code)
+            else:
+                row['key'] = labels[code] or None
+                if group_by == 'supplier':
+                    row['name'] = supplier_names[code] or None
+            rows.append(row)
+
+        return {
+            'group_by': group_by,
+            'filters': {'from': month_from, 'to': month_to, 'supplier': supplier},
+            'invoices': int(invoice_mask.sum()),
+            'groups': rows,
+            'elapsed_ms': round(1000 * (time.perf_counter() - started), 2)
+        }
+
+    @staticmethod
+    def _group_invoices(invoices, mask, group_by, size):
+        codes = invoices[group_by][mask]
+        groups = {'count': np.bincount(codes, minlength=size)}
+        for column in ('invoice_amount', 'total_invoice') + TAX_COLUMNS:
+            values = invoices[column][mask]
+            groups[column] = np.bincount(codes, weights=np.nan_to_num(values), minlength=size)
+        known = ~np.isnan(invoices['total_invoice'][mask])
+        known_counts = np.bincount(codes[known], minlength=size)
+        groups['mean_total_invoice'] = np.divide(
+            groups['total_invoice'], known_counts, out=np.zeros(size), where=known_counts > 0
+        )
+        groups['total'] = groups['total_invoice']
+        return groups
+
+    @staticmethod
+    def _group_items(invoices, items, mask, size):
+        values = np.nan_to_num(items['value'])
+        # Invoice-level taxes are split over its items in proportion to their value
+        invoice_values = np.bincount(items['invoice'], weights=values, minlength=len(invoices['supplier']))
+        invoice_of_item = items['invoice'][mask]
+        share = np.divide(values[mask], invoice_values[invoice_of_item],
+                          out=np.zeros(int(mask.sum())), where=invoice_values[invoice_of_item] > 0)
+
+        codes = items['hsn'][mask]
+        groups = {
+            'count': np.bincount(codes, minlength=size),
+            'taxable_value': np.bincount(codes, weights=values[mask], minlength=size),
+            'quantity': np.bincount(codes, weights=np.nan_to_num(items['quantity'][mask]), minlength=size),
+        }
+        for column in TAX_COLUMNS:
+            invoice_tax = np.nan_to_num(invoices[column])[invoice_of_item]
+            groups[column] = np.bincount(codes, weights=invoice_tax * share, minlength=size)
+        groups['mean_taxable_value'] = np.divide(
+            groups['taxable_value'], groups['count'], out=np.zeros(size), where=groups['count'] > 0
+        )
+        groups['total'] = groups['taxable_value']
+        return groups
+
+
+def _round(value):
+    value = value.item()
+    return value if isinstance(value, int) else round(value, 2)
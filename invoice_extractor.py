@@ -1,5 +1,8 @@
 import os
 import csv
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
 from typing import Dict, Optional, Tuple
 import tkinter as tk
@@ -8,6 +11,7 @@ from PIL import Image, ImageTk
 import io
 from dotenv import load_dotenv
 import base64
+from csv_index import IndexedCsvStore, invoice_key
 
 # Load environment variables
 load_dotenv()
@@ -178,6 +182,12 @@ def save_to_csv(data: Dict[str, str], csv_file: str) -> bool:
         print(f"Error saving to CSV: {e}")
         return False
 
+# Number of extractions the desktop app runs at once
+EXTRACT_WORKERS = int(os.getenv('DESKTOP_EXTRACT_WORKERS', 4))
+
+# Image types picked up by "Process Folder"
+FOLDER_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff')
+
 class InvoiceExtractorApp:
     def __init__(self, root):
         self.root = root
@@ -187,9 +197,20 @@ class InvoiceExtractorApp:
         # Variables
         self.image_path = ""
         self.extracted_data = {}
+        self.csv_path = os.path.join(os.getcwd(), "extracted_invoices.csv")
+        self.store = IndexedCsvStore(self.csv_path)
+        
+        # Model calls run on worker threads; they report back through ui_queue,
+        # which is drained on the Tk main thread by poll_queue().
+        self.executor = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS)
+        self.ui_queue = queue.Queue()
+        self.batches = []  # open FolderBatchWindows, cancelled on close
         
         # Create UI
         self.create_widgets()
+        
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(100, self.poll_queue)
     
     def create_widgets(self):
         # Top frame for buttons
@@ -201,8 +222,12 @@ class InvoiceExtractorApp:
         btn_upload.pack(side=tk.LEFT, padx=5)
         
         # Extract button
-        btn_extract = ttk.Button(top_frame, text="Extract Data", command=self.extract_data)
-        btn_extract.pack(side=tk.LEFT, padx=5)
+        self.btn_extract = ttk.Button(top_frame, text="Extract Data", command=self.extract_data)
+        self.btn_extract.pack(side=tk.LEFT, padx=5)
+        
+        # Folder batch button
+        btn_folder = ttk.Button(top_frame, text="Process Folder", command=self.process_folder)
+        btn_folder.pack(side=tk.LEFT, padx=5)
         
         # Save button
         btn_save = ttk.Button(top_frame, text="Save to CSV", command=self.save_data)
@@ -265,6 +290,28 @@ class InvoiceExtractorApp:
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to load image: {e}")
     
+    def poll_queue(self):
+        """Apply results posted by worker threads, then poll again."""
+        try:
+            while True:
+                handler, args = self.ui_queue.get_nowait()
+                handler(*args)
+        except queue.Empty:
+            pass
+        self.root.after(100, self.poll_queue)
+    
+    def post_to_ui(self, handler, *args):
+        """Schedule handler(*args) on the Tk main thread from any thread."""
+        self.ui_queue.put((handler, args))
+    
+    def on_close(self):
+        # Stop queued model calls so no more tokens are spent once the window
+        # is gone; only the calls already running are waited for on exit
+        for batch in self.batches:
+            batch.cancel_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
+    
     def extract_data(self):
         if not self.image_path:
             messagebox.showwarning("Warning", "Please upload an invoice image first")
@@ -277,75 +324,30 @@ class InvoiceExtractorApp:
         loading_label = ttk.Label(self.scrollable_frame, text="Extracting data, please wait...")
         loading_label.pack(pady=20)
         
-        # Add a progress bar
-        progress = ttk.Progressbar(self.scrollable_frame, mode='indeterminate')
-        progress.pack(fill=tk.X, padx=20, pady=10)
-        progress.start(10)
+        # Add a progress bar; it animates because the main loop stays free
+        self.progress = ttk.Progressbar(self.scrollable_frame, mode='indeterminate')
+        self.progress.pack(fill=tk.X, padx=20, pady=10)
+        self.progress.start(10)
+        
+        self.btn_extract.config(state=tk.DISABLED)
+        self.status_var.set(f"Extracting {os.path.basename(self.image_path)}...")
         
-        self.root.update()
+        future = self.executor.submit(extract_fields_from_image, self.image_path)
+        future.add_done_callback(lambda f: self.post_to_ui(self.on_extract_done, f))
+    
+    def on_extract_done(self, future):
+        self.btn_extract.config(state=tk.NORMAL)
+        self.progress.stop()
+        self.progress.destroy()
         
         try:
             # Extract data from image
-            self.extracted_data, error = extract_fields_from_image(self.image_path)
+            self.extracted_data, error = future.result()
             
             if error:
                 raise Exception(error)
             
-            # Clear loading widgets
-            for widget in self.scrollable_frame.winfo_children():
-                widget.destroy()
-            
-            if not self.extracted_data:
-                ttk.Label(self.scrollable_frame, text="No data extracted").pack()
-                return
-            
-            # Create a treeview for better data display
-            style = ttk.Style()
-            style.configure("Treeview", rowheight=30)  # Increase row height
-            
-            # Create a frame for the treeview and scrollbars
-            tree_frame = ttk.Frame(self.scrollable_frame)
-            tree_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-            
-            # Add scrollbars
-            y_scroll = ttk.Scrollbar(tree_frame, orient="vertical")
-            x_scroll = ttk.Scrollbar(tree_frame, orient="horizontal")
-            
-            # Create the treeview
-            tree = ttk.Treeview(
-                tree_frame,
-                columns=("Value"),
-                show="headings",
-                yscrollcommand=y_scroll.set,
-                xscroll=x_scroll.set
-            )
-            
-            # Configure the columns
-            tree.heading("#0", text="Field", anchor=tk.W)
-            tree.heading("Value", text="Value", anchor=tk.W)
-            tree.column("#0", width=250, stretch=tk.NO)
-            tree.column("Value", width=500, stretch=tk.YES)
-            
-            # Configure the scrollbars
-            y_scroll.config(command=tree.yview)
-            x_scroll.config(command=tree.xview)
-            
-            # Add data to the treeview
-            for key, value in self.extracted_data.items():
-                if value:  # Only add non-empty values
-                    tree.insert("", tk.END, text=key, values=(value,))
-            
-            # Pack the treeview and scrollbars
-            tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-            y_scroll.pack(side=tk.RIGHT, fill=tk.Y)
-            x_scroll.pack(side=tk.BOTTOM, fill=tk.X)
-            
-            # Add some padding and styling
-            style = ttk.Style()
-            style.configure("Treeview", rowheight=30, font=('Arial', 10))
-            style.configure("Treeview.Heading", font=('Arial', 10, 'bold'))
-            
-            self.status_var.set(f"Successfully extracted {len(self.extracted_data)} fields")
+            self.show_extracted_data()
             
         except Exception as e:
             for widget in self.scrollable_frame.winfo_children():
@@ -356,10 +358,78 @@ class InvoiceExtractorApp:
                 foreground="red"
             ).pack(pady=20)
             self.status_var.set("Error extracting data")
-        finally:
-            if 'progress' in locals():
-                progress.stop()
-                progress.destroy()
+    
+    def show_extracted_data(self):
+        # Clear loading widgets
+        for widget in self.scrollable_frame.winfo_children():
+            widget.destroy()
+        
+        if not self.extracted_data:
+            ttk.Label(self.scrollable_frame, text="No data extracted").pack()
+            return
+        
+        # Create a treeview for better data display
+        style = ttk.Style()
+        style.configure("Treeview", rowheight=30)  # Increase row height
+        
+        # Create a frame for the treeview and scrollbars
+        tree_frame = ttk.Frame(self.scrollable_frame)
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        # Add scrollbars
+        y_scroll = ttk.Scrollbar(tree_frame, orient="vertical")
+        x_scroll = ttk.Scrollbar(tree_frame, orient="horizontal")
+        
+        # Create the treeview
+        tree = ttk.Treeview(
+            tree_frame,
+            columns=("Value"),
+            show="headings",
+            yscrollcommand=y_scroll.set,
+            xscroll=x_scroll.set
+        )
+        
+        # Configure the columns
+        tree.heading("#0", text="Field", anchor=tk.W)
+        tree.heading("Value", text="Value", anchor=tk.W)
+        tree.column("#0", width=250, stretch=tk.NO)
+        tree.column("Value", width=500, stretch=tk.YES)
+        
+        # Configure the scrollbars
+        y_scroll.config(command=tree.yview)
+        x_scroll.config(command=tree.xview)
+        
+        # Add data to the treeview
+        for key, value in self.extracted_data.items():
+            if value:  # Only add non-empty values
+                tree.insert("", tk.END, text=key, values=(value,))
+        
+        # Pack the treeview and scrollbars
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        y_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        x_scroll.pack(side=tk.BOTTOM, fill=tk.X)
+        
+        # Add some padding and styling
+        style = ttk.Style()
+        style.configure("Treeview", rowheight=30, font=('Arial', 10))
+        style.configure("Treeview.Heading", font=('Arial', 10, 'bold'))
+        
+        self.status_var.set(f"Successfully extracted {len(self.extracted_data)} fields")
+    
+    def process_folder(self):
+        folder = filedialog.askdirectory(title="Select a folder of invoice images")
+        if not folder:
+            return
+        
+        paths = sorted(
+            os.path.join(folder, name) for name in os.listdir(folder)
+            if name.lower().endswith(FOLDER_IMAGE_EXTENSIONS)
+        )
+        if not paths:
+            messagebox.showinfo("Process Folder", "No invoice images found in the selected folder.")
+            return
+        
+        self.batches.append(FolderBatchWindow(self, paths))
     
     def save_data(self):
         if not self.extracted_data:
@@ -367,22 +437,19 @@ class InvoiceExtractorApp:
             return
         
         # Default file path
-        default_file = os.path.join(os.getcwd(), "extracted_invoices.csv")
-        
-        # Check if file exists to determine if we need headers
-        file_exists = os.path.isfile(default_file)
+        default_file = self.csv_path
         
         try:
+            # Duplicate check is a lookup in the sidecar index, not a CSV scan
+            existing_row = self.store.find(invoice_key(self.extracted_data))
+            if existing_row is not None and not messagebox.askyesno(
+                "Duplicate Invoice",
+                f"This invoice is already saved (row {existing_row + 1}).\n\nAppend it again?"
+            ):
+                return
+            
             # Save to the default file (append mode)
-            with open(default_file, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=self.extracted_data.keys())
-                
-                # Write header only if file is being created
-                if not file_exists:
-                    writer.writeheader()
-                
-                # Write the data
-                writer.writerow(self.extracted_data)
+            self.store.append(self.extracted_data)
             
             # Show success message
             messagebox.showinfo(
@@ -397,11 +464,130 @@ class InvoiceExtractorApp:
     
     def count_invoices_in_csv(self, filepath):
         """Count the number of invoices in the CSV file."""
+        if filepath == self.csv_path:
+            return self.store.count
+        return IndexedCsvStore(filepath).count
+
+class FolderBatchWindow:
+    """Extracts every image of a folder concurrently with a live progress table."""
+    
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = paths
+        self.results = {}
+        self.finished = 0
+        self.cancel_event = threading.Event()
+        self.futures = []
+        
+        self.window = tk.Toplevel(app.root)
+        self.window.title(f"Processing {len(paths)} invoices")
+        self.window.geometry("700x400")
+        self.window.protocol("WM_DELETE_WINDOW", self.cancel)
+        
+        # Per-file progress table
+        self.tree = ttk.Treeview(self.window, columns=("Status", "Details"), show="tree headings")
+        self.tree.heading("#0", text="File", anchor=tk.W)
+        self.tree.heading("Status", text="Status", anchor=tk.W)
+        self.tree.heading("Details", text="Details", anchor=tk.W)
+        self.tree.column("#0", width=250)
+        self.tree.column("Status", width=100, stretch=tk.NO)
+        self.tree.column("Details", width=330)
+        self.tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        for path in paths:
+            self.tree.insert("", tk.END, iid=path, text=os.path.basename(path), values=("Queued", ""))
+        
+        bottom_frame = ttk.Frame(self.window, padding="10")
+        bottom_frame.pack(fill=tk.X)
+        
+        self.progress = ttk.Progressbar(bottom_frame, mode='determinate', maximum=len(paths))
+        self.progress.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        
+        self.btn_cancel = ttk.Button(bottom_frame, text="Cancel", command=self.cancel)
+        self.btn_cancel.pack(side=tk.RIGHT, padx=5)
+        
+        for path in paths:
+            future = app.executor.submit(self.extract_one, path)
+            future.add_done_callback(lambda f, p=path: app.post_to_ui(self.on_file_done, p, f))
+            self.futures.append(future)
+    
+    def extract_one(self, path):
+        """Runs on a worker thread."""
+        if self.cancel_event.is_set():
+            return None
+        self.app.post_to_ui(self.set_status, path, "Extracting", "")
+        return extract_fields_from_image(path)
+    
+    def set_status(self, path, status, details):
+        if self.tree.exists(path):
+            self.tree.item(path, values=(status, details))
+    
+    def on_file_done(self, path, future):
+        if future.cancelled() or (future.exception() is None and future.result() is None):
+            self.set_status(path, "Cancelled", "")
+        elif future.exception() is not None:
+            self.set_status(path, "Failed", str(future.exception()))
+        else:
+            data, error = future.result()
+            if error or not data:
+                self.set_status(path, "Failed", error or "No data extracted")
+            else:
+                self.results[path] = data
+                self.set_status(path, "Done", f"{len(data)} fields")
+        
+        self.finished += 1
+        self.progress['value'] = self.finished
+        self.app.status_var.set(f"Processed {self.finished}/{len(self.paths)} invoices")
+        
+        if self.finished == len(self.paths):
+            self.save_results()
+    
+    def cancel(self):
+        if self.finished == len(self.paths):
+            self.app.batches.remove(self)
+            self.window.destroy()
+            return
+        self.cancel_event.set()
+        for future in self.futures:
+            future.cancel()
+        self.btn_cancel.config(state=tk.DISABLED)
+        self.app.status_var.set("Cancelling folder extraction...")
+    
+    def save_results(self):
+        """Append all new extractions to the CSV in one write."""
+        self.btn_cancel.config(text="Close", state=tk.NORMAL)
+        rows = []
+        seen_keys = set()
+        duplicates = 0
+        for path in self.paths:
+            if path not in self.results:
+                continue
+            data = self.results[path]
+            key = invoice_key(data)
+            if key is not None and (key in seen_keys or self.app.store.find(key) is not None):
+                duplicates += 1
+                self.set_status(path, "Duplicate", "Already saved; skipped")
+                continue
+            seen_keys.add(key)
+            rows.append(data)
+        
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return sum(1 for _ in f) - 1  # Subtract 1 for header
-        except FileNotFoundError:
-            return 0
+            saved = len(self.app.store.append_rows(rows))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save data: {str(e)}", parent=self.window)
+            return
+        
+        failed = len(self.paths) - len(self.results)
+        self.app.status_var.set(
+            f"Folder processed: {saved} saved, {duplicates} duplicates, {failed} not extracted"
+        )
+        messagebox.showinfo(
+            "Folder Processed",
+            f"Appended {saved} invoices to:\n{self.app.csv_path}\n\n"
+            f"Skipped duplicates: {duplicates}\n"
+            f"Not extracted (failed or cancelled): {failed}",
+            parent=self.window
+        )
 
 if __name__ == '__main__':
     if not MODEL:
@@ -1,150 +1,623 @@
 import os
 import csv
 import google.generativeai as genai
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from PIL import Image
 import io
 from dotenv import load_dotenv
 import base64
+import hashlib
 import json
 import re
+import random
+import threading
+import time
+from collections import deque
+import tracing
+import einvoice_qr
+import ocr_text
+import usage_accounting
+from invoice_model import Invoice, to_number
 
 # Load environment variables
 load_dotenv()
 
+# Model cascade, cheapest first. An invoice is only sent to the next model
+# when the previous model's output fails validate_extraction().
+MODEL_CASCADE = [
+    name.strip()
+    for name in os.getenv('GEMINI_MODEL_CASCADE', 'gemini-1.5-flash-8b,gemini-1.5-flash,gemini-1.5-pro').split(',')
+    if name.strip()
+]
+
+# Relative tolerance when reconciling line items, tax and totals
+TOTALS_TOLERANCE = float(os.getenv('CASCADE_TOTALS_TOLERANCE', 0.01))
+# Absolute tolerance for round-off, in invoice currency
+ROUND_OFF_TOLERANCE = float(os.getenv('CASCADE_ROUND_OFF_TOLERANCE', 1.0))
+
+# Fields every accepted extraction must contain
+REQUIRED_FIELDS = [
+    ('company_info', 'gstin'),
+    ('invoice_info', 'gst_invoice_number'),
+    ('invoice_info', 'invoice_date'),
+    ('totals', 'total_invoice'),
+]
+
 # Initialize Gemini API
 try:
     GEMINI_API_KEY = os.getenv('GOOGLE_API_KEY')
     if not GEMINI_API_KEY:
         raise ValueError("Please set the GOOGLE_API_KEY in the .env file")
     genai.configure(api_key=GEMINI_API_KEY)
-    MODEL = genai.GenerativeModel('gemini-1.5-flash')
+    MODELS = [(name, genai.GenerativeModel(name)) for name in MODEL_CASCADE]
+    MODEL = MODELS[0][1]
 except Exception as e:
     print(f"Error initializing Gemini API: {e}")
+    MODELS = []
     MODEL = None
 
-def extract_fields_from_image(image_path: str) -> Tuple[Dict[str, str], str]:
-    """Extract invoice fields from an image using Gemini API."""
+# Schema of each section the model is asked for, in prompt order
+SECTION_SCHEMAS = {
+    "company_info": {
+        "company_name": "string",
+        "company_address": "string",
+        "city": "string",
+        "pincode": "string",
+        "gstin": "string",
+        "email": "string",
+        "phone": "string",
+        "website_url": "string",
+        "pan_number": "string",
+        "state_and_state_code": "string",
+        "contact_person_name": "string"
+    },
+    "invoice_info": {
+        "gst_invoice_number": "string",
+        "invoice_date": "string",
+        "invoice_type": "string",
+        "challan_number": "string",
+        "challan_date": "string",
+        "purchase_order_number": "string",
+        "purchase_order_date": "string",
+        "place_of_supply": "string",
+        "place_of_delivery": "string",
+        "reverse_charge_applicable": "string",
+        "e_invoice_irn": "string",
+        "e_way_bill_number": "string",
+        "qr_code": "string"
+    },
+    "billing_info": {
+        "billing_company_name": "string",
+        "billing_address": "string",
+        "billing_city": "string",
+        "billing_pincode": "string",
+        "billing_party_gstin": "string",
+        "email_and_phone_of_buyer": "string"
+    },
+    "shipping_info": {
+        "shipping_company_name": "string",
+        "shipping_address": "string",
+        "shipping_city": "string",
+        "shipping_pincode": "string",
+        "shipping_party_gstin": "string"
+    },
+    "items": [
+        {
+            "description_of_goods": "string",
+            "hsn_code": "string",
+            "quantity": "number",
+            "uqc": "string",
+            "weight": "string",
+            "rate": "number",
+            "amount": "number",
+            "discount_per_item": "number",
+            "taxable_value": "number",
+            "batch_no": "string",
+            "expiry_date": "string",
+            "manufacturing_date": "string"
+        }
+    ],
+    "tax_info": {
+        "cgst": "number",
+        "sgst": "number",
+        "igst": "number",
+        "cess_amount": "number"
+    },
+    "totals": {
+        "invoice_amount": "number",
+        "total_invoice": "number"
+    },
+    "transport_info": {
+        "transporter_details": "string",
+        "vehicle_number": "string",
+        "lr_number": "string",
+        "transporter_id": "string"
+    },
+    "bank_info": {
+        "bank_details": "string"
+    }
+}
+ALL_SECTIONS = tuple(SECTION_SCHEMAS)
+# Sections needed by integrations that only want the invoice header
+HEADER_SECTIONS = ('company_info', 'invoice_info', 'billing_info', 'totals')
+
+PROMPT_INSTRUCTIONS = """IMPORTANT INSTRUCTIONS:
+1. If any field is not present or not applicable, set it to null
+2. For items array, include ALL items found on the invoice with their complete details
+3. Make sure all numerical values are properly formatted as numbers, not strings
+4. Only extract data that is actually present on the invoice
+5. Do not make up or assume any values"""
+
+def build_extraction_prompt(sections=None, known=None, hints=None) -> str:
+    """Prompt asking for the given sections, minus fields already known.
+
+    ``known`` is a partial result ({section: {field: value}}), e.g. read from
+    a verified e-invoice QR code; those fields are left out of the requested
+    schema. ``hints`` has the same shape, e.g. from an unverified QR code; the
+    model still extracts those fields, checking them against the invoice.
+    """
+    sections = sections or ALL_SECTIONS
+    known = known or {}
+    schema = {}
+    for section in sections:
+        section_schema = SECTION_SCHEMAS[section]
+        if isinstance(section_schema, dict):
+            section_schema = {
+                field: kind for field, kind in section_schema.items()
+                if field not in known.get(section, {})
+            }
+            if not section_schema:
+                continue
+        schema[section] = section_schema
+    
+    prompt = "Extract all data from this GST invoice and return it in a structured JSON format. \n\n"
+    if 'items' in schema:
+        prompt += "For invoices with multiple items, create an array of items with all their details.\n\n"
+    prompt += "Return the response in this exact JSON structure:\n" + json.dumps(schema, indent=2) + "\n\n"
+    if known:
+        facts = [f"{section}.{field} = {json.dumps(value)}" for section, fields in known.items()
+                 for field, value in fields.items() if field != 'qr_code']
+        prompt += ("These fields were already read from the invoice's signed e-invoice QR code and "
+                   "must not be returned: " + "; ".join(facts) + "\n\n")
+    if hints:
+        facts = [f"{section}.{field} = {json.dumps(value)}" for section, fields in hints.items()
+                 for field, value in fields.items() if field != 'qr_code']
+        prompt += ("The invoice's e-invoice QR code, whose signature could not be verified, reads: "
+                   + "; ".join(facts) + ". Use these values only where they match what is printed "
+                   "on the invoice.\n\n")
+    return prompt + PROMPT_INSTRUCTIONS
+
+EXTRACTION_PROMPT = build_extraction_prompt()
+# Version of each section's schema and instructions. Stored results are tagged
+# with the versions they were extracted under, so backfill.py can re-extract
+# just the sections that changed since.
+SECTION_VERSIONS = {
+    section: hashlib.sha256((json.dumps({section: schema}, sort_keys=True) + PROMPT_INSTRUCTIONS)
+                            .encode('utf-8')).hexdigest()[:8]
+    for section, schema in SECTION_SCHEMAS.items()
+}
+# Identifies the prompt wording in usage accounting, so prompt changes can be compared
+PROMPT_VERSION = hashlib.sha256((EXTRACTION_PROMPT + ocr_text.TEXT_MODE_NOTE).encode('utf-8')).hexdigest()[:12]
+
+# Token counts and latency of every model call, with daily budgets
+USAGE = usage_accounting.UsageAccounting()
+
+# Per-tier cascade statistics, reported by get_cascade_stats()
+CASCADE_STATS = {}
+CASCADE_STATS_LOCK = threading.Lock()
+
+# Per (input mode, supplier) token, latency and accuracy statistics,
+# reported by get_input_mode_stats()
+INPUT_MODE_STATS = {}
+INPUT_MODE_STATS_LOCK = threading.Lock()
+
+def parse_model_response(text: str) -> Optional[Dict]:
+    """Parse the model's JSON answer, dropping top-level null sections."""
+    try:
+        # Try to parse the response as JSON
+        result = json.loads(text)
+    except json.JSONDecodeError:
+        # If direct JSON parsing fails, try to extract JSON from the response
+        json_match = re.search(r'\{.*\}', text, re.DOTALL)
+        if not json_match:
+            return None
+        result = json.loads(json_match.group(0))
+    return {k: v for k, v in result.items() if v is not None}
+
+def _amounts_match(expected: float, actual: float) -> bool:
+    return abs(expected - actual) <= max(ROUND_OFF_TOLERANCE, TOTALS_TOLERANCE * abs(expected))
+
+def validate_extraction(result: Dict, sections=None) -> List[str]:
+    """Return the reasons an extraction should be escalated (empty if it is fine).
+
+    Only checks that involve the requested ``sections`` (default: all) apply.
+    """
+    sections = sections or ALL_SECTIONS
+    issues = []
+    for section, field in REQUIRED_FIELDS:
+        if section not in sections:
+            continue
+        value = (result.get(section) or {}).get(field)
+        if value in (None, ''):
+            issues.append(f'missing:{section}.{field}')
+
+    items = result.get('items') or []
+    if 'items' in sections and not items:
+        issues.append('missing:items')
+
+    totals = result.get('totals') or {}
+    tax_info = result.get('tax_info') or {}
+    invoice_amount = to_number(totals.get('invoice_amount'))
+    total_invoice = to_number(totals.get('total_invoice'))
+
+    # Line items must add up to the taxable invoice amount
+    item_values = [to_number(item.get('taxable_value')) or to_number(item.get('amount')) for item in items]
+    if invoice_amount is not None and item_values and None not in item_values:
+        if not _amounts_match(invoice_amount, sum(item_values)):
+            issues.append('mismatch:items_vs_invoice_amount')
+
+    # Taxable amount plus taxes must add up to the invoice total
+    if 'tax_info' in sections and invoice_amount is not None and total_invoice is not None:
+        taxes = sum(to_number(tax_info.get(key)) or 0.0 for key in ('cgst', 'sgst', 'igst', 'cess_amount'))
+        if not _amounts_match(total_invoice, invoice_amount + taxes):
+            issues.append('mismatch:tax_vs_total_invoice')
+
+    return issues
+
+def merge_known_fields(result: Dict, known: Dict):
+    """Overlay deterministically known fields on a model result, in place."""
+    for section, fields in known.items():
+        if not isinstance(result.get(section), dict):
+            result[section] = {}
+        result[section].update(fields)
+
+def _same_value(a, b) -> bool:
+    if isinstance(a, (int, float)) or isinstance(b, (int, float)):
+        a, b = to_number(a), to_number(b)
+        return a is not None and b is not None and _amounts_match(a, b)
+    return re.sub(r'[^0-9a-z]', '', str(a or '').lower()) == re.sub(r'[^0-9a-z]', '', str(b or '').lower())
+
+def field_agreement(result: Dict, reference: Dict) -> float:
+    """Fraction of fields, filled in either extraction, on which the two agree."""
+    pairs = []
+    for section, schema in SECTION_SCHEMAS.items():
+        if section == 'items':
+            items, reference_items = result.get('items') or [], reference.get('items') or []
+            for i in range(max(len(items), len(reference_items))):
+                item = items[i] if i < len(items) and isinstance(items[i], dict) else {}
+                reference_item = reference_items[i] if i < len(reference_items) and isinstance(reference_items[i], dict) else {}
+                pairs.extend((item.get(field), reference_item.get(field)) for field in schema[0])
+            continue
+        values, reference_values = result.get(section) or {}, reference.get(section) or {}
+        pairs.extend((values.get(field), reference_values.get(field)) for field in schema if field != 'qr_code')
+    compared = [(a, b) for a, b in pairs if a not in (None, '') or b not in (None, '')]
+    if not compared:
+        return 1.0
+    return sum(1 for a, b in compared if _same_value(a, b)) / len(compared)
+
+def _token_usage(response) -> Tuple[int, int]:
+    usage = getattr(response, 'usage_metadata', None)
+    return (getattr(usage, 'prompt_token_count', 0) or 0, getattr(usage, 'candidates_token_count', 0) or 0)
+
+def _supplier_key(result: Optional[Dict], known: Dict) -> str:
+    company_info = (result or {}).get('company_info') or known.get('company_info') or {}
+    return str(company_info.get('gstin') or company_info.get('company_name') or 'unknown')
+
+def _record_input_modes(supplier: str, events: List[Tuple], agreement: Optional[float]):
+    """Record one invoice's model calls as (input mode, outcome, latency, prompt tokens, output tokens)."""
+    with INPUT_MODE_STATS_LOCK:
+        for mode, outcome, latency, prompt_tokens, output_tokens in events:
+            stats = INPUT_MODE_STATS.setdefault((mode, supplier), {
+                'attempts': 0,
+                'clean': 0,
+                'issues': 0,
+                'errors': 0,
+                'low_confidence': 0,
+                'prompt_tokens': 0,
+                'output_tokens': 0,
+                'comparisons': 0,
+                'agreement': 0.0,
+                'latencies': deque(maxlen=1000)
+            })
+            stats[outcome] += 1
+            if outcome == 'low_confidence':
+                continue
+            stats['attempts'] += 1
+            stats['prompt_tokens'] += prompt_tokens
+            stats['output_tokens'] += output_tokens
+            stats['latencies'].append(latency)
+        if agreement is not None:
+            stats = INPUT_MODE_STATS[('text', supplier)]
+            stats['comparisons'] += 1
+            stats['agreement'] += agreement
+
+def _summarize_input_mode(entries: List[Dict]) -> Dict:
+    summary = {key: sum(entry[key] for entry in entries)
+               for key in ('attempts', 'clean', 'issues', 'errors', 'low_confidence', 'comparisons')}
+    attempts = summary['attempts']
+    if attempts:
+        latencies = sorted(latency for entry in entries for latency in entry['latencies'])
+        summary['clean_rate'] = round(summary['clean'] / attempts, 4)
+        summary['mean_prompt_tokens'] = round(sum(entry['prompt_tokens'] for entry in entries) / attempts, 1)
+        summary['mean_output_tokens'] = round(sum(entry['output_tokens'] for entry in entries) / attempts, 1)
+        summary['latency_ms'] = {
+            'mean': round(1000 * sum(latencies) / len(latencies), 1),
+            'p50': round(1000 * _percentile(latencies, 0.50), 1),
+            'p95': round(1000 * _percentile(latencies, 0.95), 1)
+        }
+    if summary['comparisons']:
+        summary['agreement_with_image'] = round(
+            sum(entry['agreement'] for entry in entries) / summary['comparisons'], 4)
+    return summary
+
+def get_input_mode_stats() -> Dict:
+    """Tokens, latency and accuracy of text versus image mode, overall and per supplier."""
+    with INPUT_MODE_STATS_LOCK:
+        by_mode, by_supplier = {}, {}
+        for (mode, supplier), entry in INPUT_MODE_STATS.items():
+            by_mode.setdefault(mode, []).append(entry)
+            by_supplier.setdefault(supplier, {}).setdefault(mode, []).append(entry)
+        return {
+            'ocr_mode': ocr_text.OCR_MODE,
+            'min_confidence': ocr_text.OCR_MIN_CONFIDENCE,
+            'compare_rate': ocr_text.OCR_COMPARE_RATE,
+            'modes': {mode: _summarize_input_mode(entries) for mode, entries in by_mode.items()},
+            'suppliers': {
+                supplier: {mode: _summarize_input_mode(entries) for mode, entries in modes.items()}
+                for supplier, modes in sorted(by_supplier.items())
+            }
+        }
+
+def _record_attempt(model_name: str, latency: float, outcome: str, issues: List[str]):
+    with CASCADE_STATS_LOCK:
+        stats = CASCADE_STATS.setdefault(model_name, {
+            'attempts': 0,
+            'accepted': 0,
+            'escalated': 0,
+            'errors': 0,
+            'issues': {},
+            'latencies': deque(maxlen=1000)
+        })
+        stats['attempts'] += 1
+        stats[outcome] += 1
+        stats['latencies'].append(latency)
+        for issue in issues:
+            stats['issues'][issue] = stats['issues'].get(issue, 0) + 1
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def get_cascade_stats() -> Dict:
+    """Per-tier hit rates, escalation reasons and latencies."""
+    report = {'tiers': []}
+    with CASCADE_STATS_LOCK:
+        for model_name in MODEL_CASCADE:
+            stats = CASCADE_STATS.get(model_name)
+            if not stats:
+                report['tiers'].append({'model': model_name, 'attempts': 0})
+                continue
+            latencies = sorted(stats['latencies'])
+            report['tiers'].append({
+                'model': model_name,
+                'attempts': stats['attempts'],
+                'accepted': stats['accepted'],
+                'escalated': stats['escalated'],
+                'errors': stats['errors'],
+                'hit_rate': round(stats['accepted'] / stats['attempts'], 4),
+                'escalation_reasons': dict(stats['issues']),
+                'latency_ms': {
+                    'mean': round(1000 * sum(latencies) / len(latencies), 1),
+                    'p50': round(1000 * _percentile(latencies, 0.50), 1),
+                    'p95': round(1000 * _percentile(latencies, 0.95), 1)
+                }
+            })
+    report['totals_tolerance'] = TOTALS_TOLERANCE
+    report['round_off_tolerance'] = ROUND_OFF_TOLERANCE
+    return report
+
+def extract_fields_from_image(image_path: str, mime_type: str = "image/jpeg", meta: Optional[Dict] = None,
+                              header_only: bool = False, einvoice=None,
+                              sections: Optional[List[str]] = None) -> Tuple[Dict[str, str], str]:
+    """Extract invoice fields from an image using the Gemini model cascade.
+
+    A verified e-invoice QR code on the image fills the header fields it
+    carries and the model is only asked for the rest. With ``header_only`` only
+    the header sections are extracted, and an invoice with a verified QR code
+    needs no model call at all. Pass the result of einvoice_qr.find_einvoice() as ``einvoice``
+    if it is already known (False if there is none) to skip decoding again.
+    ``sections`` asks for just those sections instead (used by backfill.py).
+
+    With ``OCR_MODE`` set (see ocr_text), the model may be sent the page's OCR
+    text instead of the image; low-confidence OCR falls back to the image.
+
+    If ``meta`` is given it is filled with the model that produced the result,
+    the tiers tried, the input mode, token counts, the section versions and
+    any validation issues left in the returned data.
+    """
+    if sections:
+        unknown = [section for section in sections if section not in SECTION_SCHEMAS]
+        if unknown:
+            return {}, f"Unknown sections: {', '.join(unknown)}"
+        sections = tuple(sections)
+    else:
+        sections = HEADER_SECTIONS if header_only else ALL_SECTIONS
+    if einvoice is None:
+        with tracing.span('qr_decode'):
+            einvoice = einvoice_qr.find_einvoice(image_path, mime_type)
+    # Only a verified QR code is trusted; an unverified one is a hint to the model
+    known = einvoice_qr.to_invoice_fields(einvoice) if einvoice and einvoice['verified'] else {}
+    hints = einvoice_qr.to_invoice_fields(einvoice) if einvoice and not einvoice['verified'] else {}
+    if meta is not None:
+        meta['sections'] = list(sections)
+        meta['section_versions'] = {section: SECTION_VERSIONS[section] for section in sections}
+        meta['einvoice'] = {'irn': einvoice['fields']['Irn'], 'verified': einvoice['verified']} if einvoice else None
+    
+    if header_only and known:
+        if meta is not None:
+            meta.update(tiers_tried=[], model='einvoice_qr', validation_issues=[])
+        return known, ""
+    
     if not MODEL:
         return {}, "Error: Gemini API not properly initialized. Check your API key."
     
+    retry_after = USAGE.try_acquire()
+    if retry_after is not None:
+        return {}, f"Daily token budget exhausted; retry in {retry_after} seconds"
+    # Models over their daily budget drop out of the cascade
+    allowed = USAGE.allowed_models([name for name, _ in MODELS])
+    tiers = [tier for tier, (name, _) in enumerate(MODELS) if name in allowed]
+    if not tiers:
+        return {}, "Daily token budget exhausted for every model"
+    
+    if known or hints or sections != ALL_SECTIONS:
+        prompt = build_extraction_prompt(sections, known, hints)
+    else:
+        prompt = EXTRACTION_PROMPT
+    
+    # Send OCR text instead of the image when the supplier's input mode
+    # allows it and the OCR is good enough. The supplier comes from the QR
+    # code (only the input mode depends on it, so an unverified one will do)
+    # or else from the OCR text.
+    supplier_gstin = ((known or hints).get('company_info') or {}).get('gstin')
+    ocr = None
+    if ocr_text.needs_ocr(supplier_gstin):
+        with tracing.span('ocr') as ocr_span:
+            ocr = ocr_text.read_layout(image_path, mime_type)
+            ocr_span.set('confidence', ocr['confidence'] if ocr else None)
+        if not supplier_gstin and ocr:
+            supplier_gstin = ocr_text.supplier_in_text(ocr['text'])
+    input_mode = ocr_text.input_mode_for(supplier_gstin)
+    use_text = ocr_text.is_usable(ocr, input_mode)
+    # Model calls as (input mode, outcome, latency, prompt tokens, output tokens)
+    events = []
+    # and as (model, prompt tokens, output tokens, latency) for usage accounting
+    calls = []
+    if ocr is not None and input_mode != 'image' and not use_text:
+        events.append(('text', 'low_confidence', ocr['seconds'], 0, 0))
+    
     try:
         # Load and prepare the image
-        with open(image_path, "rb") as img_file:
-            img_data = img_file.read()
-        
-        # Prepare the prompt
-        prompt = """Extract all data from this GST invoice and return it in a structured JSON format. 
-        
-        For invoices with multiple items, create an array of items with all their details.
-        
-        Return the response in this exact JSON structure:
-        {
-          "company_info": {
-            "company_name": "string",
-            "company_address": "string", 
-            "city": "string",
-            "pincode": "string",
-            "gstin": "string",
-            "email": "string",
-            "phone": "string",
-            "website_url": "string",
-            "pan_number": "string",
-            "state_and_state_code": "string",
-            "contact_person_name": "string"
-          },
-          "invoice_info": {
-            "gst_invoice_number": "string",
-            "invoice_date": "string",
-            "invoice_type": "string",
-            "challan_number": "string",
-            "challan_date": "string",
-            "purchase_order_number": "string",
-            "purchase_order_date": "string",
-            "place_of_supply": "string",
-            "place_of_delivery": "string",
-            "reverse_charge_applicable": "string",
-            "e_invoice_irn": "string",
-            "e_way_bill_number": "string",
-            "qr_code": "string"
-          },
-          "billing_info": {
-            "billing_company_name": "string",
-            "billing_address": "string",
-            "billing_city": "string", 
-            "billing_pincode": "string",
-            "billing_party_gstin": "string",
-            "email_and_phone_of_buyer": "string"
-          },
-          "shipping_info": {
-            "shipping_company_name": "string",
-            "shipping_address": "string",
-            "shipping_city": "string",
-            "shipping_pincode": "string", 
-            "shipping_party_gstin": "string"
-          },
-          "items": [
-            {
-              "description_of_goods": "string",
-              "hsn_code": "string",
-              "quantity": "number",
-              "uqc": "string",
-              "weight": "string",
-              "rate": "number",
-              "amount": "number",
-              "discount_per_item": "number",
-              "taxable_value": "number",
-              "batch_no": "string",
-              "expiry_date": "string",
-              "manufacturing_date": "string"
-            }
-          ],
-          "tax_info": {
-            "cgst": "number",
-            "sgst": "number", 
-            "igst": "number",
-            "cess_amount": "number"
-          },
-          "totals": {
-            "invoice_amount": "number",
-            "total_invoice": "number"
-          },
-          "transport_info": {
-            "transporter_details": "string",
-            "vehicle_number": "string",
-            "lr_number": "string",
-            "transporter_id": "string"
-          },
-          "bank_info": {
-            "bank_details": "string"
-          }
-        }
+        with tracing.span('read_image'):
+            with open(image_path, "rb") as img_file:
+                img_data = img_file.read()
+    except Exception as e:
+        return {}, f"Error processing image: {str(e)}"
+    
+    def generate(model, mode):
+        if mode == 'text':
+            note = ocr_text.TEXT_MODE_NOTE.format(width=ocr['width'], height=ocr['height'])
+            return model.generate_content([f"{prompt}\n\n{note}", ocr['text']])
+        return model.generate_content([prompt, {"mime_type": mime_type, "data": img_data}])
+    
+    # Text mode gets one try on the cheapest model; if that fails validation
+    # the cascade runs in image mode as usual
+    attempts = [(tiers[0], 'text')] if use_text else []
+    attempts += [(tier, 'image') for tier in tiers]
+    
+    best = None  # (issue count, result, issues, model name, input mode)
+    error_message = ""
+    tiers_tried = []
+    for i, (tier, mode) in enumerate(attempts):
+        model_name, model = MODELS[tier]
+        last_tier = i == len(attempts) - 1
+        tiers_tried.append(model_name if mode == 'image' else f'{model_name}:text')
+        started = time.monotonic()
+        # OCR time counts towards the latency of text mode
+        ocr_seconds = ocr['seconds'] if mode == 'text' else 0.0
+        usage = (0, 0)
+        called = False
+        try:
+            # Generate content
+            with tracing.span('model', model=model_name, tier=tier, input=mode):
+                try:
+                    response = generate(model, mode)
+                finally:
+                    model_seconds = time.monotonic() - started
+            usage = _token_usage(response)
+            calls.append((model_name, mode) + usage + (model_seconds,))
+            called = True
+            with tracing.span('parse'):
+                result = parse_model_response(response.text)
+                if result is not None:
+                    merge_known_fields(result, known)
+        except Exception as e:
+            if not called:
+                # The call failed; its tokens are unknown but it still counts as a call
+                calls.append((model_name, mode, 0, 0, time.monotonic() - started))
+            if mode == 'image':
+                _record_attempt(model_name, time.monotonic() - started, 'errors', [])
+            events.append((mode, 'errors', time.monotonic() - started + ocr_seconds) + usage)
+            error_message = f"Error processing image: {str(e)}"
+            continue
         
-        IMPORTANT INSTRUCTIONS:
-        1. If any field is not present or not applicable, set it to null
-        2. For items array, include ALL items found on the invoice with their complete details
-        3. Make sure all numerical values are properly formatted as numbers, not strings
-        4. Only extract data that is actually present on the invoice
-        5. Do not make up or assume any values"""
+        if result is None:
+            if mode == 'image':
+                _record_attempt(model_name, time.monotonic() - started, 'errors' if last_tier else 'escalated', ['unparseable'])
+            events.append((mode, 'errors', time.monotonic() - started + ocr_seconds) + usage)
+            error_message = "Could not parse the response as JSON"
+            continue
         
-        # Generate content
-        response = MODEL.generate_content([prompt, {"mime_type": "image/jpeg", "data": img_data}])
+        with tracing.span('validate'):
+            issues = validate_extraction(result, sections)
+        events.append((mode, 'issues' if issues else 'clean', time.monotonic() - started + ocr_seconds) + usage)
+        if best is None or len(issues) < best[0]:
+            best = (len(issues), result, issues, model_name, mode)
         
-        # Process the response
+        if not issues or last_tier:
+            if mode == 'image':
+                _record_attempt(model_name, time.monotonic() - started, 'accepted', issues)
+            break
+        if mode == 'image':
+            _record_attempt(model_name, time.monotonic() - started, 'escalated', issues)
+    
+    # Sample text-mode results against image mode on the same model, to
+    # measure how accurate text mode is for this supplier
+    agreement = None
+    if best is not None and best[4] == 'text' and random.random() < ocr_text.OCR_COMPARE_RATE:
+        started = time.monotonic()
         try:
-            # Try to parse the response as JSON
-            result = json.loads(response.text)
-            return {k: v for k, v in result.items() if v is not None}, ""
-        except json.JSONDecodeError:
-            # If direct JSON parsing fails, try to extract JSON from the response
-            json_match = re.search(r'\{.*\}', response.text, re.DOTALL)
-            if json_match:
-                result = json.loads(json_match.group(0))
-                return {k: v for k, v in result.items() if v is not None}, ""
-            else:
-                return {}, "Could not parse the response as JSON"
-    except Exception as e:
-        return {}, f"Error processing image: {str(e)}"
+            with tracing.span('model', model=best[3], tier=tiers[0], input='image', comparison=True):
+                response = generate(MODELS[tiers[0]][1], 'image')
+            calls.append((best[3], 'image') + _token_usage(response) + (time.monotonic() - started,))
+            reference = parse_model_response(response.text)
+        except Exception as e:
+            print(f"Error running image-mode comparison: {e}")
+            reference, response = None, None
+        if reference is not None:
+            merge_known_fields(reference, known)
+            agreement = field_agreement(best[1], reference)
+            outcome = 'issues' if validate_extraction(reference, sections) else 'clean'
+            events.append(('image', outcome, time.monotonic() - started) + _token_usage(response))
+    
+    supplier = _supplier_key(best[1] if best else None, known)
+    if events:
+        _record_input_modes(supplier, events, agreement)
+    USAGE.record([(model_name, prompt_tokens, output_tokens, latency)
+                  for model_name, _, prompt_tokens, output_tokens, latency in calls],
+                 supplier=supplier, prompt=PROMPT_VERSION)
+    
+    if meta is not None:
+        meta['tiers_tried'] = tiers_tried
+        meta['model'] = best[3] if best else None
+        meta['input_mode'] = best[4] if best else None
+        meta['ocr_confidence'] = ocr['confidence'] if ocr else None
+        meta['tokens'] = {
+            'prompt': sum(call[2] for call in calls),
+            'output': sum(call[3] for call in calls)
+        }
+        meta['calls'] = [
+            {'model': model_name, 'input': mode, 'prompt_tokens': prompt_tokens, 'output_tokens': output_tokens,
+             'latency_ms': round(1000 * latency, 1)}
+            for model_name, mode, prompt_tokens, output_tokens, latency in calls
+        ]
+        meta['prompt_version'] = PROMPT_VERSION
+        meta['validation_issues'] = best[2] if best else []
+    
+    if best is None:
+        return {}, error_message
+    return best[1], ""
 
 def save_to_csv(data: Dict[str, str], csv_file: str) -> bool:
     """Save extracted data to CSV file."""
@@ -157,3 +630,28 @@ def save_to_csv(data: Dict[str, str], csv_file: str) -> bool:
     except Exception as e:
         print(f"Error saving to CSV: {e}")
         return False
+
+def flatten_invoice_data(data):
+    """Flatten nested invoice data for CSV export."""
+    if isinstance(data, Invoice):
+        return data.flatten()
+    
+    flattened = {}
+    
+    def flatten_dict(d, prefix=''):
+        for key, value in d.items():
+            if isinstance(value, dict):
+                flatten_dict(value, f"{prefix}{key}_")
+            elif isinstance(value, list):
+                if key == 'items':
+                    # Handle items array specially
+                    for i, item in enumerate(value):
+                        for item_key, item_value in item.items():
+                            flattened[f"item_{i+1}_{item_key}"] = item_value
+                else:
+                    flattened[f"{prefix}{key}"] = str(value)
+            else:
+                flattened[f"{prefix}{key}"] = value
+    
+    flatten_dict(data)
+    return flattened
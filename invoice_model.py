@@ -0,0 +1,294 @@
+"""Typed invoice model built once from the model's JSON answer.
+
+``Invoice.from_dict`` turns the nested dict returned by the model into
+``__slots__`` records with numeric fields already normalised to floats. The
+serialised JSON bytes and their SHA-256 digest are computed once and cached,
+so responses, webhook deliveries and equality checks reuse them instead of
+re-walking the dict. Treat an Invoice as immutable once built.
+
+Fields the model returns outside the schema are kept in ``extra`` so nothing
+is lost on the way through.
+"""
+import hashlib
+import json
+import re
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+
+# A currency prefix (₹, Rs., INR) or a unit, %, currency or "/-" suffix
+NUMBER_AFFIXES = re.compile(r'^(?:₹|rs\.?|inr)\s*|\s*(?:₹|/-|%|[a-z]+\.?)$', re.IGNORECASE)
+# Plain digits, or digits grouped with commas in the Indian or Western style
+NUMBER_PATTERN = re.compile(r'-?(?:(?:\d+|\d{1,3}(?:,\d{2,3})*,\d{3})(?:\.\d*)?|\.\d+)')
+
+
+def to_number(value) -> Optional[float]:
+    """Convert model output such as 5,54,400.00 or "Rs. 1,200" to a float.
+
+    Returns None rather than guessing when the separators are ambiguous, as in
+    1.200,00 or 1.200.00.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    sign = '-' if text.startswith('-') else ''
+    text = NUMBER_AFFIXES.sub('', text.lstrip('-').strip()).strip()
+    if not NUMBER_PATTERN.fullmatch(sign + text):
+        return None
+    return float((sign + text).replace(',', ''))
+
+
+class Record:
+    """A flat group of named fields; subclasses list them in FIELDS."""
+    __slots__ = ('extra', 'given')
+    FIELDS = ()
+    NUMERIC_FIELDS = frozenset()
+
+    def __init__(self, values: Optional[Dict] = None):
+        values = values or {}
+        for field in self.FIELDS:
+            value = values.get(field)
+            if field in self.NUMERIC_FIELDS:
+                # A value that is not clearly a number is kept as the model wrote it
+                number = to_number(value)
+                value = value if number is None and value not in (None, '') else number
+            setattr(self, field, value)
+        self.extra = {key: value for key, value in values.items() if key not in self.FIELDS} or None
+        # Schema fields the source dict actually had, even as null
+        self.given = frozenset(field for field in self.FIELDS if field in values)
+
+    def to_dict(self) -> Dict:
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        if self.extra:
+            data.update(sorted(self.extra.items()))
+        return data
+
+    def given_dict(self) -> Dict:
+        """Like to_dict(), but only the fields the source dict had."""
+        data = {field: getattr(self, field) for field in self.FIELDS if field in self.given}
+        if self.extra:
+            data.update(sorted(self.extra.items()))
+        return data
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+class CompanyInfo(Record):
+    __slots__ = FIELDS = (
+        'company_name', 'company_address', 'city', 'pincode', 'gstin', 'email', 'phone', 'website_url',
+        'pan_number', 'state_and_state_code', 'contact_person_name'
+    )
+
+
+class InvoiceInfo(Record):
+    __slots__ = FIELDS = (
+        'gst_invoice_number', 'invoice_date', 'invoice_type', 'challan_number', 'challan_date',
+        'purchase_order_number', 'purchase_order_date', 'place_of_supply', 'place_of_delivery',
+        'reverse_charge_applicable', 'e_invoice_irn', 'e_way_bill_number', 'qr_code'
+    )
+
+
+class BillingInfo(Record):
+    __slots__ = FIELDS = (
+        'billing_company_name', 'billing_address', 'billing_city', 'billing_pincode', 'billing_party_gstin',
+        'email_and_phone_of_buyer'
+    )
+
+
+class ShippingInfo(Record):
+    __slots__ = FIELDS = (
+        'shipping_company_name', 'shipping_address', 'shipping_city', 'shipping_pincode', 'shipping_party_gstin'
+    )
+
+
+class LineItem(Record):
+    __slots__ = FIELDS = (
+        'description_of_goods', 'hsn_code', 'quantity', 'uqc', 'weight', 'rate', 'amount', 'discount_per_item',
+        'taxable_value', 'batch_no', 'expiry_date', 'manufacturing_date'
+    )
+    NUMERIC_FIELDS = frozenset(('quantity', 'rate', 'amount', 'discount_per_item', 'taxable_value'))
+
+
+class TaxInfo(Record):
+    __slots__ = FIELDS = ('cgst', 'sgst', 'igst', 'cess_amount')
+    NUMERIC_FIELDS = frozenset(FIELDS)
+
+
+class Totals(Record):
+    __slots__ = FIELDS = ('invoice_amount', 'total_invoice')
+    NUMERIC_FIELDS = frozenset(FIELDS)
+
+
+class TransportInfo(Record):
+    __slots__ = FIELDS = ('transporter_details', 'vehicle_number', 'lr_number', 'transporter_id')
+
+
+class BankInfo(Record):
+    __slots__ = FIELDS = ('bank_details',)
+
+
+# Top-level sections in the order of the extraction prompt; 'items' sits
+# between shipping_info and tax_info
+SECTIONS = (
+    ('company_info', CompanyInfo),
+    ('invoice_info', InvoiceInfo),
+    ('billing_info', BillingInfo),
+    ('shipping_info', ShippingInfo),
+    ('items', LineItem),
+    ('tax_info', TaxInfo),
+    ('totals', Totals),
+    ('transport_info', TransportInfo),
+    ('bank_info', BankInfo),
+)
+SECTION_NAMES = tuple(name for name, _ in SECTIONS)
+
+
+class Invoice:
+    __slots__ = SECTION_NAMES + ('extra', '_json', '_digest')
+
+    def __init__(self, **sections):
+        for name, _ in SECTIONS:
+            setattr(self, name, sections.get(name))
+        self.extra = sections.get('extra')
+        self._json = None
+        self._digest = None
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Invoice':
+        """Build from the model's nested dict; absent sections stay None."""
+        sections = {}
+        for name, record_class in SECTIONS:
+            value = data.get(name)
+            if value is None:
+                continue
+            if name == 'items':
+                sections[name] = [LineItem(item) for item in value if isinstance(item, dict)]
+            elif isinstance(value, dict):
+                sections[name] = record_class(value)
+        sections['extra'] = {key: value for key, value in data.items() if key not in SECTION_NAMES} or None
+        return cls(**sections)
+
+    def to_dict(self) -> Dict:
+        """Plain nested dict in the shape the model returned (null sections omitted)."""
+        data = {}
+        for name in SECTION_NAMES:
+            section = getattr(self, name)
+            if section is None:
+                continue
+            data[name] = [item.to_dict() for item in section] if name == 'items' else section.to_dict()
+        if self.extra:
+            data.update(sorted(self.extra.items()))
+        return data
+
+    def to_json_bytes(self) -> bytes:
+        """Compact UTF-8 JSON, encoded on first use and cached."""
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return self._json
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 of the canonical JSON; equal digests mean equal invoices."""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.to_json_bytes()).hexdigest()
+        return self._digest
+
+    def __eq__(self, other):
+        return isinstance(other, Invoice) and self.digest == other.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __repr__(self):
+        return f'Invoice(digest={self.digest[:12]})'
+
+    def flatten(self) -> Dict:
+        """One flat row for CSV export.
+
+        Like flatten_invoice_data() on the source dict, only the keys it had
+        become columns, so absent schema fields add no empty columns.
+        """
+        row = {}
+        for name in SECTION_NAMES:
+            section = getattr(self, name)
+            if section is None:
+                continue
+            if name == 'items':
+                for i, item in enumerate(section, 1):
+                    for key, value in item.given_dict().items():
+                        row[f'item_{i}_{key}'] = value
+                continue
+            for key, value in section.given_dict().items():
+                if isinstance(value, dict):
+                    _flatten_into(row, value, f'{name}_{key}_')
+                else:
+                    row[f'{name}_{key}'] = str(value) if isinstance(value, list) else value
+        if self.extra:
+            _flatten_into(row, self.extra, '')
+        return row
+
+
+def _flatten_into(row, data, prefix):
+    for key, value in data.items():
+        if isinstance(value, dict):
+            _flatten_into(row, value, f'{prefix}{key}_')
+        else:
+            row[f'{prefix}{key}'] = str(value) if isinstance(value, list) else value
+
+
+INVOICE_COLUMNS = (
+    ('supplier_gstin', 'company_info', 'gstin'),
+    ('supplier_name', 'company_info', 'company_name'),
+    ('invoice_number', 'invoice_info', 'gst_invoice_number'),
+    ('invoice_date', 'invoice_info', 'invoice_date'),
+    ('buyer_gstin', 'billing_info', 'billing_party_gstin'),
+    ('invoice_amount', 'totals', 'invoice_amount'),
+    ('total_invoice', 'totals', 'total_invoice'),
+    ('cgst', 'tax_info', 'cgst'),
+    ('sgst', 'tax_info', 'sgst'),
+    ('igst', 'tax_info', 'igst'),
+    ('cess_amount', 'tax_info', 'cess_amount'),
+)
+NUMERIC_INVOICE_COLUMNS = frozenset(('invoice_amount', 'total_invoice', 'cgst', 'sgst', 'igst', 'cess_amount'))
+
+
+def to_columns(invoices: Iterable[Invoice]) -> Dict[str, Dict[str, List]]:
+    """Columnar view of many invoices and their line items.
+
+    Numeric columns are ``array('d')`` with NaN for missing values, so they can
+    be wrapped without copying (e.g. ``numpy.frombuffer``). Line items carry
+    the position of their invoice in ``invoice_index``.
+    """
+    nan = float('nan')
+    invoice_columns = {
+        column: array('d') if column in NUMERIC_INVOICE_COLUMNS else []
+        for column, _, _ in INVOICE_COLUMNS
+    }
+    item_columns = {
+        field: array('d') if field in LineItem.NUMERIC_FIELDS else []
+        for field in LineItem.FIELDS
+    }
+    item_columns['invoice_index'] = array('q')
+
+    for index, invoice in enumerate(invoices):
+        for column, section_name, field in INVOICE_COLUMNS:
+            section = getattr(invoice, section_name)
+            value = getattr(section, field) if section is not None else None
+            if column in NUMERIC_INVOICE_COLUMNS:
+                value = nan if value is None else value
+            invoice_columns[column].append(value)
+        for item in invoice.items or ():
+            for field in LineItem.FIELDS:
+                value = getattr(item, field)
+                if field in LineItem.NUMERIC_FIELDS:
+                    value = nan if value is None else value
+                item_columns[field].append(value)
+            item_columns['invoice_index'].append(index)
+
+    return {'invoices': invoice_columns, 'items': item_columns}
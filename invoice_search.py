@@ -0,0 +1,290 @@
+"""Inverted-index search over the extraction store.
+
+Documents are the invoices in ``InvoiceStore``; the index keeps, for every
+term, the documents containing it and a per-field weight (an invoice number or
+GSTIN match counts for more than a word of an address). Like the analytics
+columns it is extended incrementally from the store offset, so each new
+extraction is searchable as soon as it has been appended.
+
+A query term matches index terms that are equal, that it is a prefix of
+(search-as-you-type), or that are one edit away (typos). Typo candidates come
+from a deletion index: every term is also filed under each of its one-character
+deletions, so a misspelled query term finds its neighbours with a handful of
+dictionary lookups instead of a scan. Documents must match every query term
+that occurs in the index at all (so "that invoice from Hindcomp" is not sunk by
+"invoice"); if none do, documents matching any term are returned instead.
+"""
+import bisect
+import heapq
+import math
+import re
+import threading
+from typing import Dict, List
+
+from invoice_store import InvoiceStore
+
+# (section, field, weight) of the indexed header fields
+FIELD_WEIGHTS = (
+    ('invoice_info', 'gst_invoice_number', 5.0),
+    ('invoice_info', 'e_invoice_irn', 4.0),
+    ('company_info', 'gstin', 5.0),
+    ('billing_info', 'billing_party_gstin', 4.0),
+    ('shipping_info', 'shipping_party_gstin', 4.0),
+    ('company_info', 'company_name', 3.0),
+    ('billing_info', 'billing_company_name', 2.5),
+    ('shipping_info', 'shipping_company_name', 2.0),
+    ('company_info', 'company_address', 1.0),
+    ('company_info', 'city', 1.0),
+    ('billing_info', 'billing_address', 1.0),
+    ('billing_info', 'billing_city', 1.0),
+    ('shipping_info', 'shipping_address', 1.0),
+    ('shipping_info', 'shipping_city', 1.0),
+)
+ITEM_FIELD_WEIGHTS = (
+    ('hsn_code', 3.0),
+    ('description_of_goods', 2.0),
+)
+
+STOP_WORDS = frozenset(('a', 'an', 'and', 'at', 'by', 'for', 'from', 'in', 'of', 'on', 'or', 'that', 'the',
+                        'this', 'to', 'with'))
+
+EXACT_MATCH = 1.0
+PREFIX_MATCH = 0.8
+TYPO_MATCH = 0.6
+MAX_EXPANSIONS = 50  # prefix/typo candidates considered per query term
+MIN_PREFIX_LENGTH = 2
+MIN_TYPO_LENGTH = 4
+
+WORD_PATTERN = re.compile(r'[0-9a-z]+')
+
+
+def _stem(token):
+    # Plurals only: "valves" -> "valve", but not "glass" or "gst2s"
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss') and token.isalpha():
+        return token[:-1]
+    return token
+
+
+def tokenize(text) -> List[str]:
+    """Lower-cased word tokens; identifiers also yield their compact form."""
+    if text in (None, ''):
+        return []
+    text = str(text).lower()
+    words = WORD_PATTERN.findall(text)
+    tokens = [_stem(word) for word in words]
+    # "INV/23-24/001" is also indexed as "inv2324001" so it can be typed either way
+    if len(words) > 1 and ' ' not in text.strip():
+        tokens.append(''.join(words))
+    return tokens
+
+
+def _deletions(term):
+    return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+def edit_distance(a, b, limit=2) -> int:
+    """Damerau-Levenshtein (optimal string alignment) distance, capped at limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class SearchIndex:
+    def __init__(self, store: InvoiceStore):
+        self.store = store
+        self.offset = 0
+        self.docs = []  # per document: summary of the invoice and its store offset
+        self.postings = {}  # term -> {doc id: field weight}
+        self.sorted_terms = []
+        self.deletes = {}  # one-character deletion -> terms
+        self.digests = {}  # invoice digest -> doc id
+        self.irns = {}  # e-invoice IRN -> doc id
+        self.doc_ids = {}  # store offset of a document's current record -> doc id
+        self.lock = threading.RLock()
+
+    def refresh(self) -> int:
+        """Index store records appended since the last refresh; return how many."""
+        with self.lock:
+            if self.store.size() == self.offset:
+                return 0
+            added = 0
+            new_terms = []
+            for offset, next_offset, record in self.store.read_from(self.offset):
+                if self._add(offset, record, new_terms):
+                    added += 1
+                self.offset = next_offset
+            if new_terms:
+                # One sort per refresh instead of an insertion per term
+                self.sorted_terms.extend(new_terms)
+                self.sorted_terms.sort()
+            return added
+
+    def _add(self, offset, record, new_terms):
+        data = record.get('data') or {}
+        digest = record.get('digest')
+        # A backfilled record takes over the document of the record it replaces
+        doc_id = self.doc_ids.get(record.get('supersedes'))
+        if doc_id is None:
+            # Re-extractions of an identical invoice would only duplicate hits
+            if digest and digest in self.digests:
+                self.doc_ids[offset] = self.digests[digest]
+                return False
+            doc_id = len(self.docs)
+        self.digests[digest] = doc_id
+        self.doc_ids[offset] = doc_id
+
+        weights = {}
+        for section, field, weight in FIELD_WEIGHTS:
+            for term in tokenize((data.get(section) or {}).get(field)):
+                weights[term] = max(weights.get(term, 0.0), weight)
+        for item in data.get('items') or []:
+            if not isinstance(item, dict):
+                continue
+            for field, weight in ITEM_FIELD_WEIGHTS:
+                for term in tokenize(item.get(field)):
+                    weights[term] = max(weights.get(term, 0.0), weight)
+
+        for term, weight in weights.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                new_terms.append(term)
+                if len(term) >= MIN_TYPO_LENGTH:
+                    for deletion in _deletions(term):
+                        self.deletes.setdefault(deletion, set()).add(term)
+            postings[doc_id] = weight
+
+        company_info = data.get('company_info') or {}
+        invoice_info = data.get('invoice_info') or {}
+        irn = str(invoice_info.get('e_invoice_irn') or '').strip().lower()
+        if irn:
+            self.irns.setdefault(irn, doc_id)
+        doc = {
+            'offset': offset,
+            'supplier': company_info.get('company_name'),
+            'gstin': company_info.get('gstin'),
+            'invoice_number': invoice_info.get('gst_invoice_number'),
+            'invoice_date': invoice_info.get('invoice_date'),
+            'total_invoice': (data.get('totals') or {}).get('total_invoice'),
+            'extracted_at': record.get('extracted_at'),
+            'filename': record.get('filename'),
+            'mode': record.get('mode', 'full')
+        }
+        if doc_id < len(self.docs):
+            # Terms only the replaced record had still match the document
+            self.docs[doc_id] = doc
+            return False
+        self.docs.append(doc)
+        return True
+
+    def find_irn(self, irn: str):
+        """The stored record of an e-invoice IRN, if it was extracted before."""
+        self.refresh()
+        with self.lock:
+            doc_id = self.irns.get(irn.strip().lower())
+            doc = self.docs[doc_id] if doc_id is not None else None
+        if doc is None:
+            return None
+        return self.store.read_record(doc['offset'])
+
+    def _candidates(self, token) -> Dict[str, float]:
+        """Index terms a query token matches, with their match weight."""
+        candidates = {}
+        if token in self.postings:
+            candidates[token] = EXACT_MATCH
+
+        if len(token) >= MIN_PREFIX_LENGTH:
+            start = bisect.bisect_left(self.sorted_terms, token)
+            for term in self.sorted_terms[start:start + MAX_EXPANSIONS]:
+                if not term.startswith(token):
+                    break
+                candidates.setdefault(term, PREFIX_MATCH)
+
+        if len(token) >= MIN_TYPO_LENGTH:
+            # Terms sharing a one-character deletion with the token (or equal
+            # to one of its deletions, or having it as a deletion)
+            probes = _deletions(token) | {token}
+            found = set()
+            for probe in probes:
+                found |= self.deletes.get(probe, set())
+                if probe in self.postings:
+                    found.add(probe)
+            for term in sorted(found)[:MAX_EXPANSIONS]:
+                if term not in candidates and edit_distance(token, term, 1) <= 1:
+                    candidates[term] = TYPO_MATCH
+        return candidates
+
+    def search(self, query: str, page: int = 1, per_page: int = 20, include_data: bool = False) -> Dict:
+        """Ranked, paginated hits for a free-text query."""
+        self.refresh()
+        tokens = [token for token in dict.fromkeys(tokenize_query(query)) if token not in STOP_WORDS]
+
+        with self.lock:
+            total_docs = len(self.docs)
+            token_scores = []
+            ignored = []
+            for token in tokens:
+                scores = {}
+                for term, match_weight in self._candidates(token).items():
+                    postings = self.postings[term]
+                    idf = math.log(1 + total_docs / len(postings))
+                    for doc_id, field_weight in postings.items():
+                        score = match_weight * field_weight * idf
+                        if score > scores.get(doc_id, 0.0):
+                            scores[doc_id] = score
+                if scores:
+                    token_scores.append(scores)
+                else:
+                    ignored.append(token)
+
+            match = 'all'
+            combined = {}
+            if token_scores:
+                smallest = min(token_scores, key=len)
+                for doc_id in smallest:
+                    if all(doc_id in scores for scores in token_scores):
+                        combined[doc_id] = sum(scores[doc_id] for scores in token_scores)
+                if not combined and len(token_scores) > 1:
+                    match = 'any'
+                    for scores in token_scores:
+                        for doc_id, score in scores.items():
+                            combined[doc_id] = combined.get(doc_id, 0.0) + score
+
+            # Best score first; newer extractions win ties
+            top = heapq.nlargest(page * per_page, combined.items(), key=lambda entry: (entry[1], entry[0]))
+            hits = []
+            for doc_id, score in top[(page - 1) * per_page:]:
+                hit = dict(self.docs[doc_id], id=doc_id, score=round(score, 3))
+                hits.append(hit)
+
+        if include_data:
+            for hit in hits:
+                record = self.store.read_record(hit['offset'])
+                hit['data'] = record.get('data') if record else None
+
+        return {
+            'query': query,
+            'terms': [token for token in tokens if token not in ignored],
+            'ignored_terms': ignored,
+            'match': match,
+            'total': len(combined),
+            'page': page,
+            'per_page': per_page,
+            'hits': hits
+        }
+
+
+def tokenize_query(query) -> List[str]:
+    # Query identifiers are matched piece by piece, so no compact form is added
+    return [_stem(word) for word in WORD_PATTERN.findall(str(query or '').lower())]
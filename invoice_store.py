@@ -0,0 +1,114 @@
+"""Append-only store of every extraction produced by the API.
+
+Each extraction is one JSON line in ``uploads/extractions.jsonl``. Readers such
+as the analytics and search indexes remember the byte offset they have
+consumed up to and call ``read_from(offset)`` to pick up only the new records,
+so they can be kept current incrementally without rescanning the file. A torn
+final line (a crash mid-write) is ignored until it is completed.
+
+The uploaded images are kept in ``uploads/sources``, named by content hash,
+so stored extractions can be re-run later (see backfill.py). A re-extraction
+is appended with ``supersedes`` set to the offset of the record it replaces.
+"""
+import json
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, Iterator, Optional, Tuple
+
+from invoice_model import Invoice
+
+STORE_FILE = os.environ.get('INVOICE_STORE_FILE', os.path.join('uploads', 'extractions.jsonl'))
+SOURCE_DIR = os.environ.get('SOURCE_IMAGE_DIR', os.path.join('uploads', 'sources'))
+RETAIN_SOURCES = os.environ.get('RETAIN_SOURCE_IMAGES', '1') != '0'
+
+
+class InvoiceStore:
+    def __init__(self, path: str = STORE_FILE, source_dir: str = SOURCE_DIR):
+        self.path = path
+        self.source_dir = source_dir
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def append(self, invoice: Invoice, sha256: Optional[str] = None, **meta) -> int:
+        """Append one extraction and return the byte offset of its record."""
+        record = {
+            'extracted_at': datetime.now().isoformat(),
+            'sha256': sha256,
+            'digest': invoice.digest
+        }
+        record.update(meta)
+        # The invoice's cached JSON is spliced in rather than re-encoded
+        head = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        line = head[:-1] + b',"data":' + invoice.to_json_bytes() + b'}\n'
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write(line)
+        return offset
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def read_from(self, offset: int = 0) -> Iterator[Tuple[int, int, Dict]]:
+        """Yield (offset, next_offset, record) for complete records after offset."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                next_offset = offset + len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(f"Skipping unreadable record at offset {offset} in {self.path}")
+                else:
+                    yield offset, next_offset, record
+                offset = next_offset
+
+    def read_record(self, offset: int) -> Optional[Dict]:
+        """Read the single record starting at offset."""
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            line = f.readline()
+        return json.loads(line) if line.endswith(b'\n') else None
+
+    def retain_source(self, path: str, sha256: str, extension: str) -> Optional[str]:
+        """Keep a copy of an uploaded image under its content hash; return its path."""
+        if not RETAIN_SOURCES or not sha256:
+            return None
+        directory = os.path.join(self.source_dir, sha256[:2])
+        target = os.path.join(directory, f'{sha256}.{extension}')
+        if os.path.exists(target):
+            return target
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f'{target}.{uuid.uuid4().hex}.tmp'
+        try:
+            try:
+                os.link(path, temp_path)
+            except OSError:
+                shutil.copyfile(path, temp_path)
+            os.replace(temp_path, target)
+        except OSError as e:
+            print(f"Error keeping source image {sha256}: {e}")
+            return None
+        return target
+
+    def source_path(self, sha256: str) -> Optional[str]:
+        """Path of the kept image with this content hash, or None."""
+        directory = os.path.join(self.source_dir, str(sha256)[:2])
+        if not sha256 or not os.path.isdir(directory):
+            return None
+        for name in os.listdir(directory):
+            if name.startswith(f'{sha256}.') and not name.endswith('.tmp'):
+                return os.path.join(directory, name)
+        return None
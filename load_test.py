@@ -0,0 +1,481 @@
+"""End-to-end load generator for the Flask API.
+
+``run`` starts the API in a child process with the Gemini model replaced by a
+local fake (log-normal latency, canned invoice JSON) and every webhook pointed
+at a local sink server, then drives /api/extract, /api/download-csv and the
+webhook endpoints with either an open-loop (Poisson arrivals at --rate) or a
+closed-loop (--concurrency users back to back) workload. It reports
+throughput, latency percentiles, error and shed rates per endpoint, webhook
+deliveries received, and the server's RSS, thread count and open files, and
+can compare the report against a previous run.
+
+Usage:
+    python load_test.py run --mode open --rate 20 --duration 60 --output run.json
+    python load_test.py run --mode closed --concurrency 16 --compare run.json
+    python load_test.py serve --port 5055   # the fake-model server on its own
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+SAMPLE_INVOICE = {
+    "company_info": {"company_name": "Load Test Supplies Pvt Ltd", "gstin": "24AAKCS3881N1ZQ",
+                     "city": "Vapi", "pincode": "396195"},
+    "invoice_info": {"gst_invoice_number": "LT-0001", "invoice_date": "2025-08-08"},
+    "billing_info": {"billing_company_name": "Sandhya Organic Chemicals Pvt Ltd",
+                     "billing_party_gstin": "24AAKCS3881N1ZQ"},
+    "items": [
+        {"description_of_goods": "Aluminium Bottle 1 Kg", "hsn_code": "76129010", "quantity": 100,
+         "rate": 44.0, "amount": 4400.0, "taxable_value": 4400.0},
+        {"description_of_goods": "Compressor Valve", "hsn_code": "84818090", "quantity": 2,
+         "rate": 800.0, "amount": 1600.0, "taxable_value": 1600.0}
+    ],
+    "tax_info": {"cgst": 540.0, "sgst": 540.0, "igst": None, "cess_amount": None},
+    "totals": {"invoice_amount": 6000.0, "total_invoice": 7080.0}
+}
+
+# Relative share of each endpoint in the generated traffic
+DEFAULT_MIX = {'extract': 0.7, 'download_csv': 0.15, 'webhooks': 0.1, 'webhook_logs': 0.05}
+
+
+# ---------------------------------------------------------------------------
+# Server side: the API with a fake model
+# ---------------------------------------------------------------------------
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """Stands in for genai.GenerativeModel with a realistic latency distribution."""
+
+    def __init__(self, median_seconds, sigma, error_rate):
+        self.mu = math.log(median_seconds)
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    def generate_content(self, parts):
+        time.sleep(random.lognormvariate(self.mu, self.sigma))
+        if random.random() < self.error_rate:
+            raise RuntimeError('Fake model error')
+        invoice = json.loads(json.dumps(SAMPLE_INVOICE))
+        invoice['invoice_info']['gst_invoice_number'] = f"LT-{random.randint(0, 10 ** 6):06d}"
+        return _FakeResponse(json.dumps(invoice))
+
+
+def serve(args):
+    import invoice_extractor_server
+    import webhooks
+
+    invoice_extractor_server.MODELS = [
+        (name, FakeModel(args.fake_latency_median, args.fake_latency_sigma, args.fake_error_rate))
+        for name in invoice_extractor_server.MODEL_CASCADE
+    ]
+    invoice_extractor_server.MODEL = invoice_extractor_server.MODELS[0][1]
+    if args.webhook_config:
+        webhooks.WEBHOOK_CONFIG_FILE = args.webhook_config
+
+    import app
+    print(f"Load-test server on port {args.port} (fake model median {args.fake_latency_median}s)", flush=True)
+    app.app.run(host='127.0.0.1', port=args.port, threaded=True)
+
+
+# ---------------------------------------------------------------------------
+# Harness side
+# ---------------------------------------------------------------------------
+
+class WebhookSink:
+    """Local HTTP server that accepts and counts webhook deliveries."""
+
+    def __init__(self):
+        sink = self
+        self.received = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with sink.lock:
+                    sink.received += 1
+                    sink.bytes += len(body)
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/webhook'
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def build_corpus(corpus_dir, count):
+    """Load invoice images from a folder, or render synthetic ones."""
+    if corpus_dir:
+        images = []
+        for name in sorted(os.listdir(corpus_dir)):
+            path = os.path.join(corpus_dir, name)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    images.append((name, f.read()))
+        if not images:
+            raise SystemExit(f"No files found in corpus folder {corpus_dir}")
+        return images
+
+    from PIL import Image, ImageDraw
+    images = []
+    for i in range(count):
+        image = Image.new('RGB', (1240, 1754), 'white')
+        draw = ImageDraw.Draw(image)
+        draw.text((80, 80), f"TAX INVOICE No. LT-{i:04d}", fill='black')
+        for line in range(40):
+            draw.text((80, 160 + line * 36), f"Item {line}  HSN 7612{line:04d}  Qty {line + 1}  Rate 44.00", fill='black')
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=85)
+        images.append((f'synthetic_{i}.jpg', buffer.getvalue()))
+    return images
+
+
+class ResourceSampler:
+    """Samples RSS, threads and open files of a process from /proc."""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _sample(self):
+        status = {}
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                status[key] = value.strip()
+        return {
+            'rss_mb': int(status['VmRSS'].split()[0]) / 1024,
+            'threads': int(status['Threads']),
+            'open_files': len(os.listdir(f'/proc/{self.pid}/fd'))
+        }
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.samples.append(self._sample())
+            except (OSError, KeyError, ValueError):
+                pass  # not on Linux, or the process is gone
+            self.stop_event.wait(self.interval)
+
+    def report(self):
+        self.stop_event.set()
+        if not self.samples:
+            return None
+        return {
+            metric: {
+                'mean': round(sum(sample[metric] for sample in self.samples) / len(self.samples), 1),
+                'max': round(max(sample[metric] for sample in self.samples), 1)
+            }
+            for metric in ('rss_mb', 'threads', 'open_files')
+        }
+
+
+class LoadGenerator:
+    def __init__(self, base_url, corpus, mix, repeat_ratio, priority):
+        self.base_url = base_url
+        self.corpus = corpus
+        self.mix = mix
+        self.repeat_ratio = repeat_ratio
+        self.priority = priority
+        self.local = threading.local()
+        self.results = []
+        self.lock = threading.Lock()
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def pick_endpoint(self):
+        return random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+
+    def one_request(self, arrival=None):
+        """Issue one request; latency counts from arrival if it queued client-side."""
+        endpoint = self.pick_endpoint()
+        session = self.session()
+        started = arrival if arrival is not None else time.monotonic()
+        status = None
+        try:
+            if endpoint == 'extract':
+                name, data = random.choice(self.corpus)
+                if random.random() >= self.repeat_ratio:
+                    # Trailing bytes keep the image valid but defeat result caching
+                    data = data + os.urandom(16)
+                headers = {'X-Priority': self.priority} if self.priority else {}
+                response = session.post(f'{self.base_url}/api/extract', files={'file': (name, data)},
+                                        headers=headers, timeout=300)
+            elif endpoint == 'download_csv':
+                response = session.post(f'{self.base_url}/api/download-csv', json=SAMPLE_INVOICE, timeout=60)
+            elif endpoint == 'webhooks':
+                response = session.get(f'{self.base_url}/api/webhooks', timeout=60)
+            else:
+                response = session.get(f'{self.base_url}/api/webhook-logs', timeout=60)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        latency = time.monotonic() - started
+        with self.lock:
+            self.results.append((endpoint, status, latency, time.monotonic()))
+
+    def run_closed(self, concurrency, duration):
+        deadline = time.monotonic() + duration
+
+        def user():
+            while time.monotonic() < deadline:
+                self.one_request()
+
+        threads = [threading.Thread(target=user) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open(self, rate, duration, max_in_flight):
+        # Poisson arrivals; requests beyond max_in_flight queue client-side
+        # and that queueing is included in their latency, as a user would see it
+        deadline = time.monotonic() + duration
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            next_arrival = time.monotonic()
+            while next_arrival < deadline:
+                delay = next_arrival - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.one_request, time.monotonic())
+                next_arrival += random.expovariate(rate)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(results, elapsed):
+    report = {'elapsed_s': round(elapsed, 2), 'total_requests': len(results), 'endpoints': {}}
+    for endpoint in sorted({r[0] for r in results}):
+        rows = [r for r in results if r[0] == endpoint]
+        latencies = sorted(r[2] for r in rows)
+        statuses = {}
+        for r in rows:
+            statuses[str(r[1])] = statuses.get(str(r[1]), 0) + 1
+        ok = sum(1 for r in rows if isinstance(r[1], int) and r[1] < 400)
+        shed = sum(1 for r in rows if r[1] == 503)
+        report['endpoints'][endpoint] = {
+            'requests': len(rows),
+            'throughput_rps': round(ok / elapsed, 2),
+            'error_rate': round(1 - ok / len(rows), 4),
+            'shed_rate': round(shed / len(rows), 4),
+            'status_codes': statuses,
+            'latency_ms': {
+                name: round(1000 * percentile(latencies, fraction), 1)
+                for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))
+            }
+        }
+    ok_total = sum(1 for r in results if isinstance(r[1], int) and r[1] < 400)
+    report['throughput_rps'] = round(ok_total / elapsed, 2)
+    return report
+
+
+def compare(report, baseline):
+    """Print per-endpoint deltas against a previous report."""
+    print("\nComparison with baseline:")
+    print(f"  throughput: {baseline.get('throughput_rps')} -> {report.get('throughput_rps')} rps")
+    for endpoint, current in report['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(endpoint)
+        if not previous:
+            continue
+        for name in ('p50', 'p95', 'p99'):
+            before, after = previous['latency_ms'][name], current['latency_ms'][name]
+            change = f"{100 * (after - before) / before:+.1f}%" if before else 'n/a'
+            print(f"  {endpoint:13} {name}: {before}ms -> {after}ms ({change})")
+        print(f"  {endpoint:13} errors: {previous['error_rate']} -> {current['error_rate']}")
+    for metric in ('rss_mb', 'threads', 'open_files'):
+        before = (baseline.get('server_resources') or {}).get(metric, {}).get('max')
+        after = (report.get('server_resources') or {}).get(metric, {}).get('max')
+        print(f"  server {metric} max: {before} -> {after}")
+
+
+def wait_for_server(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("Server exited during startup")
+        try:
+            if requests.get(f'{base_url}/api/health', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("Server did not become healthy in time")
+
+
+def run(args):
+    sink = WebhookSink()
+    config_dir = tempfile.mkdtemp(prefix='invoice_load_test_')
+    webhook_config = os.path.join(config_dir, 'webhook_config.json')
+    webhooks = [
+        {'id': i + 1, 'name': f'Load Sink {i + 1}', 'url': sink.url, 'enabled': True,
+         'headers': {'X-Sink': str(i)}, 'gzip': args.gzip_webhooks}
+        for i in range(args.webhooks)
+    ]
+    # Endpoints that never answer, to exercise timeouts and circuit breaking
+    webhooks += [
+        {'id': len(webhooks) + i + 1, 'name': f'Dead {i + 1}', 'url': f'http://10.255.255.1:9/dead{i}',
+         'enabled': True, 'headers': {}}
+        for i in range(args.dead_webhooks)
+    ]
+    with open(webhook_config, 'w') as f:
+        json.dump({'webhooks': webhooks}, f)
+
+    port = args.port or random.randint(20000, 40000)
+    base_url = f'http://127.0.0.1:{port}'
+    command = [
+        sys.executable, os.path.abspath(__file__), 'serve', '--port', str(port),
+        '--webhook-config', webhook_config,
+        '--fake-latency-median', str(args.fake_latency_median),
+        '--fake-latency-sigma', str(args.fake_latency_sigma),
+        '--fake-error-rate', str(args.fake_error_rate)
+    ]
+    # Everything the server stores goes to the temp dir, not the real uploads/
+    env = dict(os.environ)
+    env.update({
+        'INVOICE_STORE_FILE': os.path.join(config_dir, 'extractions.jsonl'),
+        'SOURCE_IMAGE_DIR': os.path.join(config_dir, 'sources'),
+        'ANALYTICS_DIR': os.path.join(config_dir, 'analytics'),
+        'USAGE_DB': os.path.join(config_dir, 'usage.db'),
+        'TRACE_LOG_FILE': os.path.join(config_dir, 'traces.jsonl'),
+        'PROFILE_DIR': os.path.join(config_dir, 'profiles'),
+        'WORK_QUEUE_URL': 'sqlite:///' + os.path.join(config_dir, 'work_queue.db'),
+        'WORK_QUEUE_FILES_DIR': os.path.join(config_dir, 'queue_files'),
+    })
+    env.pop('OTEL_EXPORT_FILE', None)
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                               stdout=subprocess.DEVNULL if not args.server_output else None,
+                               stderr=subprocess.DEVNULL if not args.server_output else None)
+    try:
+        wait_for_server(base_url, process)
+        corpus = build_corpus(args.corpus, args.corpus_size)
+        mix = json.loads(args.mix) if args.mix else DEFAULT_MIX
+        generator = LoadGenerator(base_url, corpus, mix, args.repeat_ratio, args.priority)
+        sampler = ResourceSampler(process.pid)
+
+        print(f"Running {args.mode}-loop load for {args.duration}s against {base_url}...")
+        started = time.monotonic()
+        if args.mode == 'open':
+            generator.run_open(args.rate, args.duration, args.max_in_flight)
+        else:
+            generator.run_closed(args.concurrency, args.duration)
+        elapsed = time.monotonic() - started
+
+        # Give asynchronous webhook deliveries a moment to land
+        time.sleep(args.drain)
+        report = summarize(generator.results, elapsed)
+        report['config'] = {
+            key: getattr(args, key) for key in (
+                'mode', 'rate', 'concurrency', 'duration', 'repeat_ratio', 'priority', 'webhooks',
+                'dead_webhooks', 'gzip_webhooks', 'fake_latency_median', 'fake_latency_sigma', 'fake_error_rate'
+            )
+        }
+        report['server_resources'] = sampler.report()
+        report['webhook_sink'] = {
+            'received': sink.received,
+            'bytes': sink.bytes,
+            'per_second': round(sink.received / (elapsed + args.drain), 2)
+        }
+        try:
+            report['server_metrics'] = requests.get(f'{base_url}/api/metrics', timeout=5).json()
+        except (requests.RequestException, ValueError):
+            report['server_metrics'] = None
+    finally:
+        process.terminate()
+        process.wait()
+        sink.close()
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+    print(json.dumps({key: value for key, value in report.items() if key != 'server_metrics'}, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the invoice extractor API.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_fake_model_options(sub):
+        sub.add_argument('--fake-latency-median', type=float, default=2.5, help='Median fake model latency (s)')
+        sub.add_argument('--fake-latency-sigma', type=float, default=0.5, help='Log-normal sigma of the latency')
+        sub.add_argument('--fake-error-rate', type=float, default=0.0, help='Fraction of fake model calls that fail')
+
+    serve_parser = subparsers.add_parser('serve', help='Run the API with a fake model')
+    serve_parser.add_argument('--port', type=int, default=5055)
+    serve_parser.add_argument('--webhook-config', help='Webhook config file to use instead of webhook_config.json')
+    add_fake_model_options(serve_parser)
+
+    run_parser = subparsers.add_parser('run', help='Start a fake-model server and drive load against it')
+    run_parser.add_argument('--mode', choices=['open', 'closed'], default='open')
+    run_parser.add_argument('--rate', type=float, default=10.0, help='Open loop: mean arrivals per second')
+    run_parser.add_argument('--max-in-flight', type=int, default=256, help='Open loop: client-side concurrency cap')
+    run_parser.add_argument('--concurrency', type=int, default=8, help='Closed loop: number of users')
+    run_parser.add_argument('--duration', type=float, default=30.0, help='Seconds of load')
+    run_parser.add_argument('--drain', type=float, default=2.0, help='Seconds to wait for webhooks after the run')
+    run_parser.add_argument('--mix', help='JSON endpoint weights, e.g. \'{"extract": 1}\'')
+    run_parser.add_argument('--corpus', help='Folder of sample invoice images (default: synthetic images)')
+    run_parser.add_argument('--corpus-size', type=int, default=20, help='Number of synthetic images')
+    run_parser.add_argument('--repeat-ratio', type=float, default=0.0,
+                            help='Fraction of uploads sent byte-identical (exercises caching/coalescing)')
+    run_parser.add_argument('--priority', choices=['interactive', 'bulk'], help='X-Priority for extract calls')
+    run_parser.add_argument('--webhooks', type=int, default=1, help='Webhook subscribers pointing at the sink')
+    run_parser.add_argument('--dead-webhooks', type=int, default=0, help='Subscribers that never answer')
+    run_parser.add_argument('--gzip-webhooks', action='store_true', help='Deliver to the sink gzipped')
+    run_parser.add_argument('--port', type=int, help='Server port (default: random)')
+    run_parser.add_argument('--server-output', action='store_true', help="Show the server's output")
+    run_parser.add_argument('--output', help='Write the JSON report here')
+    run_parser.add_argument('--compare', help='Previous JSON report to compare against')
+    add_fake_model_options(run_parser)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
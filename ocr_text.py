@@ -0,0 +1,158 @@
+"""Local OCR of invoice images for the text input mode.
+
+Sending the model the OCR text of an invoice instead of its pixels costs far
+fewer input tokens and is usually faster. Tesseract (via ``pytesseract``) reads
+the page, and the words are laid out again line by line. Each run of words is
+prefixed with its ``[x,y]`` pixel position, so the model can still tell
+columns, tables and the header blocks apart. If the mean word confidence is
+below ``OCR_MIN_CONFIDENCE``, the extractor falls back to sending the image.
+
+``OCR_MODE`` selects the input mode: ``image`` (the default, no OCR), ``text``
+(always send OCR text when there is any) or ``auto`` (send text when the OCR is
+confident). Use ``OCR_SUPPLIER_MODES`` to override the mode per supplier GSTIN,
+e.g. ``27AAPFU0939F1ZV=image,29AABCT1332L1ZA=text``. The supplier is taken
+from the e-invoice QR code when there is one. Otherwise it is the first
+GSTIN in the OCR text that has an override. Any override other than ``image``
+therefore means every invoice without a QR code is OCRed to look for its
+supplier, even with ``OCR_MODE=image``.
+"""
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+OCR_MODE = os.getenv('OCR_MODE', 'image').lower()
+OCR_MIN_CONFIDENCE = float(os.getenv('OCR_MIN_CONFIDENCE', 80))
+OCR_MIN_WORDS = int(os.getenv('OCR_MIN_WORDS', 20))
+OCR_LANGUAGE = os.getenv('OCR_LANGUAGE', 'eng')
+# Fraction of text-mode extractions also run in image mode to measure agreement
+OCR_COMPARE_RATE = float(os.getenv('OCR_COMPARE_RATE', 0))
+
+SUPPLIER_MODES = {}
+for entry in os.getenv('OCR_SUPPLIER_MODES', '').split(','):
+    gstin, _, mode = entry.partition('=')
+    if gstin.strip() and mode.strip().lower() in ('image', 'text', 'auto'):
+        SUPPLIER_MODES[gstin.strip().upper()] = mode.strip().lower()
+
+GSTIN_IN_TEXT = re.compile(r'(?<![0-9A-Z])[0-9]{2}[0-9A-Z]{10}[0-9A-Z]Z[0-9A-Z](?![0-9A-Z])')
+
+# Words further apart than this many character widths start a new segment
+SEGMENT_GAP = 2.5
+
+TEXT_MODE_NOTE = (
+    "The invoice is given as OCR text instead of an image. Each line of the page is one line below; "
+    "each run of words is prefixed with its [x,y] pixel position (the page is {width}x{height} pixels). "
+    "OCR may misread some characters, so correct obvious errors in numbers using the totals."
+)
+
+
+def input_mode_for(supplier_gstin: Optional[str] = None) -> str:
+    """The configured input mode for a supplier: 'image', 'text' or 'auto'."""
+    if supplier_gstin:
+        mode = SUPPLIER_MODES.get(str(supplier_gstin).strip().upper())
+        if mode:
+            return mode
+    return OCR_MODE if OCR_MODE in ('text', 'auto') else 'image'
+
+
+def needs_ocr(supplier_gstin: Optional[str] = None) -> bool:
+    """Whether to OCR the page: for text input, or to find an unknown supplier."""
+    if input_mode_for(supplier_gstin) != 'image':
+        return True
+    return not supplier_gstin and any(mode != 'image' for mode in SUPPLIER_MODES.values())
+
+
+def supplier_in_text(text: str) -> Optional[str]:
+    """First GSTIN in OCR text, in reading order, that has a per-supplier mode.
+
+    The supplier's GSTIN is normally printed in the header, above the buyer's.
+    """
+    for match in GSTIN_IN_TEXT.finditer(text.upper()):
+        if match.group() in SUPPLIER_MODES:
+            return match.group()
+    return None
+
+
+def layout_text(data: Dict[str, List]) -> Dict:
+    """Lay out pytesseract.image_to_data() output as positioned text lines.
+
+    Returns {'text', 'confidence', 'words'}; confidence is the mean word
+    confidence (0-100) weighted by word length.
+    """
+    lines = {}
+    weighted, characters = 0.0, 0
+    for i, word in enumerate(data['text']):
+        word = (word or '').strip()
+        confidence = float(data['conf'][i])
+        if not word or confidence < 0:
+            continue
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        lines.setdefault(key, []).append((data['left'][i], data['top'][i], data['width'][i], word))
+        weighted += confidence * len(word)
+        characters += len(word)
+
+    rows = []
+    for words in lines.values():
+        words.sort()
+        segments = []
+        for left, top, width, word in words:
+            if segments:
+                last = segments[-1]
+                char_width = last['width'] / max(1, len(last['text']))
+                if left - last['right'] <= SEGMENT_GAP * char_width:
+                    last['text'] += ' ' + word
+                    last['width'] += width
+                    last['right'] = left + width
+                    continue
+            segments.append({'x': left, 'y': top, 'text': word, 'width': width, 'right': left + width})
+        rows.append((segments[0]['y'], segments[0]['x'], segments))
+
+    # Top to bottom, then left to right
+    rows.sort(key=lambda row: (row[0], row[1]))
+    text = '\n'.join(
+        '  '.join(f"[{segment['x']},{segment['y']}] {segment['text']}" for segment in segments)
+        for _, _, segments in rows
+    )
+    return {
+        'text': text,
+        'confidence': round(weighted / characters, 1) if characters else 0.0,
+        'words': sum(len(segment['text'].split()) for _, _, segments in rows for segment in segments)
+    }
+
+
+def read_layout(image_path: str, mime_type: str = 'image/jpeg') -> Optional[Dict]:
+    """OCR an invoice image; None if OCR is unavailable or fails.
+
+    Returns {'text', 'confidence', 'words', 'width', 'height', 'seconds'}.
+    PDFs are not read.
+    """
+    if pytesseract is None or mime_type == 'application/pdf':
+        return None
+    started = time.monotonic()
+    try:
+        with Image.open(image_path) as image:
+            image = image.convert('L')
+            data = pytesseract.image_to_data(image, lang=OCR_LANGUAGE, output_type=pytesseract.Output.DICT)
+            width, height = image.size
+    except Exception as e:
+        print(f"Error running OCR on {image_path}: {e}")
+        return None
+    result = layout_text(data)
+    result.update(width=width, height=height, seconds=time.monotonic() - started)
+    return result
+
+
+def is_usable(ocr: Optional[Dict], mode: str) -> bool:
+    """Whether OCR output may replace the image for the given input mode."""
+    if not ocr or mode == 'image' or not ocr['text']:
+        return False
+    if mode == 'text':
+        return True
+    return ocr['confidence'] >= OCR_MIN_CONFIDENCE and ocr['words'] >= OCR_MIN_WORDS
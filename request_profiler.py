@@ -0,0 +1,233 @@
+"""Opt-in profiling of individual API requests.
+
+A request is profiled when it carries ``X-Profile: <PROFILE_ADMIN_TOKEN>`` or
+is picked by ``PROFILE_SAMPLE_RATE``. Otherwise the only cost is one header
+lookup and one comparison per request.
+
+There are two profilers:
+
+- ``sampler`` (the default) is a stack sampler. It records the request thread
+  and any scheduler worker threads running jobs for the request every
+  ``PROFILE_INTERVAL_MS``, and writes collapsed stacks
+  (``frame;frame;frame count``) for flamegraph.pl or speedscope.
+- ``cprofile`` traces every call in those threads and writes a pstats file for
+  ``python -m pstats`` or snakeviz. It is exact but slows the request down.
+
+``X-Profile-Mode`` picks one per request. Profiles go to ``PROFILE_DIR``, and
+only the newest ``PROFILE_RING_SIZE`` are kept.
+"""
+import contextvars
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sampler')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', 5)) / 1000
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join('uploads', 'profiles'))
+PROFILE_RING_SIZE = int(os.environ.get('PROFILE_RING_SIZE', 50))
+
+PROFILE_MODES = ('sampler', 'cprofile')
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{8}T[0-9]{12}-[0-9a-f]{8}$')
+EXTENSIONS = {'sampler': 'collapsed', 'cprofile': 'pstats'}
+
+_current_profile = contextvars.ContextVar('request_profile', default=None)
+
+
+def is_admin(token: Optional[str]) -> bool:
+    """Whether a header value is the profiling admin token."""
+    return bool(PROFILE_ADMIN_TOKEN) and bool(token) and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN)
+
+
+def should_profile(header: Optional[str]) -> bool:
+    """Profile a request that asks with the admin token, or one in the sample."""
+    if header is not None:
+        return is_admin(header)
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def current_profile() -> Optional['RequestProfile']:
+    return _current_profile.get()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class RequestProfile:
+    def __init__(self, endpoint: str, mode: str = PROFILE_MODE, interval: float = PROFILE_INTERVAL, **details):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Invalid profile mode '{mode}'. Use one of: {', '.join(PROFILE_MODES)}")
+        self.profile_id = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+        self.endpoint = endpoint
+        self.mode = mode
+        self.interval = interval
+        self.details = details
+        self.threads = {}  # thread id -> thread name, for the sampler
+        self.profilers = []  # one cProfile.Profile per profiled thread
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.sampler = None
+        self.main_profiler = None
+        self.started = None
+        self.duration = None
+        self.token = None
+
+    def start(self):
+        """Profile the calling thread, and jobs it hands to the scheduler."""
+        self.started = time.time()
+        self.token = _current_profile.set(self)
+        self.main_profiler = self._enter_thread()
+        if self.mode == 'sampler':
+            self.sampler = threading.Thread(target=self._sample, name=f'profiler-{self.profile_id}', daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        if self.duration is not None:
+            return
+        self._exit_thread(self.main_profiler)
+        self.duration = time.time() - self.started
+        if self.sampler is not None:
+            self.stop_event.set()
+            self.sampler.join()
+        if self.token is not None:
+            _current_profile.reset(self.token)
+
+    def _enter_thread(self):
+        thread = threading.current_thread()
+        if self.mode == 'cprofile':
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Python 3.12+ allows only one active cProfile per process
+                print(f"Profile {self.profile_id}: cannot profile thread {thread.name} - {e}")
+                return None
+            with self.lock:
+                self.profilers.append(profiler)
+            return profiler
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+        return None
+
+    def _exit_thread(self, profiler=None):
+        if self.mode == 'cprofile':
+            if profiler is not None:
+                profiler.disable()
+            return
+        with self.lock:
+            self.threads.pop(threading.get_ident(), None)
+
+    @contextmanager
+    def thread(self):
+        """Include the calling thread in the profile while the block runs."""
+        profiler = self._enter_thread()
+        try:
+            yield
+        finally:
+            self._exit_thread(profiler)
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                threads = dict(self.threads)
+            frames = sys._current_frames()
+            for ident, name in threads.items():
+                frame = frames.get(ident)
+                if frame is None or ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(name)
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def save(self, directory: str = PROFILE_DIR, ring_size: int = PROFILE_RING_SIZE) -> Dict:
+        """Write the profile and its metadata, dropping the oldest beyond ring_size.
+
+        Returns the metadata, or None if there was nothing to save.
+        """
+        if self.mode == 'cprofile' and not self.profilers:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{self.profile_id}.{EXTENSIONS[self.mode]}')
+        if self.mode == 'cprofile':
+            stats = pstats.Stats(*self.profilers)
+            stats.dump_stats(path)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+        metadata = dict(self.details, **{
+            'id': self.profile_id,
+            'endpoint': self.endpoint,
+            'mode': self.mode,
+            'format': EXTENSIONS[self.mode],
+            'started_at': datetime.fromtimestamp(self.started).isoformat(),
+            'duration_ms': round(1000 * self.duration, 1),
+            'bytes': os.path.getsize(path)
+        })
+        if self.mode == 'sampler':
+            metadata['samples'] = self.samples
+            metadata['interval_ms'] = round(1000 * self.interval, 3)
+        with open(os.path.join(directory, f'{self.profile_id}.json'), 'w', encoding='utf-8') as f:
+            json.dump(metadata, f)
+        _trim_ring(directory, ring_size)
+        return metadata
+
+
+def _trim_ring(directory, ring_size):
+    # Profile ids start with their timestamp, so names sort oldest first
+    ids = sorted({name.split('.')[0] for name in os.listdir(directory) if PROFILE_ID_PATTERN.match(name.split('.')[0])})
+    for profile_id in ids[:max(0, len(ids) - ring_size)]:
+        for extension in ('json',) + tuple(EXTENSIONS.values()):
+            try:
+                os.remove(os.path.join(directory, f'{profile_id}.{extension}'))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory: str = PROFILE_DIR) -> List[Dict]:
+    """Metadata of the stored profiles, newest first."""
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # removed or being written while listing
+    return profiles
+
+
+def profile_path(profile_id: str, directory: str = PROFILE_DIR) -> Optional[str]:
+    """Path of a stored profile's data file, or None if there is no such profile."""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    for extension in EXTENSIONS.values():
+        path = os.path.join(directory, f'{profile_id}.{extension}')
+        if os.path.exists(path):
+            return os.path.abspath(path)
+    return None
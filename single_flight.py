@@ -0,0 +1,213 @@
+"""Single-flight coalescing of identical concurrent work.
+
+Concurrent calls with the same key share one execution: the first caller (the
+leader) runs the function and every duplicate waits for and receives the same
+result, or the same error. Within a process this uses an event per key. Across
+worker processes the leader holds a lease file in a shared directory and
+publishes its outcome to a result file that followers poll for. The leader
+renews its lease while the call runs, including any wait in the scheduler
+queue. A lease whose holder died is taken over once it expires.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+
+class SharedCallError(RuntimeError):
+    """A leader in another process failed; raised for its remote followers."""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, lease_dir=None, lease_seconds=300, result_ttl=60, poll_interval=0.1):
+        self.lease_dir = lease_dir
+        self.lease_seconds = lease_seconds
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.stats = {'leaders': 0, 'coalesced_local': 0, 'coalesced_remote': 0}
+        if lease_dir:
+            os.makedirs(lease_dir, exist_ok=True)
+
+    def do(self, key, fn):
+        """Run fn() once per key among concurrent callers; return (value, shared)."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            self._count('coalesced_local')
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        shared = False
+        try:
+            if self.lease_dir:
+                call.value, shared = self._do_across_processes(key, fn)
+            else:
+                call.value = fn()
+                self._count('leaders')
+        except Exception as e:
+            # Local followers re-raise the very same exception object
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.value, shared
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def _paths(self, key):
+        return os.path.join(self.lease_dir, f'{key}.lease'), os.path.join(self.lease_dir, f'{key}.result')
+
+    def _do_across_processes(self, key, fn):
+        lease_path, result_path = self._paths(key)
+        while True:
+            token = self._acquire_lease(lease_path)
+            if token is not None:
+                break
+            outcome = self._wait_for_remote(lease_path, result_path)
+            if outcome is not None:
+                self._count('coalesced_remote')
+                if outcome.get('error') is not None:
+                    raise SharedCallError(outcome['error'])
+                return outcome['value'], True
+
+        self._count('leaders')
+        stop_renewing = threading.Event()
+        threading.Thread(target=self._renew_lease, args=(lease_path, token, stop_renewing), daemon=True).start()
+        try:
+            value = fn()
+        except Exception as e:
+            self._publish(result_path, {'token': token, 'error': str(e)})
+            raise
+        else:
+            self._publish(result_path, {'token': token, 'value': value, 'error': None})
+            return value, False
+        finally:
+            stop_renewing.set()
+            self._release_lease(lease_path, token)
+            self._sweep_results()
+
+    def _acquire_lease(self, lease_path):
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'token': token, 'pid': os.getpid(), 'expires_at': time.time() + self.lease_seconds}, f)
+        return token
+
+    def _renew_lease(self, lease_path, token, stop):
+        """Push the lease's expiry forward until stop is set, while it is still ours."""
+        while not stop.wait(self.lease_seconds / 3):
+            lease = self._read_lease(lease_path)
+            if not lease or lease.get('token') != token:
+                return
+            lease['expires_at'] = time.time() + self.lease_seconds
+            temp_path = f'{lease_path}.{uuid.uuid4().hex}.tmp'
+            try:
+                with open(temp_path, 'w') as f:
+                    json.dump(lease, f)
+                os.replace(temp_path, lease_path)
+            except OSError as e:
+                print(f"Error renewing lease {lease_path}: {e}")
+
+    def _read_lease(self, lease_path):
+        try:
+            with open(lease_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _release_lease(self, lease_path, token):
+        lease = self._read_lease(lease_path)
+        if lease and lease.get('token') == token:
+            try:
+                os.remove(lease_path)
+            except FileNotFoundError:
+                pass
+
+    def _wait_for_remote(self, lease_path, result_path):
+        """Wait for another process's leader; None means retry for the lease."""
+        lease = self._read_lease(lease_path)
+        while lease is None:
+            # The holder is still writing its lease file, or died before it
+            # could; an unreadable lease expires lease_seconds after creation
+            try:
+                expires_at = os.path.getmtime(lease_path) + self.lease_seconds
+            except FileNotFoundError:
+                return None
+            if time.time() > expires_at:
+                try:
+                    os.remove(lease_path)
+                except FileNotFoundError:
+                    pass
+                return None
+            time.sleep(self.poll_interval / 10)
+            lease = self._read_lease(lease_path)
+
+        while True:
+            outcome = self._read_result(result_path)
+            if outcome is not None and outcome.get('token') == lease.get('token'):
+                return outcome
+
+            current = self._read_lease(lease_path)
+            if current is None or current.get('token') != lease.get('token'):
+                # Released without a result we can read, or replaced; race again
+                outcome = self._read_result(result_path)
+                if outcome is not None and outcome.get('token') == lease.get('token'):
+                    return outcome
+                return None
+
+            if time.time() > current.get('expires_at', 0):
+                # The leader died mid-call; break its lease and take over
+                self._release_lease(lease_path, current.get('token'))
+                return None
+
+            time.sleep(self.poll_interval)
+
+    def _read_result(self, result_path):
+        try:
+            with open(result_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _publish(self, result_path, outcome):
+        temp_path = f'{result_path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(outcome, f, ensure_ascii=False)
+        os.replace(temp_path, result_path)
+
+    def _sweep_results(self):
+        """Remove published results old enough that no follower still needs them."""
+        cutoff = time.time() - self.result_ttl
+        try:
+            for entry in os.scandir(self.lease_dir):
+                if entry.name.endswith('.result') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+        except OSError:
+            pass
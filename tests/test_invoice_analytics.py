@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from invoice_analytics import InvoiceAnalytics
+from invoice_model import Invoice
+from invoice_store import InvoiceStore
+
+SHA256 = 'ab' * 32
+
+
+def make_invoice(total, hsn='8471'):
+    return Invoice.from_dict({
+        'company_info': {'gstin': '27AAAAA0000A1Z5'},
+        'invoice_info': {'invoice_date': '2024-03-05'},
+        'totals': {'total_invoice': total},
+        'items': [{'hsn_code': hsn, 'taxable_value': total}],
+    })
+
+
+def test_invoice_appended_twice_is_counted_once(tmp_path):
+    store = InvoiceStore(str(tmp_path / 'extractions.jsonl'))
+    store.append(make_invoice(100), SHA256)
+    store.append(make_invoice(100), SHA256)  # e.g. a redelivered queue job
+    analytics = InvoiceAnalytics(store, str(tmp_path / 'analytics'))
+
+    result = analytics.query('supplier')
+    assert result['invoices'] == 1
+    assert result['groups'][0]['total_invoice'] == 100.0
+
+    # Also across refreshes, and from a fresh instance reading the columns
+    store.append(make_invoice(100), SHA256)
+    assert analytics.query('supplier')['invoices'] == 1
+    assert InvoiceAnalytics(store, str(tmp_path / 'analytics')).query('supplier')['invoices'] == 1
+
+
+def test_backfill_of_a_duplicate_replaces_the_counted_row(tmp_path):
+    store = InvoiceStore(str(tmp_path / 'extractions.jsonl'))
+    store.append(make_invoice(100), SHA256)
+    duplicate = store.append(make_invoice(100), SHA256)
+    analytics = InvoiceAnalytics(store, str(tmp_path / 'analytics'))
+    analytics.refresh()
+
+    store.append(make_invoice(120, hsn='8473'), SHA256, source='backfill', supersedes=duplicate)
+    result = analytics.query('hsn')
+    assert result['invoices'] == 1
+    assert [(group['key'], group['taxable_value']) for group in result['groups']] == [('8473', 120.0)]
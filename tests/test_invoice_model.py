@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from invoice_model import Invoice, to_number
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('Rs. 1,200', 1200.0),
+    ('Rs.1,200.00', 1200.0),
+    ('INR 1200', 1200.0),
+    ('₹ 5,54,400.00', 554400.0),
+    ('1,234,567.89', 1234567.89),
+    ('1,200/-', 1200.0),
+    ('-₹100', -100.0),
+    ('18%', 18.0),
+    ('10 Nos', 10.0),
+    (42, 42.0),
+])
+def test_to_number_parses_indian_amounts(value, expected):
+    assert to_number(value) == expected
+
+
+@pytest.mark.parametrize('value', ['1.200,00', '1.200.00', '12,5', 'Rs.', 'abc', '', None, True])
+def test_to_number_does_not_guess(value):
+    assert to_number(value) is None
+
+
+def test_ambiguous_amount_is_kept_as_written():
+    invoice = Invoice.from_dict({'totals': {'invoice_amount': '1.200,00', 'total_invoice': 'Rs. 1,416'}})
+    assert invoice.to_dict()['totals'] == {'invoice_amount': '1.200,00', 'total_invoice': 1416.0}
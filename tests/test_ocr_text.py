@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ocr_text
+
+SUPPLIER = '27AAPFU0939F1ZV'
+BUYER = '29AABCT1332L1ZA'
+
+
+def test_supplier_found_in_ocr_text_picks_its_mode(monkeypatch):
+    monkeypatch.setattr(ocr_text, 'OCR_MODE', 'image')
+    monkeypatch.setattr(ocr_text, 'SUPPLIER_MODES', {SUPPLIER: 'text'})
+    # Unknown supplier: the page is OCRed to look for one with an override
+    assert ocr_text.needs_ocr(None)
+
+    text = f'[40,30] Acme Traders GSTIN:{SUPPLIER.lower()}\n[40,220] Bill to GSTIN {BUYER}'
+    assert ocr_text.supplier_in_text(text) == SUPPLIER
+    assert ocr_text.input_mode_for(ocr_text.supplier_in_text(text)) == 'text'
+    assert ocr_text.supplier_in_text(f'[40,30] GSTIN {BUYER}') is None
+
+
+def test_no_ocr_without_text_overrides(monkeypatch):
+    monkeypatch.setattr(ocr_text, 'OCR_MODE', 'image')
+    monkeypatch.setattr(ocr_text, 'SUPPLIER_MODES', {SUPPLIER: 'image'})
+    assert not ocr_text.needs_ocr(None)
+    assert not ocr_text.needs_ocr(BUYER)
@@ -0,0 +1,23 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webhooks import BREAKER_COOLDOWN, FAILURE_THRESHOLD, EndpointHealth
+
+
+def test_only_the_failure_that_opens_the_breaker_reports_it():
+    health = EndpointHealth('http://receiver.invalid/hook')
+    opened = [health.record_failure(0.1, 'HTTP 500') for _ in range(FAILURE_THRESHOLD + 3)]
+    assert opened == [False] * (FAILURE_THRESHOLD - 1) + [True, False, False, False]
+
+    # Late failures of deliveries already in flight keep the original cooldown
+    opened_at = health.opened_at
+    health.record_failure(0.1, 'HTTP 500')
+    assert health.opened_at == opened_at
+
+    # A failed half-open probe opens it again
+    health.opened_at -= BREAKER_COOLDOWN
+    assert health.before_send() == 'probe'
+    assert health.record_failure(0.1, 'HTTP 500') is True
+    assert health.state == 'open'
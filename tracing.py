@@ -0,0 +1,244 @@
+"""Lightweight request tracing.
+
+A trace is started per request and held in a context variable. Code anywhere
+in the pipeline opens timed spans with ``span(name)``; when no trace is active
+this returns a shared no-op, so instrumented code costs almost nothing outside
+a traced request. Finished traces are:
+
+- summarised in a ``Server-Timing`` header (``server_timing()``),
+- appended as one JSON line to ``TRACE_LOG_FILE``,
+- optionally appended in OTLP/JSON form to ``OTEL_EXPORT_FILE``, the format the
+  OpenTelemetry collector's ``otlpjsonfile`` receiver reads.
+
+``propagation_headers()`` gives the ``X-Trace-Id`` and W3C ``traceparent``
+headers that carry the trace to webhook deliveries.
+"""
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+TRACE_LOG_FILE = os.environ.get('TRACE_LOG_FILE', os.path.join('uploads', 'traces.jsonl'))
+TRACE_LOG_MAX_BYTES = int(os.environ.get('TRACE_LOG_MAX_BYTES', 10 * 1024 * 1024))
+OTEL_EXPORT_FILE = os.environ.get('OTEL_EXPORT_FILE')
+SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', 'invoice-extractor')
+
+TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+_write_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ('name', 'span_id', 'parent_id', 'start', 'duration', 'attributes', 'error')
+
+    def __init__(self, name, parent_id, attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration = None
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self, trace_start):
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'offset_ms': round(1000 * (self.start - trace_start), 2),
+            'duration_ms': round(1000 * (self.duration or 0), 2),
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+class _NoopSpan:
+    """Stand-in returned by span() outside a trace."""
+    span_id = None
+
+    def set(self, key, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    def __init__(self, name, trace_id=None, parent_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.root = Span(name, parent_id, {})
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def server_timing(self):
+        """Server-Timing header value: one entry per span name, durations summed."""
+        totals = {}
+        with self.lock:
+            for span in self.spans:
+                if span.duration is None:
+                    continue
+                name = re.sub(r'[^A-Za-z0-9_-]', '_', span.name)
+                duration, count = totals.get(name, (0.0, 0))
+                totals[name] = (duration + span.duration, count + 1)
+        entries = [
+            f'{name};dur={1000 * duration:.1f}' + (f';desc="x{count}"' if count > 1 else '')
+            for name, (duration, count) in totals.items()
+        ]
+        if self.root.duration is not None:
+            entries.append(f'total;dur={1000 * self.root.duration:.1f}')
+        return ', '.join(entries)
+
+    def to_dict(self):
+        with self.lock:
+            spans = [span.to_dict(self.root.start) for span in self.spans]
+        return {
+            'trace_id': self.trace_id,
+            'name': self.root.name,
+            'timestamp': self.root.start,
+            'duration_ms': round(1000 * (self.root.duration or 0), 2),
+            'attributes': self.root.attributes,
+            'error': self.root.error,
+            'spans': spans
+        }
+
+
+def start_trace(name, traceparent=None, **attributes):
+    """Begin a trace in the current context, continuing an incoming traceparent."""
+    trace_id = parent_id = None
+    if traceparent:
+        match = TRACEPARENT_PATTERN.match(traceparent.strip().lower())
+        if match and match.group(1) != '0' * 32:
+            trace_id, parent_id = match.groups()
+    trace = Trace(name, trace_id, parent_id)
+    trace.root.attributes.update(attributes)
+    _current_trace.set(trace)
+    _current_span.set(trace.root)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def end_trace(trace, **attributes):
+    """Close the root span, write the trace out and clear it from the context."""
+    trace.root.duration = time.time() - trace.root.start
+    trace.root.attributes.update(attributes)
+    _current_trace.set(None)
+    _current_span.set(None)
+    try:
+        _append_line(TRACE_LOG_FILE, trace.to_dict(), TRACE_LOG_MAX_BYTES)
+        if OTEL_EXPORT_FILE:
+            _append_line(OTEL_EXPORT_FILE, to_otlp(trace))
+    except OSError as e:
+        print(f"Error writing trace {trace.trace_id}: {e}")
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time a block as a child of the current span."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield NOOP_SPAN
+        return
+
+    current = Span(name, _current_span.get().span_id, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        current.duration = time.time() - current.start
+        _current_span.reset(token)
+        trace.add(current)
+
+
+def add_span(name, duration, start=None, **attributes):
+    """Record an already-measured interval (e.g. queue wait) as a span."""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    recorded = Span(name, _current_span.get().span_id, attributes)
+    recorded.start = start if start is not None else time.time() - duration
+    recorded.duration = duration
+    trace.add(recorded)
+
+
+def propagation_headers() -> Dict[str, str]:
+    """Headers carrying the current trace to downstream services."""
+    trace = _current_trace.get()
+    if trace is None:
+        return {}
+    return {
+        'X-Trace-Id': trace.trace_id,
+        'traceparent': f'00-{trace.trace_id}-{_current_span.get().span_id}-01'
+    }
+
+
+def to_otlp(trace):
+    """The trace as an OTLP/JSON ``ExportTraceServiceRequest``."""
+    def attributes(values):
+        converted = []
+        for key, value in values.items():
+            if isinstance(value, bool):
+                converted.append({'key': key, 'value': {'boolValue': value}})
+            elif isinstance(value, int):
+                converted.append({'key': key, 'value': {'intValue': str(value)}})
+            elif isinstance(value, float):
+                converted.append({'key': key, 'value': {'doubleValue': value}})
+            else:
+                converted.append({'key': key, 'value': {'stringValue': str(value)}})
+        return converted
+
+    def otlp_span(span, kind):
+        record = {
+            'traceId': trace.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': kind,
+            'startTimeUnixNano': str(int(span.start * 1e9)),
+            'endTimeUnixNano': str(int((span.start + (span.duration or 0)) * 1e9)),
+            'attributes': attributes(span.attributes),
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1}
+        }
+        if span.parent_id:
+            record['parentSpanId'] = span.parent_id
+        return record
+
+    with trace.lock:
+        spans = [otlp_span(trace.root, 2)] + [otlp_span(span, 1) for span in trace.spans]
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': attributes({'service.name': SERVICE_NAME})},
+            'scopeSpans': [{'scope': {'name': 'invoice.tracing'}, 'spans': spans}]
+        }]
+    }
+
+
+def _append_line(path, record, max_bytes=None):
+    line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+    with _write_lock:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if max_bytes and os.path.exists(path) and os.path.getsize(path) + len(line) > max_bytes:
+            # Keep one previous generation
+            os.replace(path, path + '.1')
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line)
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import tempfile
+import time
+from typing import Optional, Tuple
+
+from flask import Request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+# Magic byte signatures of accepted uploads. The type is decided from the first
+# bytes of the stream, never from the filename extension.
+MAGIC_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png', 'png'),
+    (b'\xff\xd8\xff', 'image/jpeg', 'jpg'),
+    (b'GIF87a', 'image/gif', 'gif'),
+    (b'GIF89a', 'image/gif', 'gif'),
+    (b'BM', 'image/bmp', 'bmp'),
+    (b'II*\x00', 'image/tiff', 'tiff'),
+    (b'MM\x00*', 'image/tiff', 'tiff'),
+    (b'%PDF-', 'application/pdf', 'pdf'),
+]
+SNIFF_BYTES = max(len(magic) for magic, _, _ in MAGIC_SIGNATURES)
+
+
+def sniff_mime_type(header: bytes) -> Optional[Tuple[str, str]]:
+    """Return (mime_type, extension) for the given leading bytes, or None."""
+    for magic, mime_type, extension in MAGIC_SIGNATURES:
+        if header.startswith(magic):
+            return mime_type, extension
+    return None
+
+
+class InvalidUpload(BadRequest):
+    description = 'Invalid file type. Please upload an image file.'
+
+
+class UploadSpool:
+    """Spool file that hashes and sniffs an upload while it is being written."""
+
+    def __init__(self, directory: str, max_bytes: Optional[int] = None):
+        fd, self.path = tempfile.mkstemp(prefix='temp_invoice_', dir=directory)
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self._header = b''
+        self.max_bytes = max_bytes
+        self.size = 0
+        # Timings for tracing: when the part started/finished arriving and
+        # the time spent writing it to disk
+        self.started_at = time.time()
+        self.finished_at = None
+        self.write_seconds = 0.0
+        self.mime_type = None
+        self.extension = None
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+
+        if self.mime_type is None:
+            self._header = (self._header + data)[:SNIFF_BYTES]
+            if len(self._header) >= SNIFF_BYTES:
+                self._sniff()
+
+        self._hash.update(data)
+        started = time.perf_counter()
+        written = self._file.write(data)
+        self.write_seconds += time.perf_counter() - started
+        return written
+
+    def _sniff(self):
+        sniffed = sniff_mime_type(self._header)
+        if sniffed is None:
+            raise InvalidUpload()
+        self.mime_type, self.extension = sniffed
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # The multipart parser rewinds the file once the part is complete, so
+        # this is where short uploads get their final type check.
+        if self.mime_type is None:
+            self._sniff()
+        if self.finished_at is None:
+            self.finished_at = time.time()
+        self._file.flush()
+        return self._file.seek(offset, whence)
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def close(self):
+        """Close the spool and remove its file from disk."""
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class StreamingUploadRequest(Request):
+    """Request that streams uploaded files straight into hashing spool files."""
+
+    # Maximum body size per endpoint name; other endpoints use MAX_CONTENT_LENGTH.
+    upload_limits = {}
+    upload_folder = tempfile.gettempdir()
+
+    @property
+    def max_content_length(self):
+        limit = self.upload_limits.get(self.endpoint)
+        if limit is not None:
+            return limit
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = UploadSpool(self.upload_folder, max_bytes=self.max_content_length)
+        self.__dict__.setdefault('_upload_spools', []).append(spool)
+        return spool
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for spool in self.__dict__.pop('_upload_spools', []):
+                spool.close()
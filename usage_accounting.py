@@ -0,0 +1,288 @@
+"""Token and cost accounting for model calls, with daily budgets.
+
+Every model call's input and output token counts and latency are added to a
+SQLite table of daily totals. The table is keyed by day, endpoint, model,
+supplier and prompt version, so spend can be broken down by any of them. The
+API, queue workers and the hot-folder watcher all write to the same database.
+
+Budgets are daily token counts:
+
+- ``TOKEN_BUDGETS_PER_MODEL`` (e.g. ``gemini-1.5-pro=2000000``). A model that
+  has used its budget is left out of the cascade, so invoices go to a cheaper
+  model instead.
+- ``TOKEN_BUDGET_DAILY`` caps all models together. Past ``BUDGET_DOWNGRADE_AT``
+  of it, only the cheapest allowed model is used. Once it is used up,
+  extractions are throttled to ``BUDGET_THROTTLE_PER_MINUTE`` per process, or
+  refused until the next day if that is 0.
+"""
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+USAGE_DB = os.environ.get('USAGE_DB', os.path.join('uploads', 'usage.db'))
+TOKEN_BUDGET_DAILY = int(os.environ.get('TOKEN_BUDGET_DAILY', 0))  # 0: no limit
+BUDGET_DOWNGRADE_AT = float(os.environ.get('BUDGET_DOWNGRADE_AT', 0.8))
+BUDGET_THROTTLE_PER_MINUTE = int(os.environ.get('BUDGET_THROTTLE_PER_MINUTE', 0))
+
+MODEL_TOKEN_BUDGETS = {}
+for entry in os.environ.get('TOKEN_BUDGETS_PER_MODEL', '').split(','):
+    model, _, budget = entry.partition('=')
+    if model.strip() and budget.strip():
+        MODEL_TOKEN_BUDGETS[model.strip()] = int(budget)
+
+# USD per million (input, output) tokens; override or extend with
+# MODEL_PRICES=model=input/output,...
+MODEL_PRICES = {
+    'gemini-1.5-flash-8b': (0.0375, 0.15),
+    'gemini-1.5-flash': (0.075, 0.30),
+    'gemini-1.5-pro': (1.25, 5.00),
+}
+for entry in os.environ.get('MODEL_PRICES', '').split(','):
+    model, _, prices = entry.partition('=')
+    if model.strip() and '/' in prices:
+        input_price, output_price = prices.split('/', 1)
+        MODEL_PRICES[model.strip()] = (float(input_price), float(output_price))
+
+DIMENSIONS = ('day', 'endpoint', 'model', 'supplier', 'prompt')
+TOTALS_CACHE_SECONDS = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    day TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    model TEXT NOT NULL,
+    supplier TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    calls INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    latency_seconds REAL NOT NULL,
+    PRIMARY KEY (day, endpoint, model, supplier, prompt)
+);
+"""
+
+# Endpoint the current model calls are made for; set per request or job
+_endpoint = contextvars.ContextVar('usage_endpoint', default='other')
+
+
+def set_endpoint(name: str):
+    """Attribute model calls made in the current context to an endpoint."""
+    _endpoint.set(name or 'other')
+
+
+def cost_of(model: str, prompt_tokens: int, output_tokens: int) -> Optional[float]:
+    """USD cost of tokens on a model, or None if its price is unknown."""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return (prompt_tokens * prices[0] + output_tokens * prices[1]) / 1_000_000
+
+
+class UsageAccounting:
+    def __init__(self, path: str = USAGE_DB, daily_budget: int = TOKEN_BUDGET_DAILY,
+                 model_budgets: Optional[Dict[str, int]] = None, downgrade_at: float = BUDGET_DOWNGRADE_AT,
+                 throttle_per_minute: int = BUDGET_THROTTLE_PER_MINUTE):
+        self.path = path
+        self.daily_budget = daily_budget
+        self.model_budgets = MODEL_TOKEN_BUDGETS if model_budgets is None else model_budgets
+        self.downgrade_at = downgrade_at
+        self.throttle_per_minute = throttle_per_minute
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self._totals = None  # (day, read at, {model: tokens})
+        self._throttle = (0, 0)  # (minute, extractions admitted in it)
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    def record(self, calls: List[Tuple[str, int, int, float]], supplier: Optional[str] = None,
+               prompt: str = '', endpoint: Optional[str] = None):
+        """Add model calls, given as (model, prompt tokens, output tokens, latency)."""
+        if not calls:
+            return
+        day = date.today().isoformat()
+        endpoint = endpoint or _endpoint.get()
+        rows = {}
+        for model, prompt_tokens, output_tokens, latency in calls:
+            row = rows.setdefault(model, [0, 0, 0, 0.0])
+            row[0] += 1
+            row[1] += prompt_tokens
+            row[2] += output_tokens
+            row[3] += latency
+        try:
+            self._connection().executemany(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (day, endpoint, model, supplier, prompt) DO UPDATE SET "
+                "calls = calls + excluded.calls, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "output_tokens = output_tokens + excluded.output_tokens, "
+                "latency_seconds = latency_seconds + excluded.latency_seconds",
+                [(day, endpoint, model, supplier or 'unknown', prompt) + tuple(row) for model, row in rows.items()]
+            )
+        except sqlite3.Error as e:
+            print(f"Error recording token usage: {e}")
+            return
+        with self.lock:
+            # Count our own calls straight away instead of waiting for a re-read
+            if self._totals is not None and self._totals[0] == day:
+                for model, row in rows.items():
+                    self._totals[2][model] = self._totals[2].get(model, 0) + row[1] + row[2]
+
+    def tokens_today(self) -> Dict[str, int]:
+        """Tokens used today per model, by all processes (re-read every few seconds)."""
+        day = date.today().isoformat()
+        with self.lock:
+            if self._totals is not None and self._totals[0] == day \
+                    and time.monotonic() - self._totals[1] < TOTALS_CACHE_SECONDS:
+                return dict(self._totals[2])
+        try:
+            totals = {
+                row['model']: row['tokens'] for row in self._connection().execute(
+                    "SELECT model, SUM(prompt_tokens + output_tokens) AS tokens FROM usage "
+                    "WHERE day = ? GROUP BY model", (day,))
+            }
+        except sqlite3.Error as e:
+            print(f"Error reading token usage: {e}")
+            totals = {}
+        with self.lock:
+            self._totals = (day, time.monotonic(), totals)
+        return dict(totals)
+
+    def allowed_models(self, models: List[str]) -> List[str]:
+        """The models of a cascade (cheapest first) that today's budgets still allow."""
+        if not self.daily_budget and not self.model_budgets:
+            return list(models)
+        used = self.tokens_today()
+        allowed = [
+            model for model in models
+            if model not in self.model_budgets or used.get(model, 0) < self.model_budgets[model]
+        ]
+        if self.daily_budget and sum(used.values()) >= self.downgrade_at * self.daily_budget:
+            allowed = allowed[:1]
+        return allowed
+
+    def _over_budget(self):
+        return bool(self.daily_budget) and sum(self.tokens_today().values()) >= self.daily_budget
+
+    def _seconds_until_tomorrow(self):
+        now = datetime.now()
+        tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return max(1, int((tomorrow - now).total_seconds()))
+
+    def check(self) -> Optional[int]:
+        """Seconds until an extraction would be allowed, or None if it is allowed now."""
+        if not self._over_budget():
+            return None
+        if not self.throttle_per_minute:
+            return self._seconds_until_tomorrow()
+        minute = int(time.time() // 60)
+        with self.lock:
+            if self._throttle[0] != minute or self._throttle[1] < self.throttle_per_minute:
+                return None
+        return max(1, int(60 - time.time() % 60))
+
+    def try_acquire(self) -> Optional[int]:
+        """Like check(), but counts an allowed extraction against the throttle."""
+        if not self._over_budget():
+            return None
+        if not self.throttle_per_minute:
+            return self._seconds_until_tomorrow()
+        minute = int(time.time() // 60)
+        with self.lock:
+            admitted = self._throttle[1] if self._throttle[0] == minute else 0
+            if admitted < self.throttle_per_minute:
+                self._throttle = (minute, admitted + 1)
+                return None
+        return max(1, int(60 - time.time() % 60))
+
+    def budget_status(self) -> Dict:
+        used = self.tokens_today()
+        total = sum(used.values())
+        status = {
+            'day': date.today().isoformat(),
+            'tokens_used': total,
+            'daily_budget': self.daily_budget or None,
+            'models': {
+                model: {'tokens_used': used.get(model, 0), 'budget': budget,
+                        'exhausted': used.get(model, 0) >= budget}
+                for model, budget in self.model_budgets.items()
+            }
+        }
+        if self.daily_budget:
+            status['used_fraction'] = round(total / self.daily_budget, 4)
+            status['state'] = ('throttled' if total >= self.daily_budget
+                               else 'downgraded' if total >= self.downgrade_at * self.daily_budget
+                               else 'normal')
+        return status
+
+    def report(self, day_from: Optional[str] = None, day_to: Optional[str] = None,
+               group_by: Tuple[str, ...] = ('day', 'endpoint', 'model')) -> Dict:
+        """Calls, tokens, latency and cost between two days, grouped by the given dimensions."""
+        for dimension in group_by:
+            if dimension not in DIMENSIONS:
+                raise ValueError(f"Invalid group_by '{dimension}'. Use any of: {', '.join(DIMENSIONS)}")
+        day_to = day_to or date.today().isoformat()
+        day_from = day_from or (date.fromisoformat(day_to) - timedelta(days=29)).isoformat()
+        for day in (day_from, day_to):
+            date.fromisoformat(day)  # ValueError on a malformed date
+
+        # Cost needs the model, so rows are fetched per model and folded
+        # into the requested groups here
+        keys = tuple(dict.fromkeys(tuple(group_by) + ('model',)))
+        rows = self._connection().execute(
+            f"SELECT {', '.join(keys)}, SUM(calls) AS calls, SUM(prompt_tokens) AS prompt_tokens, "
+            f"SUM(output_tokens) AS output_tokens, SUM(latency_seconds) AS latency_seconds "
+            f"FROM usage WHERE day BETWEEN ? AND ? GROUP BY {', '.join(keys)}",
+            (day_from, day_to)
+        ).fetchall()
+
+        groups = {}
+        totals = {'calls': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'latency_seconds': 0.0, 'cost_usd': 0.0}
+        unpriced = set()
+        for row in rows:
+            group = groups.setdefault(tuple(row[dimension] for dimension in group_by),
+                                      {key: 0 for key in ('calls', 'prompt_tokens', 'output_tokens')})
+            cost = cost_of(row['model'], row['prompt_tokens'], row['output_tokens'])
+            if cost is None:
+                unpriced.add(row['model'])
+            for target in (group, totals):
+                target['calls'] += row['calls']
+                target['prompt_tokens'] += row['prompt_tokens']
+                target['output_tokens'] += row['output_tokens']
+                target['latency_seconds'] = target.get('latency_seconds', 0.0) + row['latency_seconds']
+                target['cost_usd'] = target.get('cost_usd', 0.0) + (cost or 0.0)
+
+        def finish(values):
+            return {
+                'calls': values['calls'],
+                'prompt_tokens': values['prompt_tokens'],
+                'output_tokens': values['output_tokens'],
+                'total_tokens': values['prompt_tokens'] + values['output_tokens'],
+                'mean_latency_ms': round(1000 * values['latency_seconds'] / values['calls'], 1) if values['calls'] else None,
+                'cost_usd': round(values['cost_usd'], 6)
+            }
+
+        # Most expensive first
+        ordered = sorted(groups.items(), key=lambda entry: (-entry[1]['cost_usd'], -entry[1]['prompt_tokens']))
+        return {
+            'from': day_from,
+            'to': day_to,
+            'group_by': list(group_by),
+            'rows': [dict(zip(group_by, key), **finish(values)) for key, values in ordered],
+            'totals': finish(totals),
+            'unpriced_models': sorted(unpriced),
+            'budget': self.budget_status()
+        }
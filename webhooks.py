@@ -0,0 +1,327 @@
+import gzip
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+import tracing
+from invoice_model import Invoice
+
+# Webhook configuration storage
+WEBHOOK_CONFIG_FILE = os.environ.get('WEBHOOK_CONFIG_FILE', 'webhook_config.json')
+WEBHOOK_LOGS = []
+
+# Delivery timeouts in seconds; a webhook may override them with
+# "connect_timeout" / "read_timeout"
+CONNECT_TIMEOUT = float(os.environ.get('WEBHOOK_CONNECT_TIMEOUT', 3))
+READ_TIMEOUT = float(os.environ.get('WEBHOOK_READ_TIMEOUT', 10))
+
+# Circuit breaker settings
+FAILURE_THRESHOLD = int(os.environ.get('WEBHOOK_FAILURE_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.environ.get('WEBHOOK_BREAKER_COOLDOWN', 30))
+WEBHOOK_QUEUE_LIMIT = int(os.environ.get('WEBHOOK_QUEUE_LIMIT', 100))
+
+# Deliveries share a bounded pool instead of one thread each
+DELIVERY_POOL = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('WEBHOOK_MAX_WORKERS', 8)),
+    thread_name_prefix='webhook'
+)
+
+ENDPOINT_HEALTH = {}
+ENDPOINT_HEALTH_LOCK = threading.Lock()
+
+def load_webhook_config():
+    """Load webhook configuration from file."""
+    try:
+        if os.path.exists(WEBHOOK_CONFIG_FILE):
+            with open(WEBHOOK_CONFIG_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"Error loading webhook config: {e}")
+    return {'webhooks': []}
+
+def save_webhook_config(config):
+    """Save webhook configuration to file."""
+    try:
+        with open(WEBHOOK_CONFIG_FILE, 'w') as f:
+            json.dump(config, f, indent=2)
+        return True
+    except Exception as e:
+        print(f"Error saving webhook config: {e}")
+        return False
+
+def append_webhook_log(log_entry):
+    """Store a log entry, keeping only the last 100."""
+    WEBHOOK_LOGS.append(log_entry)
+    if len(WEBHOOK_LOGS) > 100:
+        WEBHOOK_LOGS.pop(0)
+
+def encode_payload(data):
+    """Encode invoice data to the JSON bytes shared by every delivery."""
+    if isinstance(data, Invoice):
+        return data.to_json_bytes()
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+class EndpointHealth:
+    """Circuit breaker and latency record for one webhook URL.
+
+    closed: deliveries flow normally. After FAILURE_THRESHOLD consecutive
+    failures the breaker opens and deliveries are short-circuited (dropped or
+    queued, per the webhook's "on_open" policy) without touching the network.
+    Once BREAKER_COOLDOWN seconds have passed a single half-open probe is let
+    through; success closes the breaker and replays queued deliveries, failure
+    opens it again. If deliveries are queued, the oldest one is sent as the
+    probe when the cooldown ends, so the queue drains without new traffic.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.last_error = None
+        self.successes = 0
+        self.failures = 0
+        self.short_circuited = 0
+        self.latencies = deque(maxlen=50)
+        self.queued = deque(maxlen=WEBHOOK_QUEUE_LIMIT)
+        self.lock = threading.Lock()
+
+    def before_send(self):
+        """Return 'send', 'probe' or 'reject' for a new delivery."""
+        with self.lock:
+            if self.state == 'closed':
+                return 'send'
+            if self.state == 'open' and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return 'probe'
+            self.short_circuited += 1
+            return 'reject'
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+            self.state = 'closed'
+            replay = list(self.queued)
+            self.queued.clear()
+        return replay
+
+    def record_failure(self, latency, error):
+        """Record a failed delivery; True only if it moved the breaker to open."""
+        with self.lock:
+            self.latencies.append(latency)
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+            if self.state == 'open':
+                # Deliveries sent before the breaker opened must not restart
+                # its cooldown or schedule another queue probe
+                return False
+            self.probe_in_flight = False
+            if self.state == 'half_open' or self.consecutive_failures >= FAILURE_THRESHOLD:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'successes': self.successes,
+                'failures': self.failures,
+                'short_circuited': self.short_circuited,
+                'queued': len(self.queued),
+                'last_error': self.last_error,
+                'latency_ms': {
+                    'last': round(1000 * self.latencies[-1], 1),
+                    'mean': round(1000 * sum(latencies) / len(latencies), 1),
+                    'p95': round(1000 * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 1)
+                } if latencies else None
+            }
+
+def get_endpoint_health(url):
+    with ENDPOINT_HEALTH_LOCK:
+        if url not in ENDPOINT_HEALTH:
+            ENDPOINT_HEALTH[url] = EndpointHealth(url)
+        return ENDPOINT_HEALTH[url]
+
+def get_webhook_health(url):
+    """Breaker state and recent latency for a URL (None if never used)."""
+    with ENDPOINT_HEALTH_LOCK:
+        health = ENDPOINT_HEALTH.get(url)
+    return health.snapshot() if health else None
+
+def send_webhook(url, body, headers=None, content_encoding=None, connect_timeout=None,
+                 read_timeout=None, on_open='drop'):
+    """Send an encoded payload to a webhook URL asynchronously."""
+    if not isinstance(body, bytes):
+        body = encode_payload(body)
+
+    delivery = {
+        'url': url,
+        'body': body,
+        'headers': headers,
+        'content_encoding': content_encoding,
+        'timeout': (
+            connect_timeout if connect_timeout is not None else CONNECT_TIMEOUT,
+            read_timeout if read_timeout is not None else READ_TIMEOUT
+        ),
+        'on_open': on_open
+    }
+    health = get_endpoint_health(url)
+    decision = health.before_send()
+    if decision == 'reject':
+        queued = on_open == 'queue'
+        if queued:
+            with health.lock:
+                health.queued.append(delivery)
+        append_webhook_log({
+            'timestamp': datetime.now().isoformat(),
+            'url': url,
+            'status': 'queued' if queued else 'short_circuited',
+            'response_code': None,
+            'error': f'Circuit open after {health.consecutive_failures} consecutive failures'
+        })
+        return
+
+    # Send webhook on the bounded delivery pool
+    DELIVERY_POOL.submit(_deliver, health, delivery)
+
+def _schedule_queue_probe(health):
+    """Probe with a queued delivery once the breaker's cooldown has passed."""
+    timer = threading.Timer(BREAKER_COOLDOWN, _probe_with_queued, args=(health,))
+    timer.daemon = True
+    timer.start()
+
+def _probe_with_queued(health):
+    with health.lock:
+        if not health.queued:
+            return  # Nothing waiting; the next new delivery probes instead
+        delivery = health.queued.popleft()
+    if health.before_send() == 'reject':
+        # A probe from new traffic is already in flight
+        with health.lock:
+            health.queued.appendleft(delivery)
+        return
+    try:
+        DELIVERY_POOL.submit(_deliver, health, dict(delivery, from_queue=True))
+    except RuntimeError:
+        # The pool is shutting down
+        with health.lock:
+            health.probe_in_flight = False
+            health.queued.appendleft(delivery)
+
+def _deliver(health, delivery):
+    log_entry = {
+        'timestamp': datetime.now().isoformat(),
+        'url': delivery['url'],
+        'status': 'pending',
+        'response_code': None,
+        'error': None,
+        'bytes_sent': len(delivery['body']),
+        'content_encoding': delivery['content_encoding'],
+        'trace_id': (delivery['headers'] or {}).get('X-Trace-Id')
+    }
+
+    started = time.monotonic()
+    try:
+        webhook_headers = {'Content-Type': 'application/json'}
+        if delivery['content_encoding']:
+            webhook_headers['Content-Encoding'] = delivery['content_encoding']
+        if delivery['headers']:
+            webhook_headers.update(delivery['headers'])
+
+        response = requests.post(
+            delivery['url'],
+            data=delivery['body'],
+            headers=webhook_headers,
+            timeout=delivery['timeout']
+        )
+
+        log_entry['status'] = 'success' if response.status_code < 400 else 'failed'
+        log_entry['response_code'] = response.status_code
+        log_entry['response_text'] = response.text[:500]  # Limit response text
+
+    except Exception as e:
+        log_entry['status'] = 'error'
+        log_entry['error'] = str(e)
+
+    latency = time.monotonic() - started
+    log_entry['latency_ms'] = round(1000 * latency, 1)
+    append_webhook_log(log_entry)
+
+    # A 4xx other than 429 means the endpoint is up but rejected this payload
+    code = log_entry['response_code']
+    if code is None or code >= 500 or code == 429:
+        if delivery.get('from_queue'):
+            # A failed probe from the queue goes back to the front of it
+            with health.lock:
+                health.queued.appendleft(delivery)
+        if health.record_failure(latency, log_entry['error'] or f'HTTP {code}'):
+            _schedule_queue_probe(health)
+    else:
+        for queued in health.record_success(latency):
+            send_webhook(
+                queued['url'], queued['body'], queued['headers'], queued['content_encoding'],
+                queued['timeout'][0], queued['timeout'][1], queued['on_open']
+            )
+
+def plan_deliveries(webhooks):
+    """Collapse enabled webhooks with the same URL and headers into one delivery."""
+    deliveries = {}
+    for webhook in webhooks:
+        if not webhook.get('enabled', True):
+            continue
+        key = (webhook['url'], json.dumps(webhook.get('headers') or {}, sort_keys=True))
+        deliveries.setdefault(key, webhook)
+    return list(deliveries.values())
+
+def dispatch_webhooks(data, webhooks=None):
+    """Deliver invoice data to every distinct enabled webhook.
+
+    The payload is encoded once (and gzipped at most once) and the same bytes
+    are shared by all deliveries. Returns the number of deliveries started.
+    """
+    if webhooks is None:
+        webhooks = load_webhook_config().get('webhooks', [])
+
+    deliveries = plan_deliveries(webhooks)
+    if not deliveries:
+        return 0
+
+    with tracing.span('webhooks', deliveries=len(deliveries)):
+        # Lets receivers correlate the delivery with this request's trace
+        extra_headers = tracing.propagation_headers()
+        if isinstance(data, Invoice):
+            # Receivers can compare invoices without parsing the body
+            extra_headers['X-Invoice-Digest'] = data.digest
+        body = encode_payload(data)
+        gzipped_body = None
+        for webhook in deliveries:
+            headers = dict(webhook.get('headers') or {}, **extra_headers)
+            options = {
+                'connect_timeout': webhook.get('connect_timeout'),
+                'read_timeout': webhook.get('read_timeout'),
+                'on_open': webhook.get('on_open', 'drop')
+            }
+            if webhook.get('gzip', False):
+                if gzipped_body is None:
+                    gzipped_body = gzip.compress(body, compresslevel=6)
+                send_webhook(webhook['url'], gzipped_body, headers, content_encoding='gzip', **options)
+            else:
+                send_webhook(webhook['url'], body, headers, **options)
+    return len(deliveries)
@@ -0,0 +1,352 @@
+"""Durable work queue between the API and standalone extraction workers.
+
+With ``EXTRACTION_BACKEND=queue`` the API enqueues extraction jobs instead of
+running them in-process. ``extraction_worker.py`` processes are started
+separately and can be scaled on their own.
+
+A worker leases a job for a visibility timeout and extends the lease while it
+runs. If the worker dies, the lease runs out and the job is handed to another
+worker. Failed jobs are retried with exponential backoff up to their maximum
+number of attempts. Delivery is at-least-once: a job may be processed twice
+when its lease expires under a slow but live worker, so anything a job does
+must tolerate repeats. A repeated job appends its extraction to the store
+again. Search and analytics count each invoice digest once, so they are not
+skewed. Webhooks fire again, and receivers can deduplicate on the
+X-Invoice-Digest header.
+
+Backends implement WorkQueue and are selected by ``WORK_QUEUE_URL``. The only
+backend is SQLiteQueue (``sqlite:///path``), so workers run as processes on a
+single host. Its database and ``WORK_QUEUE_FILES_DIR`` must be on local disk
+shared by the API and all workers. Spreading workers over several machines
+needs a backend on a network service, registered in BACKENDS, and none exists yet.
+"""
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from extraction_scheduler import PRIORITY_CLASSES
+
+WORK_QUEUE_URL = os.environ.get('WORK_QUEUE_URL', 'sqlite:///' + os.path.join('uploads', 'work_queue.db'))
+WORK_QUEUE_FILES_DIR = os.environ.get('WORK_QUEUE_FILES_DIR', os.path.join('uploads', 'queue_files'))
+VISIBILITY_TIMEOUT = float(os.environ.get('WORK_QUEUE_VISIBILITY_TIMEOUT', 120))
+MAX_ATTEMPTS = int(os.environ.get('WORK_QUEUE_MAX_ATTEMPTS', 3))
+RETRY_DELAY = float(os.environ.get('WORK_QUEUE_RETRY_DELAY', 10))  # doubled on each further attempt
+
+
+class QueueJob:
+    """A leased job; the lease token proves ownership to the backend."""
+    __slots__ = ('id', 'payload', 'priority', 'attempts', 'max_attempts', 'lease_token')
+
+    def __init__(self, id, payload, priority, attempts, max_attempts, lease_token):
+        self.id = id
+        self.payload = payload
+        self.priority = priority
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.lease_token = lease_token
+
+
+class WorkQueue:
+    """Interface of a work-queue backend."""
+
+    def enqueue(self, payload: Dict, priority: str = 'interactive', max_attempts: Optional[int] = None,
+                dedupe_key: Optional[str] = None) -> str:
+        """Add a job and return its id.
+
+        While a job with the same dedupe_key is queued or running, its id is
+        returned instead of adding another.
+        """
+        raise NotImplementedError
+
+    def lease(self, worker_id: str, visibility_timeout: float = VISIBILITY_TIMEOUT) -> Optional[QueueJob]:
+        """Take the next available job, or None if there is none."""
+        raise NotImplementedError
+
+    def extend(self, job: QueueJob, visibility_timeout: float = VISIBILITY_TIMEOUT) -> bool:
+        """Keep a lease alive; False if it was lost to another worker."""
+        raise NotImplementedError
+
+    def complete(self, job: QueueJob, result: Dict) -> bool:
+        """Store a job's result; False if another worker now holds the job."""
+        raise NotImplementedError
+
+    def fail(self, job: QueueJob, error: str, retry: bool = True) -> str:
+        """Record a failed attempt; returns the job's new status ('queued' or 'failed')."""
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Status of a job, with its result once done."""
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        raise NotImplementedError
+
+    def pending_payloads(self) -> List[Dict]:
+        """Payloads of jobs that are queued or running."""
+        raise NotImplementedError
+
+    def purge(self, older_than: float) -> int:
+        """Delete finished jobs not updated for older_than seconds; return how many."""
+        raise NotImplementedError
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    dedupe_key TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    lease_token TEXT,
+    leased_by TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, priority, available_at);
+CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key, status);
+"""
+
+
+class SQLiteQueue(WorkQueue):
+    """Work queue in a SQLite database, shared by processes on one machine."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Autocommit; writes that must be atomic use BEGIN IMMEDIATE
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def _transaction(self, work):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = work(connection)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    def enqueue(self, payload, priority='interactive', max_attempts=None, dedupe_key=None):
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class: {priority}")
+
+        def work(connection):
+            if dedupe_key:
+                row = connection.execute(
+                    "SELECT id FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'leased') LIMIT 1",
+                    (dedupe_key,)
+                ).fetchone()
+                if row:
+                    return row['id']
+            job_id = uuid.uuid4().hex
+            now = time.time()
+            connection.execute(
+                "INSERT INTO jobs (id, priority, status, payload, dedupe_key, max_attempts, available_at, "
+                "created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (job_id, PRIORITY_CLASSES.index(priority), json.dumps(payload), dedupe_key,
+                 max_attempts or MAX_ATTEMPTS, now, now, now)
+            )
+            return job_id
+
+        return self._transaction(work)
+
+    def lease(self, worker_id, visibility_timeout=VISIBILITY_TIMEOUT):
+        def work(connection):
+            now = time.time()
+            # Leases that ran out go back to the queue, unless out of attempts
+            connection.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END, "
+                "error = 'lease expired on ' || leased_by, lease_token = NULL, available_at = ?, updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires <= ?",
+                (now, now, now)
+            )
+            row = connection.execute(
+                "SELECT id, priority, payload, attempts, max_attempts FROM jobs "
+                "WHERE status = 'queued' AND available_at <= ? ORDER BY priority, available_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            token = uuid.uuid4().hex
+            connection.execute(
+                "UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_token = ?, leased_by = ?, "
+                "lease_expires = ?, updated_at = ? WHERE id = ?",
+                (token, worker_id, now + visibility_timeout, now, row['id'])
+            )
+            return QueueJob(row['id'], json.loads(row['payload']), PRIORITY_CLASSES[row['priority']],
+                            row['attempts'] + 1, row['max_attempts'], token)
+
+        return self._transaction(work)
+
+    def extend(self, job, visibility_timeout=VISIBILITY_TIMEOUT):
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'leased' AND lease_token = ?",
+            (now + visibility_timeout, now, job.id, job.lease_token)
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, job, result):
+        # A result is still accepted after the lease expired, as long as no
+        # other worker has picked the job up again
+        cursor = self._connection().execute(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_token = NULL, updated_at = ? "
+            "WHERE id = ? AND status != 'done' AND (status != 'leased' OR lease_token = ?)",
+            (json.dumps(result, ensure_ascii=False), time.time(), job.id, job.lease_token)
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, job, error, retry=True):
+        def work(connection):
+            row = connection.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND lease_token = ?",
+                (job.id, job.lease_token)
+            ).fetchone()
+            if row is None:
+                return 'lost'
+            now = time.time()
+            if retry and row['attempts'] < row['max_attempts']:
+                status = 'queued'
+                available_at = now + RETRY_DELAY * 2 ** (row['attempts'] - 1)
+            else:
+                status, available_at = 'failed', now
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_token = NULL, available_at = ?, updated_at = ? "
+                "WHERE id = ?",
+                (status, error, available_at, now, job.id)
+            )
+            return status
+
+        return self._transaction(work)
+
+    def get(self, job_id):
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {
+            'job_id': row['id'],
+            'status': row['status'],
+            'priority': PRIORITY_CLASSES[row['priority']],
+            'attempts': row['attempts'],
+            'max_attempts': row['max_attempts'],
+            'created_at': datetime.fromtimestamp(row['created_at']).isoformat(),
+            'updated_at': datetime.fromtimestamp(row['updated_at']).isoformat(),
+            'filename': json.loads(row['payload']).get('filename')
+        }
+        if row['status'] == 'leased':
+            job['worker'] = row['leased_by']
+        if row['error']:
+            job['error'] = row['error']
+        if row['result']:
+            job['result'] = json.loads(row['result'])
+        return job
+
+    def stats(self):
+        connection = self._connection()
+        counts = {status: 0 for status in ('queued', 'leased', 'done', 'failed')}
+        for row in connection.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status"):
+            counts[row['status']] = row['count']
+        queued = {priority: 0 for priority in PRIORITY_CLASSES}
+        for row in connection.execute(
+                "SELECT priority, COUNT(*) AS count FROM jobs WHERE status = 'queued' GROUP BY priority"):
+            queued[PRIORITY_CLASSES[row['priority']]] = row['count']
+        oldest = connection.execute("SELECT MIN(created_at) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        return {
+            'backend': 'sqlite',
+            'jobs': counts,
+            'queued': queued,
+            'oldest_queued_seconds': round(time.time() - oldest, 1) if oldest else None,
+            'workers': [
+                row['leased_by'] for row in connection.execute(
+                    "SELECT DISTINCT leased_by FROM jobs WHERE status = 'leased'")
+            ]
+        }
+
+    def pending_payloads(self):
+        return [
+            json.loads(row['payload'])
+            for row in self._connection().execute("SELECT payload FROM jobs WHERE status IN ('queued', 'leased')")
+        ]
+
+    def purge(self, older_than):
+        cursor = self._connection().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (time.time() - older_than,)
+        )
+        return cursor.rowcount
+
+
+# URL scheme -> backend class taking the rest of the URL
+BACKENDS = {
+    'sqlite': SQLiteQueue,
+}
+
+
+def open_queue(url: str = WORK_QUEUE_URL) -> WorkQueue:
+    """Open the work-queue backend named by a URL such as sqlite:///uploads/work_queue.db."""
+    scheme, separator, location = url.partition('://')
+    if not separator or scheme not in BACKENDS:
+        raise ValueError(f"Unsupported work queue URL '{url}'. Schemes: {', '.join(BACKENDS)}")
+    # sqlite:///relative/path and sqlite:////absolute/path, as in SQLAlchemy
+    return BACKENDS[scheme](location[1:] if location.startswith('/') else location)
+
+
+def spool_file(path: str, sha256: str, extension: str) -> str:
+    """Keep an upload in the queue's file folder, named by content, for workers to read."""
+    os.makedirs(WORK_QUEUE_FILES_DIR, exist_ok=True)
+    target = os.path.join(WORK_QUEUE_FILES_DIR, f'{sha256}.{extension}')
+    if os.path.exists(target):
+        # Fresh mtime so purge_files() leaves it alone until the job is queued
+        os.utime(target)
+        return target
+    temp_path = f'{target}.{uuid.uuid4().hex}.tmp'
+    try:
+        os.link(path, temp_path)
+    except OSError:
+        shutil.copyfile(path, temp_path)
+    os.replace(temp_path, target)
+    return target
+
+
+def purge_files(queue: WorkQueue, older_than: float) -> int:
+    """Delete spooled uploads no pending job needs that are older than older_than seconds."""
+    if not os.path.isdir(WORK_QUEUE_FILES_DIR):
+        return 0
+    needed = {os.path.abspath(payload.get('path', '')) for payload in queue.pending_payloads()}
+    cutoff = time.time() - older_than
+    removed = 0
+    for entry in os.scandir(WORK_QUEUE_FILES_DIR):
+        if entry.is_file() and os.path.abspath(entry.path) not in needed and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed